@@ -1,86 +1,286 @@
 import asyncio
-from typing import Any, Dict, List, Optional, Set
+import copy
+import functools
+import json
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
+import cachetools
 import google_auth_httplib2
 import googleapiclient
 import httplib2
 from api.request_batcher import GoogleDriveRequestBatcher
-from consts import FOLDER_TYPE, SHORTCUT_TYPE, logger
-from googleapiclient import discovery
+from api.direct_batch import DECODERS, DirectBatchHttpRequest
+from api.token_manager import TokenManager
+from consts import FOLDER_TYPE, REQUEST_INTERVAL, SHORTCUT_TYPE, logger
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient import discovery, discovery_cache
+from googleapiclient.http import MediaFileUpload
 from httplib2.error import HttpLib2Error
 
-DEFAULT_FIELDS = {
+# what the cache needs to walk trees; clients ask for anything else they read, with
+# subfields after a slash, e.g. "owners/me" instead of whole user objects
+BASE_FIELDS = {
     "id",
-    "size",
-    "kind",
-    "owners",
     "name",
     "mimeType",
     "parents",
-    "shortcutDetails",
+    "shortcutDetails/targetId",
 }
 
 
+def fields_mask(fields: Optional[Set[str]] = None) -> str:
+    """Partial response mask for BASE_FIELDS and fields, e.g. "owners(emailAddress,me)"
+
+    Sorted, so equal field sets always produce the same mask (and coalescing key).
+    """
+    nested = defaultdict(set)
+    for field in BASE_FIELDS.union(fields or ()):
+        name, _, subfield = field.partition("/")
+        nested[name].add(subfield)
+    # a bare name asks for the whole object, which covers its subfields
+    return ",".join(
+        name if "" in subfields else f"{name}({','.join(sorted(subfields))})"
+        for name, subfields in sorted(nested.items())
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def drive_document() -> str:
+    # the discovery document bundled with googleapiclient; build() would look it up again
+    # (and check its file cache) for every wrapper, i.e. once per account
+    return discovery_cache.get_static_doc("drive", "v3")  # type: ignore
+
+
 class GoogleDriveApiWrapper:
-    def __init__(self, credentials) -> None:
+    def __init__(
+        self,
+        credentials,
+        cache_ttl: float = 0,
+        cache_size: int = 10000,
+        api_endpoint: Optional[str] = None,
+        request_interval: float = REQUEST_INTERVAL,
+        transport: Optional[Callable[[], httplib2.Http]] = None,
+        fast_batch_decoder: bool = False,
+        json_decoder: str = "json",
+        deadlines: Optional[Dict[str, float]] = None,
+        hedge_percentile: float = 0,
+    ) -> None:
+        # with deadlines, sockets time out too, so threads of given up requests don't hang around
+        timeout = max(deadlines.values()) if deadlines else None
+        make_http = transport or functools.partial(httplib2.Http, timeout=timeout)
+
+        # one token for all requests of the account, instead of each Http refreshing on its own
+        self.tokens = None if isinstance(credentials, AnonymousCredentials) else TokenManager(credentials, make_http)
+        auth = self.tokens or credentials
+
         # Create a new Http() object for every request because httplib2 is not thread-safe
         # see: https://github.com/googleapis/google-api-python-client/blob/main/docs/thread_safety.md
+        def new_http():
+            http = make_http()
+            # uploads answer 308 to every chunk but the last, which httplib2 would follow as a
+            # redirect; googleapiclient's own build_http() drops it the same way
+            http.redirect_codes = http.redirect_codes - {308}
+            return google_auth_httplib2.AuthorizedHttp(auth, http=http)
+
         def build_request(http, *args, **kwargs):
-            new_http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
-            return googleapiclient.http.HttpRequest(new_http, *args, **kwargs)  # type: ignore
+            return googleapiclient.http.HttpRequest(new_http(), *args, **kwargs)  # type: ignore
 
-        authorized_http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
-        self.api = discovery.build(
-            "drive",
-            "v3",
+        self.new_http = new_http
+        authorized_http = new_http()
+        # parsed fresh every time, since building the service fixes up the document in place
+        document = json.loads(drive_document())
+        if api_endpoint:
+            # the batch uri is derived from rootUrl, so override that instead of client_options
+            document["rootUrl"] = api_endpoint
+        self.api = discovery.build_from_document(
+            document,
             requestBuilder=build_request,  # type: ignore
             http=authorized_http,
         )
+        self.request_interval = request_interval
+        self.deadlines = deadlines
+        self.hedge_percentile = hedge_percentile
+        self.new_batch = None
+        if fast_batch_decoder:
+            batch_uri = self.api.new_batch_http_request()._batch_uri
+            loads = DECODERS[json_decoder]
+            self.new_batch = lambda: DirectBatchHttpRequest(batch_uri, loads=loads)
 
         # lazy init, so by the time it's created we have a running loop
         self._batcher: GoogleDriveRequestBatcher = None  # type: ignore
         self.files = self.api.files()
         self.about = self.api.about()
+        self.changes = self.api.changes()
+
+        # identical metadata gets share one request while in flight, and optionally a
+        # response for cache_ttl seconds after
+        self._in_flight: Dict[tuple, asyncio.Task] = {}
+        self._responses = cachetools.TTLCache(cache_size, cache_ttl) if cache_ttl > 0 else None
+        # keys of cached responses by file id, None for the quota, so writes drop theirs directly
+        self._cached_keys: Dict[Optional[str], Set[tuple]] = defaultdict(set)
 
     @property
     def batcher(self):
         if self._batcher is None:
-            self._batcher = GoogleDriveRequestBatcher(self.api)
+            self._batcher = GoogleDriveRequestBatcher(
+                self.api,
+                request_interval=self.request_interval,
+                new_batch=self.new_batch,
+                deadlines=self.deadlines,
+                hedge_percentile=self.hedge_percentile,
+                new_http=self.new_http,
+            )
+            if self.tokens is not None:
+                self.tokens.start()
         return self._batcher
 
+    @property
+    def load(self) -> int:
+        """Requests this account has queued or in flight"""
+        return 0 if self._batcher is None else self._batcher.pending
+
+    async def _coalesced(self, key: tuple, make_request):
+        if self._responses is not None and key in self._responses:
+            return copy.deepcopy(self._responses[key])
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(make_request())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._in_flight.pop(key) if self._in_flight.get(key) is t else None)
+
+        resp = await asyncio.shield(task)
+        if self._responses is not None and resp is not None:
+            self._responses[key] = resp
+            self._cached_keys[key[1]].add(key)
+            if len(self._cached_keys) > self._responses.maxsize:
+                # more files than the cache holds, so some were expired or evicted
+                self._cached_keys.clear()
+                for cached in self._responses.keys():
+                    self._cached_keys[cached[1]].add(cached)
+        # callers are free to mutate what they get back
+        return copy.deepcopy(resp)
+
+    def _invalidate(self, file_id: Optional[str] = None):
+        """Drop cached responses about file_id, and the quota, which every write may change"""
+        if self._responses is not None:
+            for key in self._cached_keys.pop(file_id, set()) | self._cached_keys.pop(None, set()):
+                self._responses.pop(key, None)
+
     ################################################################################
     # Raw API calls                                                                #
     ################################################################################
     async def get_about(self, *fields: str) -> dict:
-        req = self.about.get(fields=",".join(fields or ["storageQuota"]))
-        resp = await self.batcher.queue_request(req, execute_now=True)
-        return resp
+        mask = ",".join(fields or ["storageQuota"])
+
+        async def make_request():
+            req = self.about.get(fields=mask)
+            return await self.batcher.queue_request(req, execute_now=True)
+
+        return await self._coalesced(("about.get", None, mask), make_request)
 
     async def clone_and_patch(self, file_id: str, **kwargs):
+        self._invalidate()
         req = self.files.copy(**{"fileId": file_id}, body=kwargs)
         cloned = await self.batcher.queue_request(req)
         return cloned
 
     async def get_file(self, file_id: str, fields: Optional[Set[str]] = None):
-        req = self.files.get(fileId=file_id, fields=",".join(DEFAULT_FIELDS.union(fields or set())))
-        resp = await self.batcher.queue_request(req)
-        return resp
+        mask = fields_mask(fields)
+
+        async def make_request():
+            req = self.files.get(fileId=file_id, fields=mask)
+            return await self.batcher.queue_request(req)
+
+        return await self._coalesced(("files.get", file_id, mask), make_request)
 
     async def delete_file(self, file_id: str):
+        self._invalidate(file_id)
         req = self.files.delete(fileId=file_id)
         resp = await self.batcher.queue_request(req)
         return resp
 
     async def update(self, fileId: str, **kwargs):
+        self._invalidate(fileId)
         req = self.files.update(fileId=fileId, **kwargs)
         resp = await self.batcher.queue_request(req)
         return resp
 
     async def create(self, **kwargs):
+        self._invalidate()
         req = self.files.create(body=kwargs)
         resp = await self.batcher.queue_request(req)
         return resp
 
+    async def download(self, file_id: str, start: Optional[int] = None, end: Optional[int] = None) -> Optional[bytes]:
+        """Content of a file, or only bytes start to end of it, both included"""
+        req = self.files.get_media(fileId=file_id)
+        if start is not None:
+            req.headers["range"] = f"bytes={start}-{end}"
+        return await self.batcher.execute_alone(req)
+
+    async def export(self, file_id: str, mime_type: str) -> Optional[bytes]:
+        """Content of a Google Docs file, converted to mime_type"""
+        req = self.files.export_media(fileId=file_id, mimeType=mime_type)
+        return await self.batcher.execute_alone(req)
+
+    def new_upload(
+        self,
+        path: str,
+        chunk_size: int,
+        file_id: Optional[str] = None,
+        resumable_uri: Optional[str] = None,
+        fields: Optional[Set[str]] = None,
+        **kwargs,
+    ):
+        """Resumable upload of the content of path to a new file with metadata kwargs, or to file_id
+
+        Sent chunk by chunk with upload_chunk. With the resumable_uri of an earlier upload of
+        the same content, it goes on from what that session already has.
+        """
+        media = MediaFileUpload(path, chunksize=chunk_size, resumable=True)
+        self._invalidate(file_id)
+        if file_id is None:
+            req = self.files.create(body=kwargs, media_body=media, fields=fields_mask(fields))
+        else:
+            req = self.files.update(fileId=file_id, body=kwargs, media_body=media, fields=fields_mask(fields))
+        if resumable_uri:
+            # makes the first chunk ask the session how far it got
+            req.resumable_uri = resumable_uri
+            req._in_error_state = True
+        return req
+
+    async def upload_chunk(self, req) -> Optional[Tuple[Any, Optional[dict]]]:
+        """Send the next chunk of an upload: (progress, None) until the last one, then (None, file)"""
+        return await self.batcher.execute_alone(req, req.next_chunk)
+
+    async def get_start_page_token(self) -> str:
+        req = self.changes.getStartPageToken()
+        resp = await self.batcher.queue_request(req, execute_now=True)
+        return resp["startPageToken"]
+
+    async def fetch_changes(self, page_token: str, fields: Optional[Set[str]] = None) -> Tuple[List[Dict], str]:
+        """Fetch all changes since page_token, and the token to fetch the next ones with"""
+        changes: List[Dict] = []
+        while True:
+            req = self.changes.list(
+                pageToken=page_token,
+                pageSize=1000,
+                includeRemoved=True,
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True,
+                fields=f"changes(fileId,removed,file({fields_mask(fields)})),nextPageToken,newStartPageToken",
+            )
+            resp = await self.batcher.queue_request(req, execute_now=True)
+            if resp is None:
+                # already logged; pick up from this page next time
+                return changes, page_token
+            changes.extend(resp.get("changes", []))
+            if "newStartPageToken" in resp:
+                return changes, resp["newStartPageToken"]
+            page_token = resp["nextPageToken"]
+
     async def fetch_file_info_one_page(
         self,
         page_token: Optional[str] = None,
@@ -91,7 +291,7 @@ class GoogleDriveApiWrapper:
     ) -> Dict[str, Any]:
         kwargs = {
             "pageSize": 1000,
-            "fields": f"files({','.join(DEFAULT_FIELDS.union(fields or set()))}), nextPageToken",
+            "fields": f"files({fields_mask(fields)}), nextPageToken",
         }
         if page_token:
             kwargs["pageToken"] = page_token
@@ -156,16 +356,19 @@ class GoogleDriveApiWrapper:
 
         return moved
 
-    async def create_shortcut(self, target_id, destination_id):
+    async def create_shortcut(self, target_id, destination_id, name: Optional[str] = None):
         shortcut_metadata = {
             "mimeType": SHORTCUT_TYPE,
             "shortcutDetails": {"targetId": target_id},
         }
         if destination_id:
             shortcut_metadata["parents"] = [destination_id]
-        return await self.create(body=shortcut_metadata)
+        if name:
+            shortcut_metadata["name"] = name
+        return await self.create(**shortcut_metadata)
 
     async def get_files(self, *file_ids: str, fields=None):
-        tasks = asyncio.as_completed([self.get_file(file_id, fields=fields) for file_id in file_ids])
+        # dict keeps order while dropping repeated ids
+        tasks = asyncio.as_completed([self.get_file(file_id, fields=fields) for file_id in dict.fromkeys(file_ids)])
         for res in tasks:
             yield await res
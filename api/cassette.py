@@ -0,0 +1,216 @@
+import atexit
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+import urllib.parse
+from collections import defaultdict, deque
+from typing import Deque, Dict, Optional, Tuple
+
+import httplib2
+from api.multipart import build_batch_response, parse_batch_request, parse_batch_response
+from consts import logger
+
+ANONYMIZED_KEYS = {"name", "displayName", "emailAddress"}
+ANONYMIZED_PREFIX = "anon-"
+# e-mail addresses in search queries, like "'x@y' in owners"
+EMAIL = re.compile(r"[\w.%+-]+@[\w-]+(?:\.[\w-]+)+")
+
+
+def anonymize(value: str) -> str:
+    # idempotent, so names that come back from a replayed response still match their keys
+    if value.startswith(ANONYMIZED_PREFIX):
+        return value
+    return ANONYMIZED_PREFIX + hashlib.sha1(value.encode()).hexdigest()[:12]
+
+
+def anonymize_json(obj):
+    if isinstance(obj, dict):
+        return {k: anonymize(v) if k in ANONYMIZED_KEYS and isinstance(v, str) else anonymize_json(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [anonymize_json(x) for x in obj]
+    return obj
+
+
+def anonymize_query(q: str) -> str:
+    return EMAIL.sub(lambda x: anonymize(x.group()), q)
+
+
+def is_anonymized(path: str) -> bool:
+    with gzip.open(path, "rt") as f:
+        return json.loads(f.readline())["anonymized"]
+
+
+def is_api_uri(uri: str) -> bool:
+    # everything else, like the OAuth token endpoint and file contents both ways, is neither
+    # recorded nor replayed
+    parsed = urllib.parse.urlparse(uri)
+    return "/drive/v3" in parsed.path and not parsed.path.startswith("/upload/") and "alt=media" not in parsed.query
+
+
+class Cassette:
+    """Request/response pairs of Drive API traffic, stored as gzipped JSON lines
+
+    Batches are stored as their individual parts, so a replay can serve them regardless of
+    how the requests get grouped into batches the next time.
+    """
+
+    def __init__(self, path: str, mode: str = "r", anonymized: bool = False) -> None:
+        self.path = path
+        self.anonymized = anonymized
+        self.entries: Dict[str, Deque[dict]] = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._file = None
+
+        if mode == "w":
+            self._file = gzip.open(path, "wt")
+            self._file.write(json.dumps({"version": 1, "anonymized": anonymized}) + "\n")
+            atexit.register(self.close)
+        else:
+            with gzip.open(path, "rt") as f:
+                self.anonymized = json.loads(f.readline())["anonymized"]
+                for line in f:
+                    entry = json.loads(line)
+                    self.entries[entry["key"]].append(entry)
+            logger.info(f"Loaded {sum(len(x) for x in self.entries.values())} recorded requests from {path}")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def key(self, method: str, uri: str, body: Optional[str]) -> str:
+        parsed = urllib.parse.urlparse(uri)
+        query = sorted(urllib.parse.parse_qsl(parsed.query))
+        if self.anonymized:
+            query = [(k, anonymize_query(v) if k == "q" else v) for k, v in query]
+        # the path of batched parts is relative, so only compare the api path
+        path = parsed.path[parsed.path.index("/drive/v3") :]
+
+        content = (body or "").strip()
+        if content:
+            try:
+                loaded = json.loads(content)
+                content = json.dumps(anonymize_json(loaded) if self.anonymized else loaded, sort_keys=True)
+            except ValueError:
+                pass
+        return f"{method} {path}?{urllib.parse.urlencode(query)} {content}"
+
+    def record(self, method: str, uri: str, body: Optional[str], status: int, content: str, elapsed: float, batch_size: int):
+        if self.anonymized and content.strip():
+            try:
+                content = json.dumps(anonymize_json(json.loads(content)))
+            except ValueError:
+                pass
+
+        entry = {
+            "key": self.key(method, uri, body),
+            "status": status,
+            "content": content,
+            "elapsed": round(elapsed, 6),
+            "batch_size": batch_size,
+        }
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(entry) + "\n")
+
+    def play(self, method: str, uri: str, body: Optional[str]) -> Optional[dict]:
+        # repeated requests get their responses in recorded order, the last one repeats
+        with self._lock:
+            entries = self.entries.get(self.key(method, uri, body))
+            if not entries:
+                return None
+            return entries.popleft() if len(entries) > 1 else entries[0]
+
+
+def _decode(body) -> Optional[str]:
+    return body.decode() if isinstance(body, bytes) else body
+
+
+class RecordingHttp(httplib2.Http):
+    """Http that records every Drive API exchange into a cassette"""
+
+    def __init__(self, cassette: Cassette, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.cassette = cassette
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):  # type: ignore
+        start = time.perf_counter()
+        resp, content = super().request(uri, method, body, headers, *args, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        if not is_api_uri(uri):
+            return resp, content
+
+        content_type = (headers or {}).get("content-type", "")
+        if content_type.startswith("multipart/mixed") and resp.status < 300:
+            requests = parse_batch_request(content_type, body.encode() if isinstance(body, str) else body)
+            responses = {x[0]: x for x in parse_batch_response(resp["content-type"], content)}
+            for content_id, part_method, path, _, part_body in requests:
+                if content_id in responses:
+                    _, status, _, part_content = responses[content_id]
+                    self.cassette.record(part_method, path, part_body, status, part_content, elapsed, len(requests))
+        else:
+            self.cassette.record(method, uri, _decode(body), resp.status, content.decode(), elapsed, 1)
+
+        return resp, content
+
+
+class ReplayHttp(httplib2.Http):
+    """Http that serves Drive API exchanges from a cassette instead of the network
+
+    Recorded latencies are slept for, multiplied by speed, so 0 replays as fast as possible.
+    A batch takes as long as its slowest recorded part. Use it with anonymous credentials,
+    since googleapiclient refreshes tokens outside of the transport.
+    """
+
+    def __init__(self, cassette: Cassette, speed: float = 1.0, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.cassette = cassette
+        self.speed = speed
+
+    def _play(self, method, uri, body) -> Tuple[int, bytes, float]:
+        entry = self.cassette.play(method, uri, body)
+        if entry is None:
+            logger.warning(f"Request not in cassette: {method} {uri}")
+            error = {"error": {"code": 404, "message": "Request not in cassette."}}
+            return 404, json.dumps(error).encode(), 0
+        return entry["status"], entry["content"].encode(), entry["elapsed"]
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):  # type: ignore
+        if not is_api_uri(uri):
+            error = {"error": {"code": 404, "message": "Only Drive API requests can be replayed."}}
+            return httplib2.Response({"status": 404, "content-type": "application/json"}), json.dumps(error).encode()
+
+        content_type = (headers or {}).get("content-type", "")
+        if content_type.startswith("multipart/mixed"):
+            requests = parse_batch_request(content_type, body.encode() if isinstance(body, str) else body)
+            parts = []
+            elapsed = 0.0
+            for content_id, part_method, path, _, part_body in requests:
+                status, content, part_elapsed = self._play(part_method, path, part_body)
+                parts.append((content_id, status, content))
+                elapsed = max(elapsed, part_elapsed)
+            response_type, content = build_batch_response(parts)
+            status = 200
+        else:
+            status, content, elapsed = self._play(method, uri, _decode(body))
+            response_type = "application/json; charset=UTF-8"
+
+        if self.speed:
+            time.sleep(elapsed * self.speed)
+        return httplib2.Response({"status": status, "content-type": response_type}), content
+
+
+def make_transport(record: Optional[str] = None, replay: Optional[str] = None, anonymize: bool = False, speed: float = 1.0):
+    """Return a factory for Http objects that record to or replay from a cassette, if asked to"""
+    if record:
+        cassette = Cassette(record, "w", anonymized=anonymize)
+        return lambda: RecordingHttp(cassette)
+    if replay:
+        cassette = Cassette(replay)
+        return lambda: ReplayHttp(cassette, speed)
+    return None
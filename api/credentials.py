@@ -0,0 +1,42 @@
+import json
+from typing import Callable, Dict, Iterator, Mapping, Optional
+
+from consts import SCOPES
+
+
+class ServiceAccounts(Mapping):
+    """Service account credentials by email, loaded from their secret files on first access
+
+    Only the email is read up front. Parsing the private key, and importing what parses it,
+    is left until an account is actually used, which for most runs is just one of them.
+    """
+
+    def __init__(self, rename: Optional[Callable[[str], str]] = None) -> None:
+        self.secrets: Dict[str, str] = {}
+        # applied to every email, e.g. to match the owners in an anonymized cassette
+        self.rename = rename
+        self._credentials: Dict[str, object] = {}
+
+    def add(self, secret: str) -> str:
+        with open(secret, "r") as f:
+            email = json.load(f)["client_email"]
+        if self.rename is not None:
+            email = self.rename(email)
+        self.secrets[email] = secret
+        return email
+
+    def __getitem__(self, email: str):
+        if email not in self._credentials:
+            from google.oauth2.service_account import Credentials
+
+            self._credentials[email] = Credentials.from_service_account_file(self.secrets[email], scopes=SCOPES)
+        return self._credentials[email]
+
+    def __contains__(self, email) -> bool:
+        return email in self.secrets
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.secrets)
+
+    def __len__(self) -> int:
+        return len(self.secrets)
@@ -0,0 +1,69 @@
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Optional
+
+from consts import logger
+
+
+class AuditLog:
+    """JSON lines file of events, written by a thread of its own so the event loop never waits on disk"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write, name="audit-log", daemon=True)
+        self._thread.start()
+
+    def put(self, event: dict):
+        self._queue.put(event)
+
+    def _write(self):
+        # appended to, so the log of one destination can span runs
+        with open(self.path, "a") as f:
+            while True:
+                event = self._queue.get()
+                if event is None:
+                    return
+                f.write(json.dumps(event, separators=(",", ":")) + "\n")
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+class EventStream:
+    """Per-item events of a run, like copied or deleted files, formatted only where they go
+
+    The sinks are TRACE logging and the audit log. With neither on, emitting an event is a
+    level check, and nothing is formatted and no path is built. Paths are built on the event
+    loop, which owns the cache. Serializing and writing happen on the audit log's thread.
+    """
+
+    def __init__(self) -> None:
+        self.audit: Optional[AuditLog] = None
+
+    def start(self, path: str):
+        self.audit = AuditLog(path)
+
+    def stop(self):
+        if self.audit is not None:
+            self.audit.close()
+            self.audit = None
+
+    def emit(self, event: str, file_id: str, cache=None, **fields):
+        trace = logger.isEnabledFor(logging.TRACE)  # type: ignore
+        if not trace and self.audit is None:
+            return
+
+        path = cache.build_path(file_id) if cache is not None else None
+        if trace:
+            details = " ".join(f"{k}={v}" for k, v in fields.items())
+            logger.trace(f"{event} {str(path).ljust(120)} {file_id.ljust(40)} {details}")  # type: ignore
+        if self.audit is not None:
+            self.audit.put({"time": time.time(), "event": event, "id": file_id, "path": path, **fields})
+
+
+EVENTS = EventStream()
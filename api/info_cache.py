@@ -1,11 +1,19 @@
 import asyncio
+import re
 from collections import defaultdict
-from functools import reduce
-from typing import Dict, Optional
+from typing import Dict, FrozenSet, List, Optional
 
 from api.api_wrapper import GoogleDriveApiWrapper
+from api.search_index import SearchIndex
 from consts import FOLDER_TYPE, IGNORE_LIST, logger, SHORTCUT_TYPE
 
+PARENT_QUERY = re.compile(r"^'([^']+)' in parents$")
+
+
+def covers(have: FrozenSet[str], fields) -> bool:
+    # a whole object covers its subfields, e.g. "owners" covers "owners/me"
+    return all(x in have or x.partition("/")[0] in have for x in fields or ())
+
 
 class InfoCache:
     def __init__(self, api: GoogleDriveApiWrapper):
@@ -14,6 +22,60 @@ class InfoCache:
 
         self._folder_sizes_cache = {}
         self._paths_cache = {}
+        self._children: Optional[Dict[str, List[str]]] = None
+        self._search_index: Optional[SearchIndex] = None
+
+        # set while a changes feed keeps the cache current (see apply_changes); folder
+        # listings made meanwhile are then answered from the cache, if they had the fields
+        self.synced = False
+        self.listed: Dict[str, FrozenSet[str]] = {}
+
+        # fields each entry was fetched with, beyond BASE_FIELDS; entries share the frozensets
+        self.fields: Dict[str, FrozenSet[str]] = {}
+        self._field_sets: Dict[FrozenSet[str], FrozenSet[str]] = {}
+
+    @property
+    def search_index(self) -> SearchIndex:
+        # built on first use, then kept up to date by the fetch methods
+        if self._search_index is None:
+            self._search_index = SearchIndex(self)
+        return self._search_index
+
+    @property
+    def children_index(self) -> Dict[str, List[str]]:
+        # parent id -> child ids, in file_info order; rebuilt lazily after every update
+        if self._children is None:
+            self._children = defaultdict(list)
+            for file_id, file in self.file_info.items():
+                self._children[file.get("parent")].append(file_id)
+        return self._children
+
+    def _updated(self, file_ids):
+        self._children = None
+        self._folder_sizes_cache.clear()
+        self._paths_cache.clear()
+        if self._search_index is not None:
+            self._search_index.update(file_ids)
+
+    def _track(self, file_ids, fields, replace=False):
+        fetched = frozenset(fields or ())
+        fetched = self._field_sets.setdefault(fetched, fetched)
+        # objects fetched in part replace the cached ones, dropping their other subfields
+        partial = {x.partition("/")[0] for x in fetched if "/" in x}
+        for file_id in file_ids:
+            have = None if replace else self.fields.get(file_id)
+            if have is None:
+                self.fields[file_id] = fetched
+            elif partial or not have.issuperset(fetched):
+                have = frozenset(x for x in have if x.partition("/")[0] not in partial) | fetched
+                self.fields[file_id] = self._field_sets.setdefault(have, have)
+
+    def has_fields(self, file_id: str, fields) -> bool:
+        return file_id in self.fields and covers(self.fields[file_id], fields)
+
+    def set_parent(self, file_id: str, parent_id: str):
+        self.file_info[file_id]["parent"] = parent_id
+        self._updated([file_id])
 
     def is_ignored(self, name: str) -> Optional[str]:
         if name in IGNORE_LIST:
@@ -24,39 +86,157 @@ class InfoCache:
         self.file_info.clear()
         self._folder_sizes_cache.clear()
         self._paths_cache.clear()
+        self._children = None
+        self._search_index = None
+        self.listed.clear()
+        self.fields.clear()
+
+    def remove(self, *file_ids: str):
+        """Drop files and everything cached below them, e.g. once they were deleted"""
+        # a file passed in along with one of its folders is below that folder too
+        gone = list(
+            dict.fromkeys(x for file_id in file_ids if file_id in self.file_info for x in self.iter_post_order(file_id))
+        )
+        for file_id in gone:
+            self.file_info.pop(file_id, None)
+            self.listed.pop(file_id, None)
+            self.fields.pop(file_id, None)
+        self._updated(gone)
+        # the search index only knows how to add files
+        self._search_index = None
+
+    def apply_changes(self, changes: List[Dict], fields=None):
+        """Apply entries of the Drive changes feed, fetched with fields
 
-    def _memoize(self, func, cache, *args):
-        key = tuple(args)
-        if key not in cache:
-            cache[key] = func(*args)
-        return cache[key]
+        Cached files are updated, and new ones are added if their parent is cached, so
+        listings stay complete. Removed files go along with everything below them. Other
+        fields of updated files may be stale now, so they count as missing.
+        """
+        updated = []
+        for change in changes:
+            if change.get("removed"):
+                self.remove(change["fileId"])
+                continue
+            file = change.get("file")
+            if not file:
+                continue
+            file_id, info = self.parse_files(file).popitem()
+            if file_id in self.file_info or info.get("parent") in self.file_info:
+                self.file_info[file_id].update(info)
+                updated.append(file_id)
+        self._track(updated, fields, replace=True)
+        self._updated(updated)
 
     ################################################################################
     # Queries                                                                      #
     ################################################################################
-    def get_folder_children(self, folder_id: str, filter_ignored=False):
-        info = self.file_info[folder_id]
+    def _resolve_shortcut(self, file_id: str) -> str:
+        info = self.file_info.get(file_id, {})
         if info.get("mimeType") == SHORTCUT_TYPE:
-            folder_id = info["shortcutDetails"]["targetId"]
+            return info["shortcutDetails"]["targetId"]
+        return file_id
 
-        for file_id, file in self.file_info.items():
+    def get_folder_children(self, folder_id: str, filter_ignored=False):
+        folder_id = self._resolve_shortcut(folder_id)
+
+        for file_id in self.children_index.get(folder_id, ()):
+            file = self.file_info[file_id]
             if filter_ignored and self.is_ignored(file.get("name")):
                 continue
-            if file.get("parent") == folder_id:
-                yield file_id, file
+            yield file_id, file
 
     def get_files_in_hierarchy(self, folder_id: str, filter_ignored: bool = True):
-        for file_id, file in self.file_info.items():
-            if filter_ignored and self.is_ignored(file.get("name")):
-                continue
-            if file.get("parent") == folder_id:
+        # iterative pre-order; every folder is descended into once, so shortcut cycles terminate
+        visited = {folder_id}
+        stack = [self.get_folder_children(folder_id, filter_ignored=filter_ignored)]
+        while stack:
+            for file_id, file in stack[-1]:
                 yield file_id, file
                 if file.get("mimeType") == FOLDER_TYPE:
-                    yield from self.get_files_in_hierarchy(file_id)
+                    target_id = file_id
                 elif file.get("mimeType") == SHORTCUT_TYPE:
-                    yield from self.get_files_in_hierarchy(
-                        file["shortcutDetails"]["targetId"]
-                    )
+                    target_id = file["shortcutDetails"]["targetId"]
+                else:
+                    continue
+
+                if target_id not in visited:
+                    visited.add(target_id)
+                    stack.append(self.get_folder_children(target_id, filter_ignored=filter_ignored))
+                    break
+            else:
+                stack.pop()
+
+    def iter_post_order(self, folder_id: str, follow_shortcuts: bool = False, filter_ignored: bool = False):
+        """Yield ids of folder_id and all its descendants, children before their parents
+
+        Iterative, so deep trees don't hit the recursion limit, and every id is yielded at
+        most once, so shortcut cycles terminate.
+        """
+        children = self.children_index
+
+        def children_of(file_id):
+            if follow_shortcuts:
+                file_id = self._resolve_shortcut(file_id)
+            return iter(children.get(file_id, ()))
+
+        visited = {folder_id}
+        stack = [(folder_id, children_of(folder_id))]
+        while stack:
+            node, it = stack[-1]
+            for child in it:
+                if child in visited:
+                    continue
+                if filter_ignored and self.is_ignored(self.file_info[child].get("name")):
+                    continue
+                visited.add(child)
+                stack.append((child, children_of(child)))
+                break
+            else:
+                stack.pop()
+                yield node
+
+    def get_usage(self, folder_id: str):
+        """Compute bytes and item counts below folder_id in one post-order pass
+
+        Returns three dicts of [bytes, items]: one per folder in the hierarchy (including
+        folder_id), one per mimeType and one per owner email. Shortcuts are counted as
+        items, but their targets are not followed.
+        """
+        per_folder = defaultdict(lambda: [0, 0])
+        per_type = defaultdict(lambda: [0, 0])
+        per_owner = defaultdict(lambda: [0, 0])
+        file_info = self.file_info
+
+        for file_id in self.iter_post_order(folder_id):
+            file = file_info[file_id]
+            mime_type = file.get("mimeType")
+            owners = file.get("owners")
+            owner = per_owner[owners[0].get("emailAddress") if owners else None]
+
+            if mime_type == FOLDER_TYPE:
+                size, items = per_folder[file_id]
+            else:
+                size, items = int(file.get("size", 0)), 0
+                per_type[mime_type][0] += size
+                owner[0] += size
+            per_type[mime_type][1] += 1
+            owner[1] += 1
+
+            if file_id != folder_id:
+                parent = per_folder[file["parent"]]
+                parent[0] += size
+                parent[1] += items + 1
+
+        return dict(per_folder), dict(per_type), dict(per_owner)
+
+    def ancestor_in(self, file_id: str, file_ids) -> Optional[str]:
+        """The nearest ancestor of file_id that is in the set file_ids, if any"""
+        ancestor = self.file_info.get(file_id, {}).get("parent")
+        seen = set()
+        while ancestor is not None and ancestor not in file_ids and ancestor not in seen:
+            seen.add(ancestor)
+            ancestor = self.file_info.get(ancestor, {}).get("parent")
+        return ancestor if ancestor in file_ids else None
 
     def is_owned_by_me(self, file_id):
         return any(x["me"] for x in self.file_info.get(file_id, {}).get("owners", []))
@@ -69,15 +249,70 @@ class InfoCache:
             ):
                 yield file_id, file
 
+    def get_duplicates(self, folder_id: str, min_size: int = 1):
+        """Find files below folder_id with identical content
+
+        Files are grouped by size first, so only size collisions need their checksums
+        compared. Returns (size, md5Checksum, file_ids) tuples, one per group of two or more.
+        """
+        by_size = defaultdict(list)
+        for file_id in self.iter_post_order(folder_id):
+            file = self.file_info[file_id]
+            if file.get("mimeType") in [FOLDER_TYPE, SHORTCUT_TYPE] or "md5Checksum" not in file:
+                continue
+            size = int(file.get("size", 0))
+            if size >= min_size:
+                by_size[size].append(file_id)
+
+        groups = []
+        for size, file_ids in by_size.items():
+            if len(file_ids) < 2:
+                continue
+            by_checksum = defaultdict(list)
+            for file_id in file_ids:
+                by_checksum[self.file_info[file_id]["md5Checksum"]].append(file_id)
+            groups.extend((size, md5, ids) for md5, ids in by_checksum.items() if len(ids) > 1)
+        return groups
+
     def get_folder_size(self, folder_id: str):
-        return self._memoize(self._get_folder_size, self._folder_sizes_cache, folder_id)
+        if folder_id not in self._folder_sizes_cache:
+            self._compute_folder_sizes(folder_id)
+        return self._folder_sizes_cache[folder_id]
 
-    def _get_folder_size(self, folder_id: str):
-        return reduce(
-            lambda x, y: x + int(self.get_file_size(y[0])),
-            self.get_folder_children(folder_id),
-            0,
-        )
+    def _is_folder(self, file_id: str):
+        return self.file_info.get(file_id, {}).get("mimeType") == FOLDER_TYPE
+
+    def _is_container(self, file_id: str):
+        return self.file_info.get(file_id, {}).get("mimeType") in [FOLDER_TYPE, SHORTCUT_TYPE]
+
+    def _compute_folder_sizes(self, folder_id: str):
+        # iterative post-order over folders; a folder is summed once all of its folder children
+        # are, and folders already on the path (cycles) count as 0. Shortcuts inside are copied
+        # and deleted as shortcuts, so what they point to isn't counted
+        sizes = self._folder_sizes_cache
+        children = self.children_index
+        on_path = set()
+        stack = [folder_id]
+        while stack:
+            node = stack[-1]
+            if node in sizes:
+                stack.pop()
+                continue
+
+            kids = children.get(self._resolve_shortcut(node), ())
+            if node not in on_path:
+                on_path.add(node)
+                pending = [x for x in kids if self._is_folder(x) and x not in sizes and x not in on_path]
+                if pending:
+                    stack.extend(pending)
+                    continue
+
+            sizes[node] = sum(
+                sizes.get(x, 0) if self._is_folder(x) else int(self.file_info[x].get("size", 0))
+                for x in kids
+            )
+            on_path.discard(node)
+            stack.pop()
 
     def get_num_folders(self, folder_id: str, filter_ignored=True):
         return sum(
@@ -89,21 +324,29 @@ class InfoCache:
         )
 
     def build_path(self, file_id: str, stop_at: Optional[str] = None):
-        return self._memoize(self._build_path, self._paths_cache, file_id, stop_at)
-
-    def _build_path(self, file_id: str, stop_at: Optional[str] = None):
-        info = self.file_info[file_id]
-        path = info["name"]
-        parent_id = info.get("parent")
-        while parent_id in self.file_info and parent_id != stop_at:
-            info = self.file_info[parent_id]
-            path = info["name"] + "/" + path
-            parent_id = info.get("parent")
-        return "/" + path
+        # walk up to the nearest ancestor with a known path, then memoize the paths on the way down
+        chain = []
+        path = ""
+        current = file_id
+        while current is not None:
+            cached = self._paths_cache.get((current, stop_at))
+            if cached is not None:
+                path = cached
+                break
+            chain.append(current)
+            parent_id = self.file_info[current].get("parent")
+            current = parent_id if parent_id in self.file_info and parent_id != stop_at else None
+
+        for fid in reversed(chain):
+            path = path + "/" + self.file_info[fid]["name"]
+            # only folders are ever ancestors, so paths of files would just take up memory
+            if fid != file_id or self._is_container(fid):
+                self._paths_cache[(fid, stop_at)] = path
+        return path
 
     def get_file_size(self, file_id: str):
         file = self.file_info[file_id]
-        if file.get("mimeType") in [FOLDER_TYPE, SHORTCUT_TYPE]:
+        if file.get("mimeType") == FOLDER_TYPE:
             return self.get_folder_size(file_id)
         else:
             return self.file_info[file_id].get("size", 0)
@@ -112,15 +355,31 @@ class InfoCache:
     # Fetching                                                                     #
     ################################################################################
     async def fetch_files(self, *file_ids: str, fields=None):
+        """Fetch file_ids, returning those that came back by their ids
+
+        Files that couldn't be fetched, like shortcut targets gone or out of reach, get no
+        entry, so they're asked for again next time.
+        """
+        fetched = {}
         async for file in self.api.get_files(*file_ids, fields=fields):
+            if file is None:
+                # unrecoverable error, already logged by the batcher
+                continue
             parsed = self.parse_files(file)
             k, v = parsed.popitem()
             self.file_info[k].update(v)
-            # self.file_info[file_ids].update(v)
+            self._track([k], fields)
+            self._updated([k])
+            fetched[k] = self.file_info[k]
         logger.debug(f"Fetched file info for id='{file_ids}'")
-        return {x: self.file_info[x] for x in file_ids}
+        return fetched
 
     async def fetch(self, query=None, shared=True, fields=None, batch=False):
+        match = PARENT_QUERY.match(query or "") if shared else None
+        folder_id = match.group(1) if match else None
+        if folder_id in self.listed and covers(self.listed[folder_id], fields):
+            return {x: self.file_info[x] for x in self.children_index.get(folder_id, ())}
+
         if not batch:
             logger.debug(
                 f"Fetching file info from GDrive with query = [{query}] and shared = {shared} and fields = {fields}"
@@ -129,24 +388,83 @@ class InfoCache:
             query, shared, fields=fields, batch=batch
         )
         new = self.parse_files(*files)
-        self.file_info.update(new)
+        # merge, so fields fetched earlier by another listing aren't lost
+        for file_id, info in new.items():
+            self.file_info[file_id].update(info)
+        self._track(new, fields)
+        self._updated(new)
+        if folder_id and self.synced:
+            self.listed[folder_id] = frozenset(fields or ())
         if not batch:
             logger.debug(f"Fetched and parsed {len(new)} files.")
-        return new
+        return {x: self.file_info[x] for x in new}
+
+    async def ensure_fields(self, file_ids, fields):
+        """Fetch fields for those of file_ids that were fetched without them"""
+        missing = defaultdict(list)
+        for file_id in file_ids:
+            if not self.has_fields(file_id, fields):
+                missing[self.fields.get(file_id, frozenset())].append(file_id)
+        # along with what they have, so partly fetched objects like owners stay complete
+        for have, ids in missing.items():
+            logger.debug(f"Fetching {set(fields)} for {len(ids)} files")
+            await self.fetch_files(*ids, fields=have | set(fields))
 
-    async def fetch_folder_and_descendants(self, folder_id: str, fields=None):
-        logger.debug(f"Fetching folder and descendants for id='{folder_id}'")
-        new = await self.fetch_files(folder_id, fields=fields)
-        await self.fetch_descendants(folder_id, fields=fields)
+    async def fetch_folder_and_descendants(self, *folder_ids: str, fields=None, follow_shortcuts=True):
+        """Fetch the folders and everything below them, concurrently
+
+        The folders share one visited set, so subtrees they have in common, nested in
+        another of them or reached through shortcuts, are listed once.
+        """
+        logger.debug(f"Fetching folder and descendants for id='{folder_ids}'")
+        await self.fetch_files(*folder_ids, fields=fields)
+        visited = set(folder_ids)
+        await asyncio.gather(
+            *(
+                self.fetch_descendants(x, fields=fields, follow_shortcuts=follow_shortcuts, _visited=visited)
+                for x in folder_ids
+            )
+        )
+
+    async def fetch_descendants(self, folder_id: str, fields=None, follow_shortcuts=True, _visited=None):
+        """Fetch everything below folder_id, folder by folder
+
+        Shortcut targets found while listing are fetched with one batched get per distinct
+        target, and folders among them are descended into as well. Each folder and target
+        is claimed in a visited set before awaiting, so concurrent branches never duplicate
+        work and shortcut cycles terminate.
+        """
+        visited = {folder_id} if _visited is None else _visited
 
-    async def fetch_descendants(self, folder_id: str, fields=None):
         new = await self.fetch(f"'{folder_id}' in parents", fields=fields, batch=True)
-        tasks = []
+        folders = []
+        targets = []
         for file_id, file in new.items():
             if file.get("mimeType") == FOLDER_TYPE and not self.is_ignored(
                 file.get("name")
             ):
-                tasks.append(self.fetch_descendants(file_id, fields=fields))
+                if file_id not in visited:
+                    visited.add(file_id)
+                    folders.append(file_id)
+            elif follow_shortcuts and file.get("mimeType") == SHORTCUT_TYPE:
+                target_id = file.get("shortcutDetails", {}).get("targetId")
+                if target_id and target_id not in visited:
+                    visited.add(target_id)
+                    targets.append(target_id)
+
+        if targets:
+            unresolved = [x for x in targets if x not in self.file_info]
+            if unresolved:
+                await self.fetch_files(*unresolved, fields=fields)
+            for target_id in targets:
+                target = self.file_info.get(target_id, {})
+                if target.get("mimeType") == FOLDER_TYPE and not self.is_ignored(target.get("name")):
+                    folders.append(target_id)
+
+        tasks = [
+            self.fetch_descendants(x, fields=fields, follow_shortcuts=follow_shortcuts, _visited=visited)
+            for x in folders
+        ]
         await asyncio.gather(*tasks)
 
     def parse_files(self, *files: Dict) -> Dict[str, Dict]:
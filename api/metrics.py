@@ -0,0 +1,156 @@
+import bisect
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, Iterable, Optional, Tuple
+
+# seconds; covers a fast single get up to a batch stuck behind a slow backend
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th quantile, inf if it's past the last bucket"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "buckets": {str(b): c for b, c in zip(self.buckets + (float("inf"),), self.counts)},
+            "sum": self.sum,
+            "count": self.count,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Dict[str, str]] = None) -> str:
+    pairs = list(labels) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class MetricsRegistry:
+    """Counters, gauges and histograms of a run, safe to update from the executor threads
+
+    Batch callbacks run in the executor, so everything is guarded by one lock.
+    """
+
+    def __init__(self, max_samples: int = 10_000) -> None:
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+        self.counters: Dict[str, Dict[Labels, float]] = defaultdict(lambda: defaultdict(float))
+        self.gauges: Dict[str, Dict[Labels, float]] = defaultdict(dict)
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = defaultdict(dict)
+        # (seconds since start, value) of gauges that are worth seeing over time
+        self.samples: Dict[str, Deque[Tuple[float, float]]] = defaultdict(lambda: deque(maxlen=max_samples))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self.counters[name][_labels(labels)] += value
+
+    def set(self, name: str, value: float, sample: bool = False, **labels):
+        with self._lock:
+            self.gauges[name][_labels(labels)] = value
+            if sample:
+                self.samples[name].append((round(time.time() - self.start_time, 3), value))
+
+    def observe(self, name: str, value: float, buckets: Iterable[float] = LATENCY_BUCKETS, **labels):
+        with self._lock:
+            key = _labels(labels)
+            if key not in self.histograms[name]:
+                self.histograms[name][key] = Histogram(buckets)
+            self.histograms[name][key].observe(value)
+
+    def histogram(self, name: str, **labels) -> Optional[Histogram]:
+        with self._lock:
+            return self.histograms.get(name, {}).get(_labels(labels))
+
+    def get(self, name: str, **labels) -> float:
+        with self._lock:
+            return self.counters.get(name, {}).get(_labels(labels), 0)
+
+    def reset(self):
+        with self._lock:
+            self.start_time = time.time()
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+            self.samples.clear()
+
+    def _process_gauges(self):
+        # with the wall time, tells whether a run was waiting on the api or on the cpu
+        self.gauges["gdrive_process_cpu_seconds"][()] = time.process_time()
+        self.gauges["gdrive_wall_seconds"][()] = time.time() - self.start_time
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._process_gauges()
+            return {
+                "counters": {n: [{"labels": dict(k), "value": v} for k, v in s.items()] for n, s in self.counters.items()},
+                "gauges": {n: [{"labels": dict(k), "value": v} for k, v in s.items()] for n, s in self.gauges.items()},
+                "histograms": {
+                    n: [{"labels": dict(k), **h.to_dict()} for k, h in s.items()] for n, s in self.histograms.items()
+                },
+                "samples": {n: list(s) for n, s in self.samples.items()},
+            }
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            self._process_gauges()
+            for name, series in self.counters.items():
+                lines.append(f"# TYPE {name} counter")
+                lines.extend(f"{name}{_format_labels(k)} {v}" for k, v in series.items())
+            for name, series in self.gauges.items():
+                lines.append(f"# TYPE {name} gauge")
+                lines.extend(f"{name}{_format_labels(k)} {v}" for k, v in series.items())
+            for name, series in self.histograms.items():
+                lines.append(f"# TYPE {name} histogram")
+                for k, h in series.items():
+                    cumulative = 0
+                    for bound, count in zip(h.buckets + (float("inf"),), h.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else str(bound)
+                        lines.append(f"{name}_bucket{_format_labels(k, {'le': le})} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(k)} {h.sum}")
+                    lines.append(f"{name}_count{_format_labels(k)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str):
+        """Write to path, as Prometheus text if it ends in .prom or .txt, JSON otherwise"""
+        text = self.to_prometheus() if path.endswith((".prom", ".txt")) else self.to_json()
+        with open(path, "w") as f:
+            f.write(text)
+
+
+METRICS = MetricsRegistry()
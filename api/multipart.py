@@ -0,0 +1,143 @@
+import email.parser
+import uuid
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# helpers for the multipart/mixed bodies of batch requests
+# see: https://developers.google.com/drive/api/guides/performance#batch-requests
+
+HTTP_REASONS = {
+    200: "OK",
+    204: "No Content",
+    400: "Bad Request",
+    401: "Unauthorized",
+    403: "Forbidden",
+    404: "Not Found",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+
+
+def split_http_message(message: str) -> Tuple[str, Dict[str, str], str]:
+    """Split an application/http message into its start line, headers and body"""
+    message = message.replace("\r\n", "\n")
+    start_line, _, rest = message.partition("\n")
+    head, _, body = rest.partition("\n\n")
+    headers = {}
+    for line in head.split("\n"):
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    return start_line.strip(), headers, body
+
+
+def parse_batch_request(content_type: str, body: bytes) -> List[Tuple[str, str, str, Dict[str, str], str]]:
+    """Parse a batch request into (content_id, method, path, headers, body) tuples"""
+    msg = email.parser.BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    parts = []
+    for part in msg.get_payload():
+        start_line, headers, part_body = split_http_message(part.get_payload())
+        method, path, _ = start_line.split(" ", 2)
+        parts.append((part["Content-ID"] or "", method, path, headers, part_body))
+    return parts
+
+
+def response_content_id(content_id: str) -> str:
+    # "<base + id>" -> "<response-base + id>", as the real endpoint does
+    return "<response-" + content_id.strip("<>") + ">"
+
+
+def build_batch_response(parts: List[Tuple[str, int, Optional[bytes]]]) -> Tuple[str, bytes]:
+    """Build a batch response from (content_id, status, json_body) tuples
+
+    Returns the Content-Type header value and the body.
+    """
+    boundary = "batch_" + uuid.uuid4().hex
+    chunks = []
+    for content_id, status, content in parts:
+        chunks.append(
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: {response_content_id(content_id)}\r\n"
+            "\r\n"
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'Unknown')}\r\n"
+            "Content-Type: application/json; charset=UTF-8\r\n"
+            "\r\n".encode()
+        )
+        chunks.append((content or b"") + b"\r\n")
+    chunks.append(f"--{boundary}--\r\n".encode())
+    return f"multipart/mixed; boundary={boundary}", b"".join(chunks)
+
+
+def parse_batch_response(content_type: str, body: bytes) -> List[Tuple[str, int, Dict[str, str], str]]:
+    """Parse a batch response into (content_id, status, headers, body) tuples
+
+    Content ids have the "response-" prefix stripped, so they match the request's.
+    """
+    msg = email.parser.BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    parts = []
+    for part in msg.get_payload():
+        status_line, headers, part_body = split_http_message(part.get_payload())
+        status = int(status_line.split(" ", 2)[1])
+        content_id = (part["Content-ID"] or "").replace("<response-", "<", 1)
+        parts.append((content_id, status, headers, part_body))
+    return parts
+
+
+def _boundary(content_type: str) -> bytes:
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "boundary":
+            return value.strip('"').encode()
+    raise ValueError(f"No boundary in content type: {content_type}")
+
+
+def _split_head(body: bytes, start: int, end: int) -> Tuple[bytes, int]:
+    """Find the blank line ending the headers that start at start; returns headers and body start"""
+    for separator in (b"\r\n\r\n", b"\n\n"):
+        pos = body.find(separator, start, end)
+        if pos != -1:
+            return body[start:pos], pos + len(separator)
+    return body[start:end], end
+
+
+def _parse_headers(head: bytes) -> Dict[str, str]:
+    headers = {}
+    for line in head.decode("latin-1").splitlines():
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    return headers
+
+
+def iter_batch_response(content_type: str, body: bytes) -> Iterator[Tuple[str, int, Dict[str, str], memoryview]]:
+    """Yield (content_id, status, headers, body) per part of a batch response, in order
+
+    Unlike parse_batch_response, nothing but the small header blocks is copied: part bodies
+    are memoryviews into body, and each part is only located once the previous one has been
+    consumed. Content ids keep their "response-" prefix.
+    """
+    delimiter = b"--" + _boundary(content_type)
+    view = memoryview(body)
+    pos = body.find(delimiter)
+    while pos != -1:
+        pos += len(delimiter)
+        if body[pos : pos + 2] == b"--":
+            return
+        next_pos = body.find(b"\n" + delimiter, pos)
+        end = len(body) if next_pos == -1 else next_pos
+        # the line break before a delimiter belongs to the delimiter
+        part_end = end - 1 if end > pos and body[end - 1 : end] == b"\r" else end
+
+        part_start = body.find(b"\n", pos, part_end) + 1
+        part_head, http_start = _split_head(body, part_start, part_end)
+        http_head, body_start = _split_head(body, http_start, part_end)
+
+        status_line, _, header_lines = http_head.partition(b"\n")
+        status = int(status_line.split(b" ", 2)[1])
+        content_id = _parse_headers(part_head).get("content-id", "")
+        yield content_id, status, _parse_headers(header_lines), view[body_start:part_end]
+
+        pos = -1 if next_pos == -1 else body.find(delimiter, next_pos)
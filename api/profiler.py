@@ -0,0 +1,180 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+from api.metrics import Histogram
+
+# seconds; the interesting range for executor queueing and event loop stalls
+WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+MAX_STACK_DEPTH = 64
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class Profiler:
+    """Sampling profiler plus phase, executor and event loop timers for one run
+
+    Phases are always timed since they're cheap; the sampler thread and the loop watcher
+    only run between start and stop.
+    """
+
+    def __init__(self, interval: float = 0.005, loop_interval: float = 0.05) -> None:
+        self.interval = interval
+        self.loop_interval = loop_interval
+        self.enabled = False
+        self.start_time = 0.0
+        self.wall = 0.0
+
+        self._lock = threading.Lock()
+        self.phases: Dict[str, float] = defaultdict(float)
+        self.phase_counts: Counter = Counter()
+        # (thread name, frames from outermost to innermost) -> samples
+        self.stacks: Counter = Counter()
+        self.num_samples = 0
+        self.executor_wait = Histogram(WAIT_BUCKETS)
+        self.executor_run = Histogram(WAIT_BUCKETS)
+        self.loop_lag = Histogram(WAIT_BUCKETS)
+        self.max_loop_lag = 0.0
+
+        self._stop = threading.Event()
+        self._sampler = None
+        self._watched = weakref.WeakSet()
+
+    def start(self):
+        self.enabled = True
+        self.start_time = time.perf_counter()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self.wall = time.perf_counter() - self.start_time
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                with self._lock:
+                    self.stacks[(names.get(ident, str(ident)), tuple(reversed(stack)))] += 1
+            self.num_samples += 1
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] += time.perf_counter() - start
+                self.phase_counts[name] += 1
+
+    def wrap_executor_call(self, func):
+        """Wrap func to record how long it queued for an executor thread and how long it ran"""
+        if not self.enabled:
+            return func
+        submitted = time.perf_counter()
+
+        def wrapper():
+            started = time.perf_counter()
+            try:
+                return func()
+            finally:
+                with self._lock:
+                    self.executor_wait.observe(started - submitted)
+                    self.executor_run.observe(time.perf_counter() - started)
+
+        return wrapper
+
+    def watch_loop(self, loop: asyncio.AbstractEventLoop):
+        """Measure event loop lag, how late a short sleep wakes up, for as long as loop runs"""
+        if self.enabled and loop not in self._watched:
+            self._watched.add(loop)
+            loop.create_task(self._watch_loop())
+
+    async def _watch_loop(self):
+        while self.enabled:
+            start = time.perf_counter()
+            await asyncio.sleep(self.loop_interval)
+            lag = max(0.0, time.perf_counter() - start - self.loop_interval)
+            with self._lock:
+                self.loop_lag.observe(lag)
+                self.max_loop_lag = max(self.max_loop_lag, lag)
+
+    def _top_functions(self, thread: str) -> Tuple[Counter, Counter, int]:
+        own, total = Counter(), Counter()
+        samples = 0
+        for (name, stack), count in self.stacks.items():
+            if name != thread or not stack:
+                continue
+            samples += count
+            own[stack[-1]] += count
+            for func in set(stack):
+                total[func] += count
+        return own, total, samples
+
+    def report(self, limit: int = 25) -> str:
+        with self._lock:
+            lines = [f"wall time: {self.wall:.3f}s, samples: {self.num_samples} every {self.interval * 1000:g}ms", ""]
+
+            lines.append("phases (wall time, nested phases overlap)")
+            for name, seconds in sorted(self.phases.items(), key=lambda x: -x[1]):
+                lines.append(f"  {name.ljust(24)} {seconds:10.3f}s {self.phase_counts[name]:6d}x")
+            lines.append("")
+
+            for title, hist in [
+                ("executor queue wait", self.executor_wait),
+                ("executor run time", self.executor_run),
+                ("event loop lag", self.loop_lag),
+            ]:
+                mean = hist.sum / hist.count if hist.count else 0
+                lines.append(
+                    f"{title}: {hist.count} samples, mean {mean * 1000:.2f}ms,"
+                    f" p50 <= {hist.quantile(0.5) * 1000:g}ms, p99 <= {hist.quantile(0.99) * 1000:g}ms"
+                )
+            lines.append(f"max event loop lag: {self.max_loop_lag * 1000:.2f}ms")
+            lines.append("")
+
+            threads = sorted({name for name, _ in self.stacks})
+            for thread in threads:
+                own, total, samples = self._top_functions(thread)
+                lines.append(f"thread {thread}: {samples} samples")
+                lines.append(f"  {'own %'.rjust(7)} {'total %'.rjust(7)}  function")
+                for func, count in own.most_common(limit):
+                    lines.append(f"  {100 * count / samples:7.1f} {100 * total[func] / samples:7.1f}  {func}")
+                lines.append("")
+
+            # collapsed stacks, as consumed by flamegraph.pl and speedscope
+            lines.append("collapsed stacks")
+            for (thread, stack), count in self.stacks.most_common():
+                lines.append(";".join((thread,) + stack) + f" {count}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str):
+        self.stop()
+        with open(path, "w") as f:
+            f.write(self.report())
+
+
+PROFILER = Profiler()
@@ -1,30 +1,133 @@
 import asyncio
+import copy
 import functools
 import random
+import threading
 import time
 import traceback
 import logging
-from typing import Any
+import weakref
+from typing import Any, Dict, Iterable, Optional
 
-from consts import BACKOFF_RESET_SECONDS, BATCH_SIZE, logger
+from api.metrics import METRICS, RATIO_BUCKETS
+from api.profiler import PROFILER
+from api.tracing import TRACER
+from consts import BACKOFF_RESET_SECONDS, BATCH_SIZE, MAXIMUM_BACKOFF, REQUEST_INTERVAL, logger
+from googleapiclient.errors import HttpError
+from httplib2.error import HttpLib2Error
 
 
 async def async_exec(loop, func, *args, **kwargs) -> Any:
     func = functools.partial(func, *args, **kwargs)
-    result = await loop.run_in_executor(None, func)
+    result = await loop.run_in_executor(None, PROFILER.wrap_executor_call(func))
     return result
 
 
+# idempotent, so safe to send twice and to give up on
+READ_METHODS = {
+    "drive.files.list",
+    "drive.files.get",
+    "drive.about.get",
+    "drive.changes.list",
+    "drive.changes.getStartPageToken",
+}
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+# latencies a percentile has to be taken from before hedging on it
+HEDGE_MIN_SAMPLES = 20
+
+
+def method_name(req) -> str:
+    # e.g. drive.files.list
+    return getattr(req, "methodId", None) or "unknown"
+
+
+def parse_deadlines(specs: Iterable[str]) -> Dict[str, float]:
+    """Parse "files.list=30"-style deadlines; bare seconds apply to every read method"""
+    deadlines: Dict[str, float] = {}
+    for spec in specs:
+        method, _, seconds = spec.rpartition("=")
+        if not method:
+            deadlines.update(dict.fromkeys(READ_METHODS - deadlines.keys(), float(seconds)))
+        else:
+            deadlines[method if method.startswith("drive.") else f"drive.{method}"] = float(seconds)
+    return deadlines
+
+
+def is_retryable(error: HttpError) -> bool:
+    # downloads also get 403 for files that can't be downloaded, which no retry fixes
+    if error.status_code == 403:
+        details = error.error_details if isinstance(error.error_details, list) else []
+        return any(x.get("reason") in RATE_LIMIT_REASONS for x in details)
+    return error.status_code in [429, 500, 502, 503, 504]
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Attempt:
+    """One sending of a queued request, which its hedge is part of
+
+    Copies of the request answer from different threads, before resolve() gets to set the
+    future. Only the first error of an attempt is handled, so a request isn't re-queued once
+    per copy, and none are once the attempt is given up on, as it's sent again anyway.
+    Responses always go through; the callback drops those for futures already done.
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.answered = False
+
+    def give_up(self):
+        with self.lock:
+            self.answered = True
+
+    def __call__(self, request_id, response, exception):
+        with self.lock:
+            if exception is not None and self.answered:
+                return
+            self.answered = True
+        self.callback(request_id, response, exception)
+
+
 class GoogleDriveRequestBatcher:
-    def __init__(self, api) -> None:
+    def __init__(
+        self,
+        api,
+        request_interval: float = REQUEST_INTERVAL,
+        new_batch=None,
+        deadlines: Optional[Dict[str, float]] = None,
+        hedge_percentile: float = 0,
+        new_http=None,
+    ) -> None:
         # NEEDS a running loop, only create this object after the loop is running
         self.loop = asyncio.get_running_loop()
         self.api = api
+        self.new_batch = new_batch or api.new_batch_http_request
+        self.request_interval = request_interval
+        # seconds per method before a batch is given up on and re-queued
+        self.deadlines = deadlines or {}
+        # batches of reads slower than this percentile of their methods' latency get a duplicate
+        self.hedge_percentile = hedge_percentile
+        # batches otherwise reuse the Http of one of their requests, which a given up or
+        # hedged attempt may still be using in another thread
+        self.new_http = new_http
+        PROFILER.watch_loop(self.loop)
 
         self.batch_queue = []
+        # set whenever something is added to batch_queue, so the idle loop doesn't have to poll
+        self.queued = asyncio.Event()
+        # requests queued, in flight or waiting for a retry, a measure of how busy the account is
+        self.pending = 0
+        # requests already retried after a 401, which aren't retried again
+        self.reauthorized = weakref.WeakSet()
         self.backoff_mult = 0
         self.backoff_start_time = 0
         self.backoff_now = False
+        # requests sent on their own wait for this time, set by the one that failed
+        self.backoff_until = 0.0
         self.loop.create_task(self.do_queue_in_batches(self.batch_queue, persist=True))
 
     async def do_queue_in_batches(self, queue, persist=False):
@@ -36,18 +139,42 @@ class GoogleDriveRequestBatcher:
                 await self.wait_between_requests()
                 continue
 
+            if persist and not queue:
+                self.queued.clear()
+                await self.queued.wait()
+                continue
+
             if time.time() - self.backoff_start_time > BACKOFF_RESET_SECONDS:
                 self.backoff_mult = 0
 
+            batch = []
+            attempts = []
             try:
                 if queue:
                     batch = queue[:BATCH_SIZE]
-                    batreq = self.api.new_batch_http_request()
+                    attempts = [(req, Attempt(callback), span) for req, callback, span in batch]
+                    batreq = self.new_batch()
 
-                    for b in batch:
-                        batreq.add(b[0], callback=b[1])
+                    sent = time.perf_counter()
+                    batch_id = TRACER.next_batch_id() if TRACER.enabled else 0
+                    for req, attempt, span in attempts:
+                        batreq.add(req, callback=self.timed(req, attempt, sent))
+                        if span:
+                            span.sent(batch_id)
 
-                    await async_exec(self.loop, batreq.execute)
+                    shared = queue is self.batch_queue
+                    if shared:
+                        METRICS.set("gdrive_queue_depth", len(queue), sample=True)
+                    METRICS.inc("gdrive_batches_total", queue="shared" if shared else "immediate")
+                    METRICS.observe("gdrive_batch_fill_ratio", len(batch) / BATCH_SIZE, buckets=RATIO_BUCKETS)
+
+                    try:
+                        await self.execute_batch(batreq, attempts)
+                    finally:
+                        METRICS.inc("gdrive_in_flight_seconds_total", time.perf_counter() - sent)
+                        TRACER.batch(
+                            batch_id, sent, len(batch), sum(1 for x in batch if x[2]), "shared" if shared else "immediate"
+                        )
 
                     # remove batch *after* it has been successfully executed
                     # use del to avoid creating a new list (breaks reference to original list)
@@ -57,25 +184,123 @@ class GoogleDriveRequestBatcher:
                         )
                     del queue[: len(batch)]
 
+            except DeadlineExceeded as e:
+                # a stuck request says nothing about rate limits, so re-send without backing off
+                METRICS.inc("gdrive_batch_errors_total", error=type(e).__name__)
+                for _, _, span in batch:
+                    if span:
+                        span.batch_failed(e)
+                logger.warning(f"Batch of {len(batch)} requests timed out: {e}. Re-queueing...")
+
             except Exception as e:
+                METRICS.inc("gdrive_batch_errors_total", error=type(e).__name__)
+                for _, _, span in batch:
+                    if span:
+                        span.batch_failed(e)
                 self.backoff()
                 logger.warning(f"Error in request batching: {e}")
                 if logger.getEffectiveLevel() < logging.DEBUG:
                     traceback.print_exc()
 
             finally:
+                # answers still coming from a hedge or a given up attempt don't re-queue anything,
+                # what failed here was re-queued already or is still in the queue
+                for _, attempt, _ in attempts:
+                    attempt.give_up()
                 await self.wait_between_requests()
 
+    def batch_deadline(self, methods) -> Optional[float]:
+        # only give up on a batch once every request in it is overdue
+        if not methods <= self.deadlines.keys():
+            return None
+        return max(self.deadlines[x] for x in methods)
+
+    def hedge_after(self, methods) -> Optional[float]:
+        if not self.hedge_percentile or not methods <= READ_METHODS:
+            return None
+        thresholds = []
+        for method in methods:
+            histogram = METRICS.histogram("gdrive_request_latency_seconds", method=method)
+            if histogram is None or histogram.count < HEDGE_MIN_SAMPLES:
+                return None
+            thresholds.append(histogram.quantile(self.hedge_percentile / 100))
+        threshold = max(thresholds)
+        return None if threshold == float("inf") else threshold
+
+    def hedge(self, batch, methods):
+        # same requests and callbacks; whichever answer comes first resolves each future
+        batreq = self.new_batch()
+        sent = time.perf_counter()
+        for req, callback, span in batch:
+            duplicate = copy.copy(req)
+            duplicate.headers = dict(req.headers)
+            batreq.add(duplicate, callback=self.timed(req, callback, sent))
+            if span:
+                span.hedged()
+        METRICS.inc("gdrive_hedges_total", method=",".join(sorted(methods)))
+        return asyncio.ensure_future(self.execute(batreq))
+
+    async def execute(self, batreq):
+        if self.new_http is None:
+            return await async_exec(self.loop, batreq.execute)
+        return await async_exec(self.loop, batreq.execute, http=self.new_http())
+
+    async def execute_batch(self, batreq, batch):
+        """Execute batreq, hedged and within the deadline of its methods, if they have them
+
+        The executor thread of an attempt that was given up on can't be stopped. It runs
+        until its socket times out, and the callbacks it still makes find their futures done.
+        """
+        methods = {method_name(req) for req, _, _ in batch}
+        deadline = self.batch_deadline(methods)
+        hedge_after = self.hedge_after(methods)
+        start = time.perf_counter()
+
+        attempts = {asyncio.ensure_future(self.execute(batreq))}
+        hedged = None
+        if hedge_after is not None and (deadline is None or hedge_after < deadline):
+            done, _ = await asyncio.wait(attempts, timeout=hedge_after)
+            if not done:
+                hedged = self.hedge(batch, methods)
+                attempts.add(hedged)
+
+        error: Optional[BaseException] = None
+        try:
+            while attempts:
+                timeout = None if deadline is None else max(0.0, deadline - (time.perf_counter() - start))
+                done, attempts = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    METRICS.inc("gdrive_deadlines_exceeded_total", method=",".join(sorted(methods)))
+                    raise DeadlineExceeded(f"No response within {deadline:g}s")
+                for attempt in done:
+                    if attempt.exception() is None:
+                        if attempt is hedged:
+                            METRICS.inc("gdrive_hedge_wins_total", method=",".join(sorted(methods)))
+                        return
+                    error = attempt.exception()
+            raise error  # type: ignore
+        finally:
+            for attempt in attempts:
+                # nobody waits for these anymore, don't let their errors go unretrieved
+                attempt.add_done_callback(lambda x: x.cancelled() or x.exception())
+
     async def wait_between_requests(self):
         # exponential backoff: https://developers.google.com/drive/api/guides/limits#exponential
         rand_milis = random.randint(1, 1000)
-        wait_time = min(2**self.backoff_mult + rand_milis / 1000, 60)
+        if self.backoff_mult == 0:
+            wait_time = self.request_interval * (1 + rand_milis / 1000)
+        else:
+            wait_time = min(2**self.backoff_mult + rand_milis / 1000, MAXIMUM_BACKOFF)
+        METRICS.inc("gdrive_sleep_seconds_total", wait_time, reason="backoff" if self.backoff_mult else "interval")
         await asyncio.sleep(wait_time)
 
-    def backoff(self):
+    def backoff(self, seconds: Optional[float] = None):
         self.backoff_start_time = time.time()
         self.backoff_mult += 1
-        logger.warning(f"Backing off for 2^{self.backoff_mult} seconds...")
+        METRICS.inc("gdrive_backoffs_total")
+        if seconds is None:
+            seconds = 2**self.backoff_mult
+        logger.warning(f"Backing off for {seconds:.3g} seconds...")
 
     async def queue_request(self, req, execute_now=False) -> dict:
         # THIS IS BLACK MAGIC BUT IT WORKS SO WELL
@@ -88,27 +313,117 @@ class GoogleDriveRequestBatcher:
             queue = []
 
         future = self.loop.create_future()
-        callback = self.make_callback(future, req)
-        queue.append((req, callback))
+        span = TRACER.start_request(req)
+        callback = self.make_callback(future, req, span)
+        queue.append((req, callback, span))
 
-        if queue is not self.batch_queue:
-            await self.do_queue_in_batches(queue)
+        self.pending += 1
+        try:
+            if queue is self.batch_queue:
+                self.queued.set()
+            else:
+                await self.do_queue_in_batches(queue)
 
-        # wait until future has a result, meaning when callback is called
-        result = await future
+            # wait until future has a result, meaning when callback is called
+            result = await future
+        finally:
+            self.pending -= 1
+        if span:
+            span.resolved()
 
         return result
 
-    def make_callback(self, future, req):
+    async def execute_alone(self, req, call=None) -> Any:
+        """Execute a request that can't go in a batch, like media downloads and uploads
+
+        Retried like batched requests are, and backs off the whole account on rate limits.
+        call is run instead of req.execute, e.g. req.next_chunk for uploads.
+        """
+        method = method_name(req)
+        retries = 0
+        self.pending += 1
+        try:
+            while True:
+                # one pause for all requests, not one each for as long as backoff_mult is up
+                wait_time = self.backoff_until - time.time()
+                if wait_time > 0:
+                    METRICS.inc("gdrive_sleep_seconds_total", wait_time, reason="backoff")
+                    await asyncio.sleep(wait_time)
+
+                sent = time.perf_counter()
+                sent_at = time.time()
+                try:
+                    resp = await async_exec(self.loop, call or req.execute)
+                except HttpError as e:
+                    METRICS.inc("gdrive_requests_total", method=method, status=e.status_code)
+                    if not is_retryable(e):
+                        logger.warning(f"Unrecoverable error: {e}. Skipping request...")
+                        return None
+                    logger.warning(f"Error: {e}. Retrying request...")
+                except (HttpLib2Error, OSError) as e:
+                    METRICS.inc("gdrive_batch_errors_total", error=type(e).__name__)
+                    logger.warning(f"Error executing request: {e}. Retrying request...")
+                else:
+                    METRICS.inc("gdrive_requests_total", method=method, status=200)
+                    METRICS.observe("gdrive_request_latency_seconds", time.perf_counter() - sent, method=method)
+                    return resp
+                finally:
+                    METRICS.inc("gdrive_in_flight_seconds_total", time.perf_counter() - sent)
+
+                METRICS.inc("gdrive_retries_total", method=method)
+                retries += 1
+                # requests running side by side fail together; back off once for all of them.
+                # The pause grows with this request's own retries, so errors scattered over a
+                # long transfer cost a short pause each instead of ever longer ones
+                if self.backoff_start_time < sent_at:
+                    pause = min(2**retries + random.randint(1, 1000) / 1000, MAXIMUM_BACKOFF)
+                    self.backoff(pause)
+                    self.backoff_until = max(self.backoff_until, time.time() + pause)
+        finally:
+            self.pending -= 1
+
+    def timed(self, req, callback, sent):
+        # responses arrive together, so a request's latency is that of its batch
+        method = method_name(req)
+
+        def timed_callback(request_id, response, exception):
+            METRICS.observe("gdrive_request_latency_seconds", time.perf_counter() - sent, method=method)
+            callback(request_id, response, exception)
+
+        return timed_callback
+
+    def make_callback(self, future, req, span=None):
+        method = method_name(req)
+        queued_at = time.perf_counter()
+
         # this is called when the request is done
         def callback(request_id, response, exception):
+            if future.done():
+                # a hedged or given up attempt answered after another one
+                return
+            if span:
+                span.received(exception.status_code if exception is not None else 200)
             if exception is not None:
-                self.handle_request_exception(future, exception, (req, callback))
+                METRICS.inc("gdrive_requests_total", method=method, status=exception.status_code)
+                self.handle_request_exception(future, exception, (req, callback, span))
             else:
-                future.set_result(response)
+                METRICS.inc("gdrive_requests_total", method=method, status=200)
+                if span:
+                    span.callback_done()
+                # from the first queueing to the final response, retries included
+                METRICS.observe("gdrive_request_wait_seconds", time.perf_counter() - queued_at, method=method)
+                self.resolve(future, response)
 
         return callback
 
+    def resolve(self, future, result):
+        # callbacks run in executor threads, possibly two for the same request
+        def set_result():
+            if not future.done():
+                future.set_result(result)
+
+        self.loop.call_soon_threadsafe(set_result)
+
     def handle_request_exception(self, future, exception, queue_item):
         # 400 - Bad Request 	The request cannot be fulfilled due to a client error in the request.
         # 401 - Unauthorized 	The request contains invalid credentials.
@@ -117,15 +432,35 @@ class GoogleDriveRequestBatcher:
         # 429 - Too Many Requests 	Too many requests to the API.
         # 500, 502, 503, 504 - Server Errors 	Unexpected error arises while processing the request.
         # from: https://developers.google.com/drive/api/guides/handle-errors
+        span = queue_item[2]
         if exception.status_code in [403, 429, 500, 502, 503, 504]:
             logger.warning(f"Error: {exception}. Retrying request...")
+            METRICS.inc("gdrive_retries_total", method=method_name(queue_item[0]))
+            if span:
+                span.requeued(exception.status_code)
             # backoff once per batch
             self.backoff_now = True
             self.batch_queue.append(queue_item)
+            # callbacks run in the executor thread
+            self.loop.call_soon_threadsafe(self.queued.set)
+
+        elif exception.status_code == 401 and queue_item[0] not in self.reauthorized:
+            # the token ran out in flight; the retry goes out with the one replacing it
+            logger.warning(f"Error: {exception}. Retrying request with a refreshed token...")
+            METRICS.inc("gdrive_retries_total", method=method_name(queue_item[0]))
+            if span:
+                span.requeued(exception.status_code)
+            self.reauthorized.add(queue_item[0])
+            self.batch_queue.append(queue_item)
+            self.loop.call_soon_threadsafe(self.queued.set)
 
         elif exception.status_code in [400, 401, 404]:
             logger.warning(f"Unrecoverable error: {exception}. Skipping request...")
-            future.set_result(None)
+            if span:
+                span.callback_done()
+            self.resolve(future, None)
         else:
             logger.error(f"Unrecognized error: {exception}. Skipping request...")
-            future.set_result(None)
+            if span:
+                span.callback_done()
+            self.resolve(future, None)
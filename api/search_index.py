@@ -0,0 +1,181 @@
+import bisect
+import fnmatch
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+GLOB_CHARS = re.compile(r"[*?\[]")
+
+
+def trigrams(text: str) -> Set[str]:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    """Name and path index over an InfoCache
+
+    Names are indexed by lowercase trigrams, so substring lookups only have to verify the
+    intersection of a few posting sets. Full paths are kept in a sorted list, so path prefix
+    queries are a bisect. Both are built once on first use and updated incrementally as the
+    cache fetches more files.
+    """
+
+    def __init__(self, cache) -> None:
+        self.cache = cache
+
+        self._grams: Dict[str, Set[str]] = defaultdict(set)
+        self._names: Dict[str, str] = {}
+
+        self._paths: List[Tuple[str, str]] = []
+        self._path_of: Dict[str, str] = {}
+        self._parents: Set[str] = set()
+        self._pending: Set[str] = set()
+
+        self.build()
+
+    def build(self):
+        self._grams.clear()
+        self._names.clear()
+        for file_id, file in self.cache.file_info.items():
+            self._add_name(file_id, file)
+        self._pending.clear()
+        self._build_paths()
+
+    def update(self, file_ids: Iterable[str]):
+        for file_id in file_ids:
+            file = self.cache.file_info.get(file_id)
+            if file is None:
+                continue
+            if self._names.get(file_id) != file.get("name", "").lower():
+                self._remove_name(file_id)
+                self._add_name(file_id, file)
+            self._pending.add(file_id)
+
+    ################################################################################
+    # Names                                                                        #
+    ################################################################################
+    def _add_name(self, file_id: str, file: dict):
+        name = file.get("name", "").lower()
+        self._names[file_id] = name
+        for gram in trigrams(name):
+            self._grams[gram].add(file_id)
+
+    def _remove_name(self, file_id: str):
+        name = self._names.pop(file_id, None)
+        if name is None:
+            return
+        for gram in trigrams(name):
+            self._grams[gram].discard(file_id)
+
+    def _candidates(self, *fragments: str) -> Optional[Set[str]]:
+        """Ids whose name may contain all fragments, or None if the index can't narrow it down"""
+        postings = [self._grams.get(gram, set()) for fragment in fragments for gram in trigrams(fragment)]
+        if not postings:
+            return None
+
+        postings.sort(key=len)
+        result = set(postings[0])
+        for posting in postings[1:]:
+            if not result:
+                break
+            result.intersection_update(posting)
+        return result
+
+    ################################################################################
+    # Paths                                                                        #
+    ################################################################################
+    def _build_paths(self):
+        file_info = self.cache.file_info
+        paths: Dict[str, str] = {}
+
+        for file_id in file_info:
+            # walk up until a known path, then fill in everything on the way back down
+            chain = []
+            current = file_id
+            while current not in paths:
+                chain.append(current)
+                parent = file_info[current].get("parent")
+                if parent not in file_info or parent in chain:
+                    break
+                current = parent
+
+            prefix = paths.get(current, "")
+            for link in reversed(chain):
+                prefix = prefix + "/" + file_info[link].get("name", "")
+                paths[link] = prefix
+
+        self._path_of = paths
+        self._paths = sorted((path, file_id) for file_id, path in paths.items())
+        self._parents = {x.get("parent") for x in file_info.values()}
+
+    def _flush(self):
+        if not self._pending:
+            return
+
+        file_info = self.cache.file_info
+        # a moved, renamed or late-arriving folder changes the path of everything below it
+        if any(
+            x in self._path_of or x in self._parents or file_info[x].get("parent") in self._pending
+            for x in self._pending
+        ):
+            self._pending.clear()
+            self._build_paths()
+            return
+
+        for file_id in self._pending:
+            parent = file_info[file_id].get("parent")
+            prefix = self._path_of.get(parent, "") if parent in file_info else ""
+            path = prefix + "/" + file_info[file_id].get("name", "")
+            self._path_of[file_id] = path
+            self._parents.add(parent)
+            bisect.insort(self._paths, (path, file_id))
+        self._pending.clear()
+
+    def path(self, file_id: str) -> str:
+        self._flush()
+        return self._path_of[file_id]
+
+    ################################################################################
+    # Queries                                                                      #
+    ################################################################################
+    def _with_paths(self, file_ids: Iterable[str]) -> List[Tuple[str, str]]:
+        self._flush()
+        return sorted((self._path_of[x], x) for x in file_ids if x in self._path_of)
+
+    def find_substring(self, text: str) -> List[Tuple[str, str]]:
+        text = text.lower()
+        candidates = self._candidates(text)
+        if candidates is None:
+            candidates = self._names.keys()
+        return self._with_paths(x for x in candidates if text in self._names[x])
+
+    def find_prefix(self, prefix: str) -> List[Tuple[str, str]]:
+        if prefix.startswith("/"):
+            self._flush()
+            start = bisect.bisect_left(self._paths, (prefix, ""))
+            end = bisect.bisect_left(self._paths, (prefix + chr(0x10FFFF), ""))
+            return self._paths[start:end]
+
+        prefix = prefix.lower()
+        candidates = self._candidates(prefix)
+        if candidates is None:
+            candidates = self._names.keys()
+        return self._with_paths(x for x in candidates if self._names[x].startswith(prefix))
+
+    def find_glob(self, pattern: str) -> List[Tuple[str, str]]:
+        if "/" in pattern:
+            # match full paths, but only scan the range sharing the pattern's literal prefix
+            literal = GLOB_CHARS.split(pattern, 1)[0]
+            if literal.startswith("/"):
+                paths = self.find_prefix(literal)
+            else:
+                self._flush()
+                paths = self._paths
+            return [x for x in paths if fnmatch.fnmatchcase(x[0], pattern)]
+
+        pattern = pattern.lower()
+        fragments = [x for x in re.split(r"\*|\?|\[[^\]]*\]", pattern) if len(x) >= 3]
+        candidates = self._candidates(*fragments)
+        if candidates is None:
+            candidates = self._names.keys()
+        return self._with_paths(x for x in candidates if fnmatch.fnmatchcase(self._names[x], pattern))
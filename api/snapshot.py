@@ -0,0 +1,408 @@
+import bisect
+import fnmatch
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from api.search_index import GLOB_CHARS
+from consts import FOLDER_TYPE
+
+MAGIC = b"GDSNAP01"
+# magic, byte order, row count, then (offset, length) of every section
+HEADER = struct.Struct("<8sc7xQ")
+SECTION = struct.Struct("<QQ")
+# typecodes of the integer sections; string tables are UTF-8 bytes after their offsets
+SECTIONS = {
+    "id_offsets": "q",
+    "ids": None,
+    "by_id": "i",
+    "name_offsets": "q",
+    "names": None,
+    "folded_offsets": "q",
+    "folded": None,
+    "parent": "i",
+    "end": "i",
+    "mime": "i",
+    "size": "q",
+    "created": "q",
+    "modified": "q",
+    "owner": "i",
+    "target_offsets": "q",
+    "targets": None,
+    "mime_offsets": "q",
+    "mimes": None,
+    "owner_offsets": "q",
+    "owners": None,
+    "outside_offsets": "q",
+    "outside": None,
+    "root": None,
+}
+BYTE_ORDER = b"<" if sys.byteorder == "little" else b">"
+
+
+def to_millis(timestamp: Optional[str]) -> int:
+    if not timestamp:
+        return -1
+    return round(datetime.fromisoformat(timestamp).timestamp() * 1000)
+
+
+def from_millis(millis: int) -> Optional[str]:
+    if millis < 0:
+        return None
+    time = datetime.fromtimestamp(millis // 1000, timezone.utc)
+    return f"{time:%Y-%m-%dT%H:%M:%S}.{millis % 1000:03d}Z"
+
+
+def string_table(strings) -> Tuple[array, bytes]:
+    offsets = array("q", [0])
+    blob = bytearray()
+    for string in strings:
+        blob += string.encode()
+        offsets.append(len(blob))
+    return offsets, bytes(blob)
+
+
+class StringColumn:
+    """Strings stored back to back, read straight from the mapped file"""
+
+    def __init__(self, offsets: memoryview, blob: memoryview) -> None:
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row: int) -> str:
+        return str(self.blob[self.offsets[row]:self.offsets[row + 1]], "utf-8")
+
+    def release(self):
+        self.offsets.release()
+        self.blob.release()
+
+
+def write_snapshot(cache, path: str, root: Optional[str] = None):
+    """Write every file of cache to path, as columns the Snapshot class maps into memory
+
+    Rows are in pre-order, children by name, so everything below a row is the range up to
+    its end, and parents are row numbers. Parents that aren't in the cache are -2 and below,
+    numbering a table of their ids. Ids, names and shortcut targets are string tables, and
+    mimeTypes and owners number tables of the distinct values. The file is replaced
+    atomically, so processes that have the old one mapped keep reading it undisturbed.
+    """
+    file_info = cache.file_info
+    children = defaultdict(list)
+    tops = []
+    for file_id, file in file_info.items():
+        parent = file.get("parent")
+        if parent in file_info and parent != file_id:
+            children[parent].append(file_id)
+        else:
+            tops.append(file_id)
+
+    def by_name(file_id):
+        return file_info[file_id].get("name", ""), file_id
+
+    # iterative pre-order, where a row number on the stack marks the end of its subtree
+    ids: List[str] = []
+    row_of: Dict[str, int] = {}
+    ends: List[int] = []
+    stack: List = sorted(tops, key=by_name, reverse=True)
+    while stack:
+        file_id = stack.pop()
+        if isinstance(file_id, int):
+            ends[file_id] = len(ids)
+            continue
+        row_of[file_id] = len(ids)
+        ids.append(file_id)
+        ends.append(len(ids))
+        stack.append(row_of[file_id])
+        stack.extend(sorted(children.get(file_id, ()), key=by_name, reverse=True))
+    # parent cycles are below no top; they come last, one row each
+    for file_id in file_info:
+        if file_id not in row_of:
+            row_of[file_id] = len(ids)
+            ids.append(file_id)
+            ends.append(len(ids))
+
+    mimes: Dict[Optional[str], int] = {}
+    owners: Dict[Optional[str], int] = {}
+    outside: Dict[str, int] = {}
+    columns = {x: array(SECTIONS[x]) for x in ["parent", "mime", "size", "created", "modified", "owner"]}
+    names = []
+    targets = []
+    for file_id in ids:
+        file = file_info[file_id]
+        parent = file.get("parent")
+        owner = file.get("owners")
+        owner = owner[0].get("emailAddress") if owner else None
+
+        if parent in row_of and parent != file_id:
+            columns["parent"].append(row_of[parent])
+        else:
+            columns["parent"].append(-2 - outside.setdefault(parent, len(outside)) if parent else -1)
+        columns["mime"].append(mimes.setdefault(file.get("mimeType"), len(mimes)))
+        columns["size"].append(int(file.get("size", -1)))
+        columns["created"].append(to_millis(file.get("createdTime")))
+        columns["modified"].append(to_millis(file.get("modifiedTime")))
+        columns["owner"].append(owners.setdefault(owner, len(owners)) if owner else -1)
+        names.append(file.get("name", ""))
+        targets.append(file.get("shortcutDetails", {}).get("targetId", ""))
+
+    sections = dict(columns, end=array("i", ends), root=(root or "").encode())
+    sections["by_id"] = array("i", sorted(range(len(ids)), key=ids.__getitem__))
+    sections["id_offsets"], sections["ids"] = string_table(ids)
+    sections["name_offsets"], sections["names"] = string_table(names)
+    sections["folded_offsets"], sections["folded"] = string_table(x.lower() for x in names)
+    sections["target_offsets"], sections["targets"] = string_table(targets)
+    sections["mime_offsets"], sections["mimes"] = string_table(x or "" for x in mimes)
+    sections["owner_offsets"], sections["owners"] = string_table(x or "" for x in owners)
+    sections["outside_offsets"], sections["outside"] = string_table(outside)
+
+    temp = f"{path}.tmp"
+    with open(temp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, BYTE_ORDER, len(ids)))
+        table = f.tell()
+        f.write(bytes(SECTION.size * len(SECTIONS)))
+        placed = []
+        for name in SECTIONS:
+            # aligned, so integer columns can be cast in place
+            f.write(bytes(-f.tell() % 8))
+            data = sections[name]
+            placed.append((f.tell(), len(data) * getattr(data, "itemsize", 1)))
+            f.write(data)
+        f.seek(table)
+        for offset, length in placed:
+            f.write(SECTION.pack(offset, length))
+    os.replace(temp, path)
+
+
+class Snapshot:
+    """A file written by write_snapshot, mapped into memory
+
+    Opening it reads only the header. Columns are views on the mapping, so pages are read
+    when touched, and processes opening the same file share them through the page cache.
+    Folder reports and searches read the columns directly; file() builds the dict an
+    InfoCache would hold, for scripts that want one.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+
+        magic, byte_order, self.count = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a snapshot")
+        if byte_order != BYTE_ORDER:
+            raise ValueError(f"{path} was written on a machine of the other byte order")
+
+        sections = {}
+        self._offsets = {}
+        for i, (name, typecode) in enumerate(SECTIONS.items()):
+            offset, length = SECTION.unpack_from(view, HEADER.size + i * SECTION.size)
+            section = view[offset:offset + length]
+            sections[name] = section.cast(typecode) if typecode else section
+            self._offsets[name] = offset
+
+        self.ids = StringColumn(sections["id_offsets"], sections["ids"])
+        self.names = StringColumn(sections["name_offsets"], sections["names"])
+        self.folded = StringColumn(sections["folded_offsets"], sections["folded"])
+        self.targets = StringColumn(sections["target_offsets"], sections["targets"])
+        self.mimes = StringColumn(sections["mime_offsets"], sections["mimes"])
+        self.owners = StringColumn(sections["owner_offsets"], sections["owners"])
+        self.outside = StringColumn(sections["outside_offsets"], sections["outside"])
+        self.by_id = sections["by_id"]
+        self.parent = sections["parent"]
+        self.end = sections["end"]
+        self.mime = sections["mime"]
+        self.size = sections["size"]
+        self.created = sections["created"]
+        self.modified = sections["modified"]
+        self.owner = sections["owner"]
+        self.root = str(sections["root"], "utf-8") or None
+
+        mime_types = [self.mimes[x] for x in range(len(self.mimes))]
+        self._folder = mime_types.index(FOLDER_TYPE) if FOLDER_TYPE in mime_types else -1
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, file_id: str) -> bool:
+        return self.row(file_id) is not None
+
+    def row(self, file_id: str) -> Optional[int]:
+        i = bisect.bisect_left(self.by_id, file_id, key=self.ids.__getitem__)
+        return self.by_id[i] if i < self.count and self.ids[self.by_id[i]] == file_id else None
+
+    def children(self, row: int) -> Iterator[int]:
+        child = row + 1
+        while child < self.end[row]:
+            yield child
+            child = self.end[child]
+
+    def file(self, row: int) -> Dict:
+        """The entry of row, as InfoCache.parse_files makes them"""
+        file = {"name": self.names[row], "mimeType": self.mimes[self.mime[row]] or None}
+        parent = self.parent[row]
+        if parent >= 0:
+            file["parent"] = self.ids[parent]
+        elif parent < -1:
+            file["parent"] = self.outside[-2 - parent]
+        if self.size[row] >= 0:
+            file["size"] = str(self.size[row])
+        for key, column in [("createdTime", self.created), ("modifiedTime", self.modified)]:
+            if column[row] >= 0:
+                file[key] = from_millis(column[row])
+        if self.owner[row] >= 0:
+            file["owners"] = [{"emailAddress": self.owners[self.owner[row]]}]
+        if self.targets[row]:
+            file["shortcutDetails"] = {"targetId": self.targets[row]}
+        return file
+
+    def iter_files(self) -> Iterator[Tuple[str, Dict]]:
+        for row in range(self.count):
+            yield self.ids[row], self.file(row)
+
+    def close(self):
+        # views on the mapping have to go before it can be closed
+        for column in [self.ids, self.names, self.folded, self.targets, self.mimes, self.owners, self.outside]:
+            column.release()
+        for view in [self.by_id, self.parent, self.end, self.mime, self.size, self.created, self.modified, self.owner]:
+            view.release()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    ################################################################################
+    # Reports, with the signatures of InfoCache's                                  #
+    ################################################################################
+    def _row(self, file_id: str) -> int:
+        row = self.row(file_id)
+        if row is None:
+            raise KeyError(file_id)
+        return row
+
+    def build_path(self, file_id: str, stop_at: Optional[str] = None) -> str:
+        row = self._row(file_id)
+        stop = self.row(stop_at) if stop_at else None
+        names = [self.names[row]]
+        row = self.parent[row]
+        while row >= 0 and row != stop:
+            names.append(self.names[row])
+            row = self.parent[row]
+        return "/" + "/".join(reversed(names))
+
+    def get_usage(self, folder_id: str):
+        """Bytes and item counts below folder_id, like InfoCache.get_usage"""
+        top = self._row(folder_id)
+        per_folder: Dict[int, List[int]] = {}
+        per_type = defaultdict(lambda: [0, 0])
+        per_owner = defaultdict(lambda: [0, 0])
+        folder, mime, size, owner, parent = self._folder, self.mime, self.size, self.owner, self.parent
+
+        # backwards through the subtree's range, so children come before their parents
+        for row in range(self.end[top] - 1, top - 1, -1):
+            kind = mime[row]
+            if kind == folder:
+                bytes_below, items = per_folder.setdefault(row, [0, 0])
+            else:
+                bytes_below, items = max(size[row], 0), 0
+                per_type[kind][0] += bytes_below
+                per_owner[owner[row]][0] += bytes_below
+            per_type[kind][1] += 1
+            per_owner[owner[row]][1] += 1
+
+            if row != top:
+                totals = per_folder.setdefault(parent[row], [0, 0])
+                totals[0] += bytes_below
+                totals[1] += items + 1
+
+        return (
+            {self.ids[k]: v for k, v in per_folder.items()},
+            {self.mimes[k] or None: v for k, v in per_type.items()},
+            {self.owners[k] if k >= 0 else None: v for k, v in per_owner.items()},
+        )
+
+    ################################################################################
+    # Searches, with the signatures of SearchIndex's                               #
+    ################################################################################
+    def _paths(self, start: int, stop: int, base: str = "") -> Iterator[Tuple[str, str]]:
+        # paths of a range of whole subtrees, given the path of the parent of the first
+        names, end = self.names, self.end
+        stack = [(stop, base)]
+        for row in range(start, stop):
+            while row >= stack[-1][0]:
+                stack.pop()
+            path = stack[-1][1] + "/" + names[row]
+            yield path, self.ids[row]
+            if end[row] > row + 1:
+                stack.append((end[row], path))
+
+    def _with_paths(self, rows) -> List[Tuple[str, str]]:
+        return sorted((self.build_path(self.ids[x]), self.ids[x]) for x in rows)
+
+    def _find_folded(self, text: str, whole_prefix: bool) -> List[int]:
+        # search all lowercased names at once, then find the rows the hits fall in
+        needle = text.encode()
+        offsets = self.folded.offsets
+        base = self._offsets["folded"]
+        stop = base + offsets[self.count]
+        rows = []
+        position = self._map.find(needle, base, stop)
+        while position >= 0:
+            row = bisect.bisect_right(offsets, position - base) - 1
+            if position - base + len(needle) <= offsets[row + 1] and (
+                not whole_prefix or position - base == offsets[row]
+            ):
+                rows.append(row)
+                position = self._map.find(needle, base + offsets[row + 1], stop)
+            else:
+                position = self._map.find(needle, position + 1, stop)
+        return rows
+
+    def find_substring(self, text: str) -> List[Tuple[str, str]]:
+        text = text.lower()
+        if not text:
+            return self._with_paths(range(self.count))
+        return self._with_paths(self._find_folded(text, whole_prefix=False))
+
+    def find_prefix(self, prefix: str) -> List[Tuple[str, str]]:
+        if prefix.startswith("/"):
+            # walk down the complete components, then take the subtrees of the matching rows
+            *folders, last = prefix[1:].split("/")
+            level = [x for x in range(self.count) if self.parent[x] < 0]
+            for name in folders:
+                level = [child for row in level if self.names[row] == name for child in self.children(row)]
+
+            results: List[Tuple[str, str]] = []
+            for row in level:
+                if self.names[row].startswith(last):
+                    base = self.build_path(self.ids[row])[: -len(self.names[row]) - 1]
+                    results.extend(self._paths(row, self.end[row], base))
+            return sorted(results)
+
+        prefix = prefix.lower()
+        if not prefix:
+            return self._with_paths(range(self.count))
+        return self._with_paths(self._find_folded(prefix, whole_prefix=True))
+
+    def find_glob(self, pattern: str) -> List[Tuple[str, str]]:
+        if "/" in pattern:
+            # like SearchIndex, only scan the paths sharing the pattern's literal prefix
+            literal = GLOB_CHARS.split(pattern, 1)[0]
+            paths = self.find_prefix(literal) if literal.startswith("/") else self._paths(0, self.count)
+            return sorted(x for x in paths if fnmatch.fnmatchcase(x[0], pattern))
+
+        pattern = pattern.lower()
+        folded = self.folded
+        return self._with_paths(x for x in range(self.count) if fnmatch.fnmatchcase(folded[x], pattern))
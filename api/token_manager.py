@@ -0,0 +1,102 @@
+import asyncio
+import datetime
+import math
+import threading
+
+import google_auth_httplib2
+from google.auth import _helpers
+from google.auth.credentials import Credentials
+
+from api.metrics import METRICS
+from consts import logger
+
+# tokens are replaced this long before they expire, in the background when possible
+REFRESH_AHEAD = datetime.timedelta(minutes=5)
+# but no earlier than this much of their lifetime before, so short-lived tokens aren't
+# due again as soon as they arrive
+REFRESH_AHEAD_OF_LIFETIME = 1 / 4
+# wait before trying again after a background refresh failed
+REFRESH_RETRY_SECONDS = 10
+
+
+class TokenManager(Credentials):
+    """The access token of one account, shared by the Http objects of all its requests
+
+    Wraps the account's credentials. Once start() runs, a task swaps the token for a new one
+    REFRESH_AHEAD (or a quarter of its lifetime, if shorter) before it expires, so requests
+    don't wait on refreshes. A thread that still finds the token expired, or got a 401 with
+    it, waits for the one refresh in progress instead of making its own, and skips refreshing
+    if another thread already replaced the token it used.
+    """
+
+    def __init__(self, credentials, make_http, refresh_ahead: datetime.timedelta = REFRESH_AHEAD) -> None:
+        super().__init__()
+        self.credentials = credentials
+        self.refresh_ahead = refresh_ahead
+        # refresh_ahead, capped by the lifetime of the current token
+        self._ahead = refresh_ahead
+        # for refreshes in the background; request threads pass their own
+        self._request = google_auth_httplib2.Request(make_http())
+        self._lock = threading.Lock()
+        # the token each thread last sent, to tell whether a 401 was for the current one
+        self._sent = threading.local()
+        self._task = None
+
+    @property
+    def expired(self):
+        return self.expiry is not None and _helpers.utcnow() >= self.expiry - self._ahead / 2
+
+    def seconds_until_due(self) -> float:
+        if self.token is None:
+            return 0
+        if self.expiry is None:
+            return math.inf
+        return max(0.0, (self.expiry - self._ahead - _helpers.utcnow()).total_seconds())
+
+    def apply(self, headers, token=None):
+        self._sent.token = token or self.token
+        self.credentials.apply(headers, token=token or self.token)
+
+    def before_request(self, request, method, url, headers):
+        if not self.valid:
+            self._refresh(request, "expired")
+        self.apply(headers)
+
+    def refresh(self, request):
+        # called by AuthorizedHttp and batches, after a 401 or on finding the token invalid
+        self._refresh(request, "forced")
+
+    def _refresh(self, request, reason: str):
+        sent = getattr(self._sent, "token", None)
+        with self._lock:
+            if reason == "ahead":
+                if self.seconds_until_due() > 0:
+                    return
+            elif self.valid and self.token != sent:
+                # another thread refreshed while this one waited
+                return
+            self.credentials.refresh(request)
+            self.token, self.expiry = self.credentials.token, self.credentials.expiry
+            if self.expiry is not None:
+                lifetime = self.expiry - _helpers.utcnow()
+                self._ahead = min(self.refresh_ahead, lifetime * REFRESH_AHEAD_OF_LIFETIME)
+        METRICS.inc("gdrive_token_refreshes_total", reason=reason)
+        logger.debug(f"Refreshed access token ({reason}), valid until {self.expiry} UTC")
+
+    async def ensure_fresh(self):
+        """Refresh now unless the token is good for a while yet"""
+        if self.seconds_until_due() == 0:
+            await asyncio.get_running_loop().run_in_executor(None, self._refresh, self._request, "ahead")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._keep_fresh())
+
+    async def _keep_fresh(self):
+        while self.token is None or self.expiry is not None:
+            await asyncio.sleep(self.seconds_until_due())
+            try:
+                await self.ensure_fresh()
+            except Exception as e:
+                logger.warning(f"Refreshing the access token ahead of expiry failed: {e}")
+                await asyncio.sleep(REFRESH_RETRY_SECONDS)
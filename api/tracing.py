@@ -0,0 +1,153 @@
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+from typing import Dict, List, Optional
+
+FILE_ID_RE = re.compile(r"/files/([^/?]+)")
+
+
+def request_tags(req) -> Dict[str, str]:
+    # operation and file id, or the query for listings
+    tags = {"operation": getattr(req, "methodId", None) or "unknown"}
+    uri = getattr(req, "uri", "") or ""
+    match = FILE_ID_RE.search(uri)
+    if match:
+        tags["file_id"] = match.group(1)
+    query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(uri).query))
+    if "q" in query:
+        tags["q"] = query["q"]
+    return tags
+
+
+class RequestSpan:
+    """Lifecycle of one request: queued -> http (per attempt) -> resolve
+
+    Spans are Chrome trace async events sharing the request's id, so viewers nest them
+    under one track per request no matter which thread emitted them.
+    """
+
+    def __init__(self, tracer: "Tracer", span_id: int, tags: Dict[str, str]) -> None:
+        self.tracer = tracer
+        self.id = span_id
+        self.name = tags["operation"]
+        self.attempts = 0
+        tracer.emit("b", self.name, self.id, tags)
+        tracer.emit("b", "queued", self.id)
+
+    def sent(self, batch_id: int):
+        self.attempts += 1
+        self.tracer.emit("e", "queued", self.id)
+        self.tracer.emit("b", "http", self.id, {"batch": batch_id, "attempt": self.attempts})
+
+    def received(self, status: int):
+        self.tracer.emit("e", "http", self.id, {"status": status})
+
+    def requeued(self, reason):
+        self.tracer.emit("n", "retry", self.id, {"reason": str(reason)})
+        self.tracer.emit("b", "queued", self.id)
+
+    def hedged(self):
+        self.tracer.emit("n", "hedge", self.id)
+
+    def batch_failed(self, error: Exception):
+        # the whole batch broke and stays queued, without any callback
+        self.received(0)
+        self.requeued(type(error).__name__)
+
+    def callback_done(self):
+        self.tracer.emit("b", "resolve", self.id)
+
+    def resolved(self):
+        self.tracer.emit("e", "resolve", self.id)
+        self.tracer.emit("e", self.name, self.id, {"attempts": self.attempts})
+
+
+class Tracer:
+    """Collects sampled request spans and every batch, written as a Chrome trace JSON file
+
+    The file opens in Perfetto (ui.perfetto.dev) and chrome://tracing.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.events: List[dict] = []
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._batch_ids = itertools.count(1)
+        self._start = time.perf_counter()
+        self._pid = os.getpid()
+        # executor threads are gone by the time the trace is written, so remember their names
+        self._thread_names: Dict[int, str] = {}
+
+    def start(self, sample_rate: float = 1.0):
+        self.enabled = True
+        self.sample_rate = sample_rate
+        self._start = time.perf_counter()
+
+    def _ts(self, when: Optional[float] = None) -> float:
+        return round(((when or time.perf_counter()) - self._start) * 1e6, 1)
+
+    def _tid(self) -> int:
+        tid = threading.get_ident()
+        if tid not in self._thread_names:
+            self._thread_names[tid] = threading.current_thread().name
+        return tid
+
+    def emit(self, ph: str, name: str, span_id: int, args: Optional[dict] = None):
+        event = {
+            "ph": ph,
+            "name": name,
+            "cat": "request",
+            "id": span_id,
+            "ts": self._ts(),
+            "pid": self._pid,
+            "tid": self._tid(),
+        }
+        if ph == "n":
+            event["s"] = "t"
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.events.append(event)
+
+    def start_request(self, req) -> Optional[RequestSpan]:
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        return RequestSpan(self, next(self._ids), request_tags(req))
+
+    def next_batch_id(self) -> int:
+        return next(self._batch_ids)
+
+    def batch(self, batch_id: int, started: float, size: int, traced: int, queue: str):
+        if not self.enabled:
+            return
+        event = {
+            "ph": "X",
+            "name": "batch",
+            "cat": "batch",
+            "ts": self._ts(started),
+            "dur": self._ts() - self._ts(started),
+            "pid": self._pid,
+            "tid": self._tid(),
+            "args": {"batch": batch_id, "size": size, "traced": traced, "queue": queue},
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def dump(self, path: str):
+        with self._lock:
+            meta = [
+                {"ph": "M", "name": "thread_name", "pid": self._pid, "tid": tid, "args": {"name": name}}
+                for tid, name in self._thread_names.items()
+            ]
+            with open(path, "w") as f:
+                json.dump({"traceEvents": meta + self.events, "displayTimeUnit": "ms"}, f)
+
+
+TRACER = Tracer()
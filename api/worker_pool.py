@@ -0,0 +1,31 @@
+import asyncio
+from typing import Awaitable, Callable, Iterable, Optional
+
+from consts import MAX_OUTSTANDING_REQUESTS
+
+
+async def run_bounded(
+    func: Callable[..., Awaitable],
+    items: Iterable[tuple],
+    limit: int = MAX_OUTSTANDING_REQUESTS,
+    pbar=None,
+):
+    """Await func(*item) for every item, with at most limit calls in flight
+
+    Workers pull from one shared iterator, so coroutines and requests only exist for the
+    window being worked on, instead of for the whole job at once. Results are dropped.
+    """
+    it = iter(items)
+
+    async def worker():
+        for item in it:
+            await func(*item)
+            if pbar is not None:
+                pbar.update(1)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(max(1, limit))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for w in workers:
+            w.cancel()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from api.info_cache import InfoCache
+from api.snapshot import Snapshot, write_snapshot
+from bench.synthetic import SHAPES, make_tree
+from client.diff import GoogleDriveDiff
+from consts import FOLDER_TYPE
+
+OWNER = "bench@example.com"
+
+
+class Context:
+    """Two identical synthetic trees, root0 and root1, parsed into one cache"""
+
+    def __init__(self, num_files: int, shape: str) -> None:
+        self.items = []
+        for root_id in ["root0", "root1"]:
+            for item in make_tree(num_files, shape, root_id=root_id, owner=OWNER):
+                item["owners"] = [{"me": True, "emailAddress": item.pop("owner")}]
+                self.items.append(item)
+
+        self.cache = InfoCache(None)  # type: ignore
+        self.cache.file_info.update(self.cache.parse_files(*(dict(x) for x in self.items)))
+        self.folders = [k for k, v in self.cache.file_info.items() if v.get("mimeType") == FOLDER_TYPE]
+
+        # compare only needs the cache, skip connecting to the api
+        self.diff = GoogleDriveDiff.__new__(GoogleDriveDiff)
+        self.diff.cache = self.cache
+
+        self._tmp = tempfile.TemporaryDirectory()
+        self.snapshot_path = os.path.join(self._tmp.name, "cache.snap")
+        write_snapshot(self.cache, self.snapshot_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._tmp.cleanup()
+
+    def reset(self):
+        # drop derived indexes and memoized results, so every run measures the full work
+        self.cache._updated(())
+
+
+def op_parse_files(ctx: Context):
+    ctx.cache.parse_files(*(dict(x) for x in ctx.items))
+
+
+def op_children(ctx: Context):
+    for folder_id in ctx.folders:
+        for _ in ctx.cache.get_folder_children(folder_id):
+            pass
+
+
+def op_hierarchy(ctx: Context):
+    for _ in ctx.cache.get_files_in_hierarchy("root0"):
+        pass
+
+
+def op_build_path(ctx: Context):
+    for file_id in ctx.cache.file_info:
+        ctx.cache.build_path(file_id)
+
+
+def op_folder_size(ctx: Context):
+    ctx.cache.get_folder_size("root0")
+
+
+def op_orphans(ctx: Context):
+    for _ in ctx.cache.get_orphan_files():
+        pass
+
+
+def op_compare(ctx: Context):
+    info = ctx.cache.file_info
+    asyncio.run(ctx.diff.compare(("root0", info["root0"]), ("root1", info["root1"])))
+
+
+def op_snapshot_write(ctx: Context):
+    write_snapshot(ctx.cache, ctx.snapshot_path)
+
+
+def op_snapshot_usage(ctx: Context):
+    # opening included, it should cost next to nothing
+    with Snapshot(ctx.snapshot_path) as snapshot:
+        snapshot.get_usage("root0")
+
+
+OPS: Dict[str, Callable[[Context], None]] = {
+    "parse_files": op_parse_files,
+    "children": op_children,
+    "hierarchy": op_hierarchy,
+    "build_path": op_build_path,
+    "folder_size": op_folder_size,
+    "orphans": op_orphans,
+    "compare": op_compare,
+    "snapshot_write": op_snapshot_write,
+    "snapshot_usage": op_snapshot_usage,
+}
+
+
+def measure(ctx: Context, op: Callable[[Context], None], repeat: int) -> float:
+    # like timeit, keep collector pauses, which grow with the heap, out of the numbers
+    best = math.inf
+    for _ in range(repeat):
+        ctx.reset()
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            op(ctx)
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return best
+
+
+def scaling_exponent(sizes: List[int], times: List[float]) -> float:
+    """Least squares slope of log(time) over log(size): ~1 is linear, ~2 quadratic"""
+    xs = [math.log(x) for x in sizes]
+    ys = [math.log(max(y, 1e-9)) for y in times]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    num = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    den = sum((x - mean_x) ** 2 for x in xs)
+    return num / den if den else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for InfoCache traversals and diff on synthetic trees")
+    parser.add_argument("--sizes", help="Files per tree", type=int, nargs="+", default=[2_000, 8_000, 32_000])
+    parser.add_argument("--shapes", help="Shapes of the synthetic trees", choices=SHAPES, nargs="+", default=SHAPES)
+    parser.add_argument("--ops", help="Operations to measure", choices=list(OPS), nargs="+", default=list(OPS))
+    parser.add_argument("--repeat", help="Runs per measurement, the fastest counts", type=int, default=3)
+    parser.add_argument(
+        "--max-exponent",
+        help="Fail when an operation scales worse than size to this power",
+        type=float,
+        default=1.4,
+    )
+    parser.add_argument("--baseline", help="Fail when slower than the times in this JSON file by more than --threshold")
+    parser.add_argument("--threshold", help="Allowed slowdown against the baseline, as a factor", type=float, default=1.5)
+    parser.add_argument("--save-baseline", help="Write the measured times to this JSON file")
+    args = parser.parse_args()
+
+    sizes = sorted(args.sizes)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    failures = []
+
+    print("shape".ljust(10), "op".ljust(15), *(f"{n} ms".rjust(12) for n in sizes), "exponent".rjust(9))
+    for shape in args.shapes:
+        with contextlib.ExitStack() as stack:
+            contexts = [stack.enter_context(Context(n, shape)) for n in sizes]
+            results[shape] = {}
+            for name in args.ops:
+                times = [measure(ctx, OPS[name], args.repeat) for ctx in contexts]
+                results[shape][name] = {str(n): t for n, t in zip(sizes, times)}
+
+                exponent = scaling_exponent(sizes, times) if len(sizes) > 1 else 0.0
+                notes = []
+                if exponent > args.max_exponent:
+                    notes.append(f"scales as n^{exponent:.2f}")
+                for n, t in zip(sizes, times):
+                    before = baseline.get(shape, {}).get(name, {}).get(str(n))
+                    if before and t > before * args.threshold:
+                        notes.append(f"{t / before:.1f}x slower at {n}")
+                if notes:
+                    failures.append(f"{shape}/{name}: " + ", ".join(notes))
+
+                print(
+                    shape.ljust(10),
+                    name.ljust(15),
+                    *(f"{t * 1000:.2f}".rjust(12) for t in times),
+                    f"{exponent:.2f}".rjust(9),
+                    "REGRESSION" if notes else "",
+                )
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
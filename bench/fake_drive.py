@@ -0,0 +1,713 @@
+#!/usr/bin/env python3
+
+import argparse
+import base64
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple, Union
+
+import rsa
+from api.multipart import build_batch_response, parse_batch_request
+from bench.synthetic import SHAPES, make_tree
+from consts import FOLDER_TYPE, logger
+
+API_PREFIX = "/drive/v3/"
+BATCH_PATH = "/batch/drive/v3"
+UPLOAD_PREFIX = "/upload/drive/v3/"
+TOKEN_PATH = "/token"
+
+DEFAULT_QUOTA = 15 * 2**30
+PAGE_SIZE = 100
+# file contents repeat a block derived from their checksum, so copies have the same content
+CONTENT_BLOCK = 4096
+
+QUERY_CLAUSE = re.compile(r"'([^']*)' in (parents|owners)|trashed\s*=\s*(true|false)")
+
+
+class DriveError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+def parse_fields(mask: str) -> Optional[Dict]:
+    """Parse a partial response mask like "files(id,owners(me)),nextPageToken" into a tree"""
+    if not mask:
+        return None
+
+    root: Dict = {}
+    stack = [root]
+    name = ""
+    for char in mask + ",":
+        if char in ",()":
+            name = name.strip()
+            if name:
+                stack[-1][name] = None
+            if char == "(":
+                stack[-1][name] = {}
+                stack.append(stack[-1][name])
+            elif char == ")":
+                stack.pop()
+            name = ""
+        else:
+            name += char
+    return root
+
+
+def apply_fields(obj, mask: Optional[Dict]):
+    if mask is None:
+        return obj
+    if isinstance(obj, list):
+        return [apply_fields(x, mask) for x in obj]
+    return {k: apply_fields(obj[k], v) for k, v in mask.items() if k in obj}
+
+
+def content_block(seed: str) -> bytes:
+    digest = hashlib.sha256(seed.encode()).digest()
+    return (digest * (CONTENT_BLOCK // len(digest) + 1))[:CONTENT_BLOCK]
+
+
+def content(seed: str, start: int, stop: int) -> bytes:
+    """Bytes start to stop of the made up content of a file"""
+    block = content_block(seed)
+    offset = start % CONTENT_BLOCK
+    repeats = (offset + stop - start) // CONTENT_BLOCK + 1
+    return (block * repeats)[offset : offset + stop - start]
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    # only "bytes=START-END" and "bytes=START-", which is all the wrapper sends
+    if not header or not header.startswith("bytes="):
+        return None
+    start, _, end = header[len("bytes=") :].partition("-")
+    if int(start) >= size:
+        raise DriveError(416, "Request range not satisfiable.")
+    return int(start), min(int(end) + 1 if end else size, size)
+
+
+def write_service_account(path: str, email: str, token_uri: str):
+    """Write a service account secret whose tokens are issued by the fake server"""
+    _, private_key = rsa.newkeys(1024)
+    secret = {
+        "type": "service_account",
+        "project_id": "fake",
+        "private_key_id": "fake",
+        "private_key": private_key.save_pkcs1().decode(),
+        "client_email": email,
+        "client_id": "0",
+        "token_uri": token_uri,
+    }
+    with open(path, "w") as f:
+        json.dump(secret, f)
+
+
+class FakeDrive:
+    """In-memory stand-in for the parts of Drive v3 used by the wrapper
+
+    Every account sees every file; ownership only decides `owners[].me`, "'me' in owners"
+    queries and storage quota usage. File contents are made up on the fly, except for
+    uploaded ones, which are kept. With content_limit, sizes are capped at it and
+    md5Checksums are those of the contents, so downloads can be verified; otherwise the
+    synthetic checksums are kept.
+    """
+
+    def __init__(self, quota: int = DEFAULT_QUOTA, content_limit: Optional[int] = None) -> None:
+        self.lock = threading.Lock()
+        self.quota = quota
+        self.content_limit = content_limit
+
+        self.files: Dict[str, Dict] = {}
+        self.children: Dict[str, Dict[str, None]] = defaultdict(dict)
+        self.owned: Dict[str, Dict[str, None]] = defaultdict(dict)
+        self.usage: Dict[str, int] = defaultdict(int)
+
+        self._ids = itertools.count()
+        self._listings: Dict[str, List[str]] = {}
+        # ids of changed files in order; page tokens of the changes feed index into it
+        self.change_log: List[str] = []
+        # resumable upload sessions by upload id
+        self.uploads: Dict[str, Dict] = {}
+
+    def add_files(self, items: List[Dict]):
+        with self.lock:
+            for item in items:
+                self._insert(dict(item))
+
+    def _insert(self, item: Dict):
+        if self.content_limit is not None and "size" in item and "content" not in item and "data" not in item:
+            size = min(int(item["size"]), self.content_limit)
+            item["content"] = item.get("md5Checksum", item["id"])
+            item["size"] = str(size)
+            item["md5Checksum"] = hashlib.md5(content(item["content"], 0, size)).hexdigest()
+        self.files[item["id"]] = item
+        for parent in item.get("parents", []):
+            self.children[parent][item["id"]] = None
+        self.owned[item["owner"]][item["id"]] = None
+        self.usage[item["owner"]] += int(item.get("size", 0))
+        self.change_log.append(item["id"])
+
+    def _remove(self, file_id: str):
+        item = self.files.pop(file_id)
+        for parent in item.get("parents", []):
+            self.children[parent].pop(file_id, None)
+        self.owned[item["owner"]].pop(file_id, None)
+        self.usage[item["owner"]] -= int(item.get("size", 0))
+        self.change_log.append(file_id)
+
+    def _new_id(self) -> str:
+        return f"fake-{next(self._ids)}"
+
+    def _get(self, file_id: str) -> Dict:
+        if file_id not in self.files:
+            raise DriveError(404, f"File not found: {file_id}.")
+        return self.files[file_id]
+
+    def render(self, item: Dict, caller: str) -> Dict:
+        file = {k: v for k, v in item.items() if k not in ["owner", "content", "data"]}
+        file["kind"] = "drive#file"
+        file["owners"] = [
+            {
+                "kind": "drive#user",
+                "displayName": item["owner"].split("@")[0],
+                "photoLink": "https://lh3.googleusercontent.com/a/default-user=s64",
+                "me": item["owner"] == caller,
+                "permissionId": str(abs(hash(item["owner"]))),
+                "emailAddress": item["owner"],
+            }
+        ]
+        return file
+
+    ################################################################################
+    # Endpoints                                                                    #
+    ################################################################################
+    def handle(
+        self, method: str, path: str, query: Dict[str, str], body: str, caller: str, byte_range: Optional[str] = None
+    ) -> Tuple[int, Union[Dict, bytes, None]]:
+        parts = path[len(API_PREFIX) :].split("/")
+        media = len(parts) == 2 and query.get("alt") == "media"
+        if method == "GET" and parts[0] == "files" and (media or parts[2:] == ["export"]):
+            with self.lock:
+                item = dict(self._get(parts[1]))
+            # made up outside the lock, since that can take a while
+            return self.media(item, byte_range) if media else self.export(item, query)
+
+        body_json = json.loads(body) if body.strip() else {}
+        fields = parse_fields(query.get("fields", ""))
+
+        with self.lock:
+            if parts == ["about"] and method == "GET":
+                resp = self.about(caller)
+            elif parts == ["files"] and method == "GET":
+                return 200, self.list(query, caller, fields)
+            elif parts == ["files"] and method == "POST":
+                resp = self.create(body_json, caller)
+            elif len(parts) == 2 and parts[0] == "files" and method == "GET":
+                resp = self.render(self._get(parts[1]), caller)
+            elif len(parts) == 2 and parts[0] == "files" and method == "PATCH":
+                resp = self.update(parts[1], body_json, query, caller)
+            elif len(parts) == 2 and parts[0] == "files" and method == "DELETE":
+                self.delete(parts[1])
+                return 204, None
+            elif len(parts) == 3 and parts[0] == "files" and parts[2] == "copy" and method == "POST":
+                resp = self.copy(parts[1], body_json, caller)
+            elif parts == ["changes", "startPageToken"] and method == "GET":
+                resp = {"kind": "drive#startPageToken", "startPageToken": str(len(self.change_log))}
+            elif parts == ["changes"] and method == "GET":
+                return 200, self.list_changes(query, caller, fields)
+            else:
+                raise DriveError(404, f"Unknown endpoint: {method} {path}")
+
+        if fields is None and parts[0] == "files":
+            fields = parse_fields("kind,id,name,mimeType")
+        return 200, apply_fields(resp, fields)
+
+    def media(self, item: Dict, byte_range: Optional[str]) -> Tuple[int, bytes]:
+        if item["mimeType"].startswith("application/vnd.google-apps"):
+            raise DriveError(403, "Only files with binary content can be downloaded. Use Export with Docs Editors files.")
+        size = int(item.get("size", 0))
+        bounds = parse_range(byte_range, size)
+        start, stop = bounds or (0, size)
+        if "data" in item:
+            return 206 if bounds else 200, item["data"][start:stop]
+        return 206 if bounds else 200, content(item.get("content", item.get("md5Checksum", item["id"])), start, stop)
+
+    def export(self, item: Dict, query: Dict[str, str]) -> Tuple[int, bytes]:
+        if not item["mimeType"].startswith("application/vnd.google-apps") or item["mimeType"] == FOLDER_TYPE:
+            raise DriveError(403, "Export only supports Docs Editors files.")
+        return 200, f"{item['name']} ({item['id']}) exported as {query.get('mimeType')}\n".encode()
+
+    def start_upload(self, method: str, path: str, query: Dict[str, str], body: str, caller: str, mime_type: str) -> str:
+        """Open a resumable upload session for a new file (POST) or an existing one (PATCH)"""
+        parts = path[len(UPLOAD_PREFIX) :].split("/")
+        metadata = json.loads(body) if body.strip() else {}
+        metadata.setdefault("mimeType", mime_type)
+        with self.lock:
+            if parts == ["files"] and method == "POST":
+                file_id = None
+            elif len(parts) == 2 and parts[0] == "files" and method == "PATCH":
+                file_id = self._get(parts[1])["id"]
+            else:
+                raise DriveError(404, f"Unknown endpoint: {method} {path}")
+            upload_id = f"upload-{next(self._ids)}"
+            self.uploads[upload_id] = {
+                "file_id": file_id,
+                "metadata": metadata,
+                "fields": query.get("fields", ""),
+                "caller": caller,
+                "data": bytearray(),
+            }
+        return upload_id
+
+    def upload(self, upload_id: str, content_range: Optional[str], data: bytes) -> Tuple[int, Optional[Dict], int]:
+        """Take a chunk of an upload: 308 and the bytes received so far, or 200 and the file once all are in
+
+        content_range is "bytes START-END/TOTAL", or "bytes */TOTAL" to only ask for the
+        bytes received. Empty files are sent without one.
+        """
+        with self.lock:
+            session = self.uploads.get(upload_id)
+            if session is None:
+                raise DriveError(404, "Upload session not found.")
+            received = session["data"]
+            span, _, total = (content_range or "bytes */0").split(" ", 1)[-1].partition("/")
+            if span != "*":
+                start = int(span.partition("-")[0])
+                if start > len(received):
+                    raise DriveError(400, "Chunk doesn't continue the upload.")
+                # a chunk sent again after an error replaces what arrived of it
+                del received[start:]
+                received += data
+            if total == "*" or len(received) < int(total):
+                return 308, None, len(received)
+
+            file = self.finish_upload(session, bytes(received))
+            del self.uploads[upload_id]
+        fields = parse_fields(session["fields"] or "kind,id,name,mimeType")
+        return 200, apply_fields(file, fields), len(received)
+
+    def finish_upload(self, session: Dict, data: bytes) -> Dict:
+        caller = session["caller"]
+        metadata = session["metadata"]
+        old = self._get(session["file_id"]) if session["file_id"] else {}
+        if self.usage[caller] + len(data) - int(old.get("size", 0)) > self.quota:
+            raise DriveError(403, "The user's Drive storage quota has been exceeded.")
+
+        if old:
+            self._remove(old["id"])
+            item = {k: v for k, v in old.items() if k != "content"}
+            item.update({k: v for k, v in metadata.items() if k in ["name", "mimeType", "modifiedTime"]})
+        else:
+            now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+            item = {
+                "id": self._new_id(),
+                "name": metadata.get("name", "Untitled"),
+                "mimeType": metadata["mimeType"],
+                "parents": metadata.get("parents", ["drive-root"]),
+                "createdTime": metadata.get("createdTime", now),
+                "modifiedTime": metadata.get("modifiedTime", now),
+                "owner": caller,
+            }
+        item.update(data=data, size=str(len(data)), md5Checksum=hashlib.md5(data).hexdigest())
+        self._insert(item)
+        return self.render(item, caller)
+
+    def about(self, caller: str) -> Dict:
+        return {
+            "kind": "drive#about",
+            "storageQuota": {
+                "limit": str(self.quota),
+                "usage": str(self.usage[caller]),
+                "usageInDrive": str(self.usage[caller]),
+                "usageInDriveTrash": "0",
+            },
+            "user": {"kind": "drive#user", "me": True, "emailAddress": caller},
+        }
+
+    def list(self, query: Dict[str, str], caller: str, fields: Optional[Dict]) -> Dict:
+        page_size = int(query.get("pageSize", PAGE_SIZE))
+        token = query.get("pageToken")
+
+        if token:
+            listing_id, offset = token.rsplit(":", 1)
+            file_ids = self._listings[listing_id]
+            offset = int(offset)
+        else:
+            file_ids = self._query(query.get("q", ""), caller)
+            listing_id, offset = self._new_id(), 0
+            self._listings[listing_id] = file_ids
+
+        page = file_ids[offset : offset + page_size]
+        resp = {
+            "kind": "drive#fileList",
+            "incompleteSearch": False,
+            "files": [self.render(self.files[x], caller) for x in page if x in self.files],
+        }
+        if offset + page_size < len(file_ids):
+            resp["nextPageToken"] = f"{listing_id}:{offset + page_size}"
+        else:
+            self._listings.pop(listing_id, None)
+
+        return apply_fields(resp, fields or parse_fields("kind,incompleteSearch,nextPageToken,files(kind,id,name,mimeType)"))
+
+    def list_changes(self, query: Dict[str, str], caller: str, fields: Optional[Dict]) -> Dict:
+        # like Drive, a file changed several times in a page shows up once, in its latest state
+        page_size = int(query.get("pageSize", PAGE_SIZE))
+        start = int(query["pageToken"])
+        end = min(start + page_size, len(self.change_log))
+
+        changes = []
+        for file_id in dict.fromkeys(self.change_log[start:end]):
+            change = {"kind": "drive#change", "changeType": "file", "fileId": file_id}
+            if file_id in self.files:
+                change.update(removed=False, file=self.render(self.files[file_id], caller))
+            else:
+                change["removed"] = True
+            changes.append(change)
+
+        resp: Dict = {"kind": "drive#changeList", "changes": changes}
+        if end < len(self.change_log):
+            resp["nextPageToken"] = str(end)
+        else:
+            resp["newStartPageToken"] = str(end)
+        return apply_fields(resp, fields or parse_fields("kind,nextPageToken,newStartPageToken,changes(kind,fileId,removed)"))
+
+    def _query(self, q: str, caller: str) -> List[str]:
+        candidates = None
+        filters = []
+        for value, kind, trashed in QUERY_CLAUSE.findall(q):
+            if trashed:
+                continue
+            if kind == "parents":
+                ids = self.children.get(value, {})
+                filters.append(lambda x, v=value: v in self.files[x].get("parents", []))
+            else:
+                value = caller if value == "me" else value
+                ids = self.owned.get(value, {})
+                filters.append(lambda x, v=value: self.files[x]["owner"] == v)
+            if candidates is None or len(ids) < len(candidates):
+                candidates = ids
+
+        if candidates is None:
+            candidates = self.files
+        return [x for x in candidates if all(f(x) for f in filters)]
+
+    def create(self, body: Dict, caller: str) -> Dict:
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+        item = {
+            "id": self._new_id(),
+            "name": body.get("name", "Untitled"),
+            "mimeType": body.get("mimeType", "application/octet-stream"),
+            "parents": body.get("parents", ["drive-root"]),
+            "createdTime": body.get("createdTime", now),
+            "modifiedTime": body.get("modifiedTime", now),
+            "owner": caller,
+        }
+        if "shortcutDetails" in body:
+            item["shortcutDetails"] = body["shortcutDetails"]
+        self._insert(item)
+        return self.render(item, caller)
+
+    def copy(self, file_id: str, body: Dict, caller: str) -> Dict:
+        source = self._get(file_id)
+        if source["mimeType"] == FOLDER_TYPE:
+            raise DriveError(403, "Folders cannot be copied.")
+        if self.usage[caller] + int(source.get("size", 0)) > self.quota:
+            raise DriveError(403, "The user's Drive storage quota has been exceeded.")
+
+        item = dict(source, id=self._new_id(), owner=caller)
+        item.update({k: v for k, v in body.items() if k in ["name", "parents", "createdTime", "modifiedTime"]})
+        self._insert(item)
+        return self.render(item, caller)
+
+    def update(self, file_id: str, body: Dict, query: Dict[str, str], caller: str) -> Dict:
+        item = self._get(file_id)
+        self._remove(file_id)
+        item.update(body)
+        parents = [x for x in item.get("parents", []) if x not in query.get("removeParents", "").split(",")]
+        parents += [x for x in query.get("addParents", "").split(",") if x]
+        item["parents"] = parents
+        self._insert(item)
+        return self.render(item, caller)
+
+    def delete(self, file_id: str):
+        # deleting a folder deletes everything below it
+        stack = [self._get(file_id)["id"]]
+        while stack:
+            current = stack.pop()
+            stack.extend(self.children.pop(current, {}))
+            if current in self.files:
+                self._remove(current)
+
+
+class FakeDriveServer:
+    """Serve a FakeDrive over HTTP on localhost, with optional latency and error injection
+
+    Latency applies per HTTP request, so a batch costs as much as a single request. Errors
+    are injected per API request, so single parts of a batch can fail.
+    """
+
+    def __init__(
+        self,
+        drive: FakeDrive,
+        latency: float = 0,
+        jitter: float = 0,
+        stall_rate: float = 0,
+        stall: float = 0,
+        error_rate: float = 0,
+        error_codes=(429, 503),
+        token_lifetime: float = 3600,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ) -> None:
+        self.drive = drive
+        self.latency = latency
+        self.jitter = jitter
+        # a fraction of HTTP requests hangs for much longer, like a stuck backend would
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes)
+        # tokens are rejected once they expire, like real ones
+        self.token_lifetime = token_lifetime
+
+        self.stats: Counter = Counter()
+        self._stats_lock = threading.Lock()
+        self._rng = random.Random(0)
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.serve(self)
+
+            do_POST = do_PATCH = do_PUT = do_DELETE = do_GET
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    ################################################################################
+    # Request handling                                                             #
+    ################################################################################
+    def count(self, key: str):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def serve(self, handler: BaseHTTPRequestHandler):
+        self.count("http_requests")
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self._rng.random() * self.jitter)
+        if self.stall_rate and self._rng.random() < self.stall_rate:
+            self.count("stalls")
+            time.sleep(self.stall)
+
+        length = int(handler.headers.get("content-length", 0))
+        body = handler.rfile.read(length) if length else b""
+        path = urllib.parse.urlparse(handler.path).path
+        headers = {}
+
+        if path == TOKEN_PATH:
+            status, content_type, content = self.issue_token(body)
+        elif path == BATCH_PATH:
+            parts = parse_batch_request(handler.headers["content-type"], body)
+            self.count("batches")
+            results = [
+                (content_id, *self.dispatch(method, part_path, headers, part_body))
+                for content_id, method, part_path, headers, part_body in parts
+            ]
+            status = 200
+            content_type, content = build_batch_response(results)
+        elif path.startswith(UPLOAD_PREFIX):
+            status, headers, content = self.dispatch_upload(handler.command, handler.path, handler.headers, body)
+            content_type = "application/json; charset=UTF-8"
+        else:
+            status, content = self.dispatch(handler.command, handler.path, handler.headers, body.decode())
+            media = "alt=media" in handler.path and status < 300
+            content_type = "application/octet-stream" if media else "application/json; charset=UTF-8"
+
+        content = content or b""
+        with self._stats_lock:
+            self.stats["bytes_uncompressed"] += len(content)
+        # like Drive, only compress for user agents that ask for it, and not file contents
+        if (
+            "gzip" in handler.headers.get("accept-encoding", "")
+            and "gzip" in handler.headers.get("user-agent", "")
+            and content_type.startswith("application/json")
+        ):
+            content = gzip.compress(content, compresslevel=6)
+            encoding = "gzip"
+        else:
+            encoding = None
+        with self._stats_lock:
+            self.stats["bytes_sent"] += len(content)
+
+        try:
+            handler.send_response(status)
+            handler.send_header("Content-Type", content_type)
+            if encoding:
+                handler.send_header("Content-Encoding", encoding)
+            for k, v in headers.items():
+                handler.send_header(k, v)
+            handler.send_header("Content-Length", str(len(content)))
+            handler.end_headers()
+            handler.wfile.write(content)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up waiting, e.g. on a stalled request
+            self.count("client_gone")
+
+    def dispatch(self, method: str, path: str, headers, body: str) -> Tuple[int, Optional[bytes]]:
+        self.count("api_requests")
+        parsed = urllib.parse.urlparse(path)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+
+        try:
+            caller = self.authenticate(headers.get("authorization", ""))
+            if self.error_rate and self._rng.random() < self.error_rate:
+                raise DriveError(self._rng.choice(self.error_codes), "Injected error.")
+            status, resp = self.drive.handle(method, parsed.path, query, body, caller, headers.get("range"))
+        except DriveError as e:
+            status, resp = e.status, {"error": {"code": e.status, "message": str(e), "errors": []}}
+
+        self.count(f"{method} {status}")
+        if isinstance(resp, bytes):
+            self.count("media_requests")
+            return status, resp
+        return status, json.dumps(resp).encode() if resp is not None else None
+
+    def dispatch_upload(self, method: str, path: str, headers, body: bytes) -> Tuple[int, Dict[str, str], Optional[bytes]]:
+        """Resumable uploads: a POST or PATCH opens a session at the location it returns, PUTs send its chunks"""
+        self.count("api_requests")
+        parsed = urllib.parse.urlparse(path)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        extra: Dict[str, str] = {}
+        resp = None
+
+        try:
+            caller = self.authenticate(headers.get("authorization", ""))
+            if self.error_rate and self._rng.random() < self.error_rate:
+                raise DriveError(self._rng.choice(self.error_codes), "Injected error.")
+            if method == "PUT":
+                status, resp, received = self.drive.upload(query.get("upload_id", ""), headers.get("content-range"), body)
+                if status == 308 and received:
+                    extra["Range"] = f"bytes=0-{received - 1}"
+                with self._stats_lock:
+                    self.stats["bytes_uploaded"] += len(body)
+            else:
+                mime_type = headers.get("x-upload-content-type", "application/octet-stream")
+                upload_id = self.drive.start_upload(method, parsed.path, query, body.decode(), caller, mime_type)
+                status = 200
+                extra["Location"] = f"{self.url}{UPLOAD_PREFIX[1:]}files?uploadType=resumable&upload_id={upload_id}"
+        except DriveError as e:
+            status, resp = e.status, {"error": {"code": e.status, "message": str(e), "errors": []}}
+
+        self.count(f"{method} {status}")
+        return status, extra, json.dumps(resp).encode() if resp is not None else None
+
+    def authenticate(self, authorization: str) -> str:
+        token = authorization.split(" ", 1)[-1]
+        if not token.startswith("fake."):
+            raise DriveError(401, "Request had invalid authentication credentials.")
+        email, _, expires = token[len("fake.") :].partition(".")
+        if time.time() > float(expires):
+            self.count("expired_tokens")
+            raise DriveError(401, "Request had invalid authentication credentials.")
+        return base64.urlsafe_b64decode(email).decode()
+
+    def issue_token(self, body: bytes):
+        # the assertion is a JWT signed by the service account, whose issuer is its email
+        assertion = dict(urllib.parse.parse_qsl(body.decode()))["assertion"]
+        payload = assertion.split(".")[1]
+        email = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["iss"]
+        self.count("tokens_issued")
+        expires = time.time() + self.token_lifetime
+        token = {
+            "access_token": f"fake.{base64.urlsafe_b64encode(email.encode()).decode()}.{expires:.3f}",
+            "expires_in": self.token_lifetime,
+            "token_type": "Bearer",
+        }
+        return 200, "application/json", json.dumps(token).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake Google Drive API on localhost")
+    parser.add_argument("--port", help="Port to listen on", type=int, default=8089)
+    parser.add_argument("--files", help="Number of items in the synthetic tree", type=int, default=10_000)
+    parser.add_argument("--shape", help="Shape of the synthetic tree", choices=SHAPES, default="realistic")
+    parser.add_argument("--latency", help="Seconds added to every HTTP request", type=float, default=0)
+    parser.add_argument("--jitter", help="Maximum random seconds added on top of latency", type=float, default=0)
+    parser.add_argument("--stall-rate", help="Fraction of HTTP requests that stall", type=float, default=0)
+    parser.add_argument("--stall", help="Seconds a stalled HTTP request takes", type=float, default=10)
+    parser.add_argument("--error-rate", help="Fraction of API requests failing with 429/503", type=float, default=0)
+    parser.add_argument("--token-lifetime", help="Seconds access tokens are accepted for", type=float, default=3600)
+    parser.add_argument(
+        "--content-limit",
+        help="Cap file sizes at this many bytes and make checksums match the served contents, for downloads",
+        type=int,
+    )
+    parser.add_argument("--accounts", help="Number of service accounts to create", type=int, default=1)
+    parser.add_argument("--secrets", help="Directory to write service account secrets to", default="./fake-secrets")
+    args = parser.parse_args()
+
+    drive = FakeDrive(content_limit=args.content_limit)
+    drive.add_files(make_tree(args.files, args.shape))
+
+    server = FakeDriveServer(
+        drive,
+        latency=args.latency,
+        jitter=args.jitter,
+        stall_rate=args.stall_rate,
+        stall=args.stall,
+        error_rate=args.error_rate,
+        token_lifetime=args.token_lifetime,
+        port=args.port,
+    )
+
+    os.makedirs(args.secrets, exist_ok=True)
+    for i in range(args.accounts):
+        write_service_account(
+            os.path.join(args.secrets, f"account{i}.json"), f"account{i}@fake.iam.gserviceaccount.com", server.url + "token"
+        )
+
+    logger.info(f"Serving {args.files} files, root folder 'root0', at {server.url}")
+    logger.info(f"Use: ./gdrive.py -s {args.secrets} --endpoint {server.url} browse root0")
+    server.httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
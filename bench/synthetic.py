@@ -0,0 +1,87 @@
+import hashlib
+import random
+from typing import Dict, List, Tuple
+
+from consts import FOLDER_TYPE, SHORTCUT_TYPE
+
+SHAPES = ["wide", "deep", "realistic"]
+
+MIME_TYPES = [
+    "application/pdf",
+    "image/jpeg",
+    "text/plain",
+    "application/zip",
+    "application/vnd.google-apps.document",
+]
+
+
+def make_tree(
+    num_files: int,
+    shape: str = "realistic",
+    seed: int = 0,
+    root_id: str = "root0",
+    owner: str = "owner@example.com",
+) -> List[Dict]:
+    """Generate file metadata, shaped like files.list results, for a tree of num_files items
+
+    - wide: a handful of huge flat folders
+    - deep: one long chain of folders, each holding a few files
+    - realistic: random fan-out, some duplicated content and some shortcuts
+
+    The root folder, with id root_id, is the first item; its parent is not part of the tree.
+    """
+    rng = random.Random(seed)
+    items: List[Dict] = []
+    contents: List[Tuple[str, str]] = []
+
+    def add(parent, mime_type, **kwargs):
+        created = f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:00:00.000Z"
+        item = {
+            "id": f"{root_id}-{len(items)}" if items else root_id,
+            "name": f"item_{len(items)}",
+            "mimeType": mime_type,
+            "parents": [parent],
+            "createdTime": created,
+            "modifiedTime": created,
+            "owner": owner,
+        }
+        item.update(kwargs)
+        items.append(item)
+        return item["id"]
+
+    def add_file(parent):
+        mime_type = rng.choice(MIME_TYPES)
+        if mime_type.startswith("application/vnd.google-apps"):
+            # native docs have neither size nor checksum
+            return add(parent, mime_type)
+
+        if contents and rng.random() < 0.05:
+            size, md5 = rng.choice(contents)
+        else:
+            size = str(int(rng.lognormvariate(10, 3)) % 2**32)
+            md5 = hashlib.md5(f"{root_id}-{len(items)}".encode()).hexdigest()
+            contents.append((size, md5))
+        return add(parent, mime_type, size=size, md5Checksum=md5)
+
+    folders = [add("drive-root", FOLDER_TYPE, name=f"tree_{root_id}")]
+
+    if shape == "wide":
+        for _ in range(max(1, num_files // 100_000)):
+            folders.append(add(folders[0], FOLDER_TYPE))
+    elif shape == "deep":
+        for _ in range(min(200, max(1, num_files // 10))):
+            folders.append(add(folders[-1], FOLDER_TYPE))
+    else:
+        for _ in range(max(1, num_files // 20)):
+            # prefer recent folders, so the tree gets some depth
+            parent = folders[-1 - min(len(folders) - 1, int(rng.expovariate(0.05)))]
+            folders.append(add(parent, FOLDER_TYPE))
+
+    while len(items) < num_files:
+        parent = rng.choice(folders)
+        if shape == "realistic" and rng.random() < 0.01:
+            add(parent, SHORTCUT_TYPE, shortcutDetails={"targetId": rng.choice(folders)})
+        else:
+            add_file(parent)
+
+    return items
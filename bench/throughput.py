@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.fake_drive import FakeDrive, FakeDriveServer, write_service_account
+from bench.synthetic import SHAPES, make_tree
+from consts import logger
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ACCOUNT = "bench@fake.iam.gserviceaccount.com"
+
+# subcommand arguments and stdin per scenario; trees are "root0" and, for diff, "root1"
+SCENARIOS = {
+    "fetch": (["du", "root0", "--top", "1"], None),
+    "clone": (["clone", "root0", "drive-root", "--name", "bench_clone"], None),
+    "diff": (["diff", "root0", "root1"], None),
+    "delete": (["delete", "all"], "yes\n"),
+}
+
+
+def run_scenario(name: str, num_files: int, args) -> dict:
+    """Run one gdrive.py subcommand against a fresh fake drive and measure it
+
+    The client runs in its own process, so its peak RSS isn't polluted by the server or by
+    earlier runs.
+    """
+    drive = FakeDrive()
+    drive.add_files(make_tree(num_files, args.shape, root_id="root0", owner=ACCOUNT))
+    if name == "diff":
+        drive.add_files(make_tree(num_files, args.shape, seed=1, root_id="root1", owner=ACCOUNT))
+
+    with FakeDriveServer(drive, latency=args.latency, error_rate=args.error_rate) as server, tempfile.TemporaryDirectory() as secrets:
+        write_service_account(os.path.join(secrets, "bench.json"), ACCOUNT, server.url + "token")
+
+        subcommand, stdin = SCENARIOS[name]
+        command = [
+            sys.executable,
+            os.path.join(ROOT, "gdrive.py"),
+            "-q",
+            "-s",
+            secrets,
+            "--endpoint",
+            server.url,
+            "--request-interval",
+            str(args.request_interval),
+            *subcommand,
+        ]
+
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            command,
+            cwd=ROOT,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL if not args.show_output else None,
+        )
+        if stdin:
+            proc.stdin.write(stdin.encode())  # type: ignore
+        proc.stdin.close()  # type: ignore
+        # wait4 gives the rusage of this child only
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        wall = time.perf_counter() - start
+
+    return {
+        "scenario": name,
+        "files": num_files,
+        "shape": args.shape,
+        "exit_code": proc.returncode,
+        "wall_s": round(wall, 3),
+        "api_requests": server.stats["api_requests"],
+        "http_requests": server.stats["http_requests"],
+        "requests_per_s": round(server.stats["api_requests"] / wall, 1),
+        "peak_rss_mib": round(rusage.ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark against a fake Drive API")
+    parser.add_argument("--sizes", help="Tree sizes to run", type=int, nargs="+", default=[10_000])
+    parser.add_argument("--scenarios", help="Scenarios to run", choices=list(SCENARIOS), nargs="+", default=list(SCENARIOS))
+    parser.add_argument("--shape", help="Shape of the synthetic trees", choices=SHAPES, default="realistic")
+    parser.add_argument("--latency", help="Seconds added to every HTTP request", type=float, default=0.05)
+    parser.add_argument("--error-rate", help="Fraction of API requests failing with 429/503", type=float, default=0)
+    parser.add_argument(
+        "--request-interval",
+        help="Client pause between batches. 0 measures client overhead instead of pacing",
+        type=float,
+        default=0,
+    )
+    parser.add_argument("--json", help="Write results to this file as JSON")
+    parser.add_argument("--show-output", help="Show client logs", action="store_true")
+    args = parser.parse_args()
+
+    results = []
+    print(
+        "scenario".ljust(10),
+        "files".rjust(10),
+        "wall s".rjust(10),
+        "requests".rjust(10),
+        "req/s".rjust(10),
+        "peak MiB".rjust(10),
+        "exit".rjust(5),
+    )
+    for num_files in args.sizes:
+        for name in args.scenarios:
+            result = run_scenario(name, num_files, args)
+            results.append(result)
+            print(
+                name.ljust(10),
+                str(num_files).rjust(10),
+                f"{result['wall_s']:.2f}".rjust(10),
+                str(result["api_requests"]).rjust(10),
+                f"{result['requests_per_s']:.1f}".rjust(10),
+                f"{result['peak_rss_mib']:.1f}".rjust(10),
+                str(result["exit_code"]).rjust(5),
+            )
+            if result["exit_code"] != 0:
+                logger.warning(f"{name} at {num_files} files exited with {result['exit_code']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
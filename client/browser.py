@@ -18,8 +18,10 @@ class GoogleDriveBrowser(GoogleDriveClient):
     Only owner's files are shown. Only supports browsing, no file operations are performed.
     """
 
-    def __init__(self, args) -> None:
-        super().__init__(args)
+    FIELDS = {"createdTime", "modifiedTime", "size", "owners/me"}
+
+    def __init__(self, args, sessions=None) -> None:
+        super().__init__(args, sessions)
 
         self.copied_files = set()
         self.folders_copied = list()
@@ -81,7 +83,7 @@ class GoogleDriveBrowser(GoogleDriveClient):
                     logger.warning(f"{chosen_file_number}.  {fileinfo['name']} is not a folder")
 
     async def run(self, root: str = "root", orphans: bool = False):  # type: ignore
-        fields = {"createdTime", "modifiedTime"}
+        fields = self.FIELDS
 
         if root == "root":
             logger.info("Browsing files in root folder")
@@ -109,4 +111,4 @@ class GoogleDriveBrowser(GoogleDriveClient):
 
         for file_id, info in self.cache.get_orphan_files():
             logger.trace(f"Orphaned file: {file_id.ljust(80)}{info['name']}\t {info.get('parent', '')}")  # type: ignore
-            info["parent"] = root
+            self.cache.set_parent(file_id, root)
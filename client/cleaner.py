@@ -1,41 +1,77 @@
+from api.events import EVENTS
+from api.profiler import PROFILER
+from api.worker_pool import run_bounded
 from client.client import GoogleDriveClient
-from consts import logger
+from consts import FOLDER_TYPE, logger
 
 from tqdm.asyncio import tqdm
 
 
 class GoogleDriveCleaner(GoogleDriveClient):
+    FIELDS = {"size", "owners/me"}
+
     async def delete_own_files(self, file_ids, dry_run):
-        tasks = []
+        # callers like rotate may have fetched the files for something else
+        await self.cache.ensure_fields(file_ids, GoogleDriveCleaner.FIELDS)
+        to_delete = []
         for file_id in file_ids:
-            info = self.cache.file_info[file_id]
             if self.cache.is_owned_by_me(file_id):
-                logger.trace(f"will delete {info['name']} ({file_id})")
-                if not dry_run:
-                    tasks.append(self.api.delete_file(file_id))
+                to_delete.append((file_id,))
+            else:
+                EVENTS.emit("skipped", file_id, self.cache, reason="not owned")
+
+        # "all" passes folders along with everything below them, which is counted with its folder
+        deleting = {x for x, in to_delete}
+        freed = 0
+        for file_id, in to_delete:
+            if self.cache.ancestor_in(file_id, deleting) is not None:
+                continue
+            if self.cache.file_info[file_id].get("mimeType") == FOLDER_TYPE:
+                # what was fetched below it; targets of shortcuts inside aren't freed
+                freed += self.cache.get_usage(file_id)[0][file_id][0]
             else:
-                logger.trace(f"won't delete {info['name']} ({file_id}) not owned by me")
+                freed += int(self.cache.file_info[file_id].get("size", 0))
 
-        logger.info(f"deleting {len(tasks)} files")
+        if dry_run:
+            # folder contents go with their folder, but their sizes aren't always fetched
+            self.cost_plan.add_requests(self.email, "delete", len(to_delete))
+            self.cost_plan.add_quota(self.email, -freed)
+            for file_id, in to_delete:
+                EVENTS.emit("planned_delete", file_id, self.cache)
+            to_delete = []
 
-        await tqdm.gather(*tasks, miniters=1)
+        logger.info(f"deleting {len(to_delete)} files")
 
-    async def clean(self, *file_ids, dry_run=False):
+        async def delete(file_id):
+            # None if the request failed for good
+            deleted = await self.api.delete_file(file_id) is not None
+            EVENTS.emit("deleted" if deleted else "failed", file_id, self.cache)
+
+        with tqdm(total=len(to_delete), miniters=1) as pbar, PROFILER.phase("delete"):
+            await run_bounded(delete, to_delete, pbar=pbar)
+        # the cache may outlive this client, so don't leave deleted files in it
+        self.cache.remove(*(x for x, in to_delete))
+        return freed
+
+    async def clean(self, *file_ids, dry_run=False, owned=None) -> int:
+        """Delete own files among file_ids, returning the bytes freed"""
         if file_ids[0] == "all":
-            await self.delete_own_files(self.cache.file_info, dry_run=dry_run)
-        else:
-            await self.delete_own_files(file_ids, dry_run=dry_run)
+            return await self.delete_own_files(list(owned or ()), dry_run=dry_run)
+        return await self.delete_own_files(file_ids, dry_run=dry_run)
 
     async def run(self, *file_ids, dry_run=False):
+        owned = None
         if file_ids[0] == "all":
-            await self.cache.fetch("'me' in owners", shared=False)
+            with PROFILER.phase("fetch"):
+                owned = await self.cache.fetch("'me' in owners", shared=False, fields=self.FIELDS)
             if input("Are you sure you want to delete all files? (yes/no): ") != "yes":
                 return
         else:
-            await self.cache.fetch_files(*file_ids)
+            with PROFILER.phase("fetch"):
+                files = await self.cache.fetch_files(*file_ids, fields=self.FIELDS)
             print("Files to delete:")
             print(
-                "\n".join(f"{x}: {self.cache.file_info[x]['name']}" for x in file_ids)
+                "\n".join(f"{x}: {files[x]['name']}" if x in files else f"{x}: not found" for x in file_ids)
             )
 
             if (
@@ -44,4 +80,6 @@ class GoogleDriveCleaner(GoogleDriveClient):
             ):
                 return
 
-        await self.clean(*file_ids, dry_run=dry_run)
+        await self.clean(*file_ids, dry_run=dry_run, owned=owned)
+        if dry_run:
+            print(self.cost_plan.report())
@@ -1,77 +1,146 @@
-import json
+import asyncio
 import os
 import sys
+from typing import Dict, Optional, Set, Tuple
 
-from google.oauth2.service_account import Credentials
+from google.auth.credentials import AnonymousCredentials
 from api.api_wrapper import GoogleDriveApiWrapper
+from api.cassette import anonymize, is_anonymized, make_transport
+from api.credentials import ServiceAccounts
 from api.info_cache import InfoCache
+from api.request_batcher import parse_deadlines
+from client.cost_plan import CostPlan
 from consts import logger, SCOPES, CLIENT_SECRETS_FILE
-from google_auth_oauthlib.flow import InstalledAppFlow
 
 
 class GoogleDriveClient:
-    def __init__(self, args) -> None:
-        self.accounts = {}
+    # fields the client reads beyond api_wrapper.BASE_FIELDS; masks stay as narrow as that
+    FIELDS: Set[str] = set()
+
+    def __init__(self, args, sessions: Optional[Dict[str, Tuple[GoogleDriveApiWrapper, InfoCache]]] = None) -> None:
+        # owners in an anonymized cassette only match the accounts under the same hashes
+        self.accounts = ServiceAccounts(anonymize if args.replay and is_anonymized(args.replay) else None)
+        # api and cache per account; a daemon passes its own, so they outlive the client
+        self.sessions = {} if sessions is None else sessions
 
         self.email: str
         self.api: GoogleDriveApiWrapper
         self.cache: InfoCache
+        # storageQuota per account, asked for once per run
+        self.quotas: Dict[Optional[str], Dict] = {}
 
         self.oauth = args.oauth
+        # replayed traffic needs no tokens, and fetching them would go around the cassette
+        self.replaying = bool(args.replay)
+        self.api_options = {
+            "cache_ttl": args.cache_ttl,
+            "api_endpoint": args.endpoint,
+            "request_interval": args.request_interval,
+            "fast_batch_decoder": args.fast_batch_decoder,
+            "json_decoder": args.json_decoder,
+            "deadlines": parse_deadlines(args.deadline),
+            "hedge_percentile": args.hedge_percentile,
+            "transport": make_transport(args.record, args.replay, args.anonymize, args.replay_speed),
+        }
+        # what --dry-run would have cost, filled in by the clients that write
+        self.cost_plan = CostPlan(args.request_interval)
 
-        creds = self.authenticate(args)
-        self._set_secret_by_creds(creds)
-
-    def authenticate(self, args):
         if args.oauth:
-            credentials = self.authenticate_oauth()
+            if None in self.sessions:
+                self._use_session(None)
+            else:
+                self._set_secret(None, self.authenticate_oauth())
         else:
-            credentials = self.authenticate_service_account(args.secrets, args.account)
-        return credentials
+            self._set_secret_by_email(self.authenticate_service_account(args.secrets, args.account))
 
-    def set_creds_for_secret(self, secret):
-        with open(secret, "r") as f:
-            email = json.load(f)["client_email"]
-        creds = Credentials.from_service_account_file(secret, scopes=SCOPES)
-        self.accounts[email] = creds
-        return creds
-
-    def authenticate_service_account(self, secrets_dir, account_idx):
+    def authenticate_service_account(self, secrets_dir, account_idx) -> str:
+        """Register the secrets in secrets_dir and return the email of the selected account"""
         if os.path.isdir(secrets_dir):
             for file in (os.path.join(secrets_dir, x) for x in os.listdir(secrets_dir) if x.lower().endswith(".json")):
-                self.set_creds_for_secret(file)
+                self.accounts.add(file)
 
-            creds = sorted(self.accounts.items(), key=lambda x: x[0])[account_idx - 1][1]
+            email = sorted(self.accounts)[account_idx - 1]
 
         elif os.path.isfile(secrets_dir):
-            creds = self.set_creds_for_secret(secrets_dir)
+            email = self.accounts.add(secrets_dir)
         else:
             logger.error(f"Secrets file/dir not found: {secrets_dir}")
             sys.exit(1)
 
-        return creds
+        return email
 
     def authenticate_oauth(self):
+        # only needed for --oauth, and slow to import
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRETS_FILE, SCOPES)
         credentials = flow.run_local_server()
         return credentials
 
-    def _set_secret_by_creds(self, creds):
-        email = None
-        ls = [k for k, v in self.accounts.items() if v == creds]
-        if ls:
-            email = ls[0]
-        self._set_secret(email, creds)
-
     def _set_secret_by_email(self, email):
-        creds = self.accounts[email]
-        self._set_secret(email, creds)
+        self._open_session(email)
+        self._use_session(email)
 
     def _set_secret(self, email, creds):
+        self.sessions[email] = self._new_session(creds)
+        self._use_session(email)
+
+    def _open_session(self, email) -> Tuple[GoogleDriveApiWrapper, InfoCache]:
+        """The api and cache of email, set up on first use without switching to it"""
+        if email not in self.sessions:
+            # replays don't need the key parsed
+            self.sessions[email] = self._new_session(None if self.replaying else self.accounts[email])
+        return self.sessions[email]
+
+    def _new_session(self, creds) -> Tuple[GoogleDriveApiWrapper, InfoCache]:
+        api = GoogleDriveApiWrapper(AnonymousCredentials() if self.replaying else creds, **self.api_options)
+        return api, InfoCache(api)
+
+    def _use_session(self, email):
         self.email = email
-        self.api = GoogleDriveApiWrapper(creds)
-        self.cache = InfoCache(self.api)
+        self.api, self.cache = self.sessions[email]
         logger.info(f"Using account {self.email}")
 
+    async def refresh_tokens(self, emails=None):
+        """Get fresh tokens for the given accounts, all of them by default, concurrently"""
+        if emails is None:
+            emails = sorted(self.accounts) if self.accounts else [self.email]
+        apis = [self._open_session(x)[0] for x in emails]
+        await asyncio.gather(*(x.tokens.ensure_fresh() for x in apis if x.tokens is not None))
+
+    async def get_quotas(self, emails=None) -> Dict[Optional[str], Dict]:
+        """storageQuota of the given accounts, all of them by default
+
+        Accounts not asked yet in this run are asked concurrently. Ones that fail are logged
+        and left out.
+        """
+        if emails is None:
+            emails = sorted(self.accounts) if self.accounts else [self.email]
+        missing = [x for x in emails if x not in self.quotas]
+        abouts = await asyncio.gather(*(self._open_session(x)[0].get_about() for x in missing), return_exceptions=True)
+        for email, about in zip(missing, abouts):
+            if isinstance(about, Exception) or about is None:
+                logger.error(f"Getting the quota of {email} failed: {about}")
+            else:
+                self.quotas[email] = about["storageQuota"]
+        return {x: self.quotas[x] for x in emails if x in self.quotas}
+
+    async def fetch_tree(self, root: str, follow_shortcuts: bool = True) -> str:
+        """Fetch root and everything below it, returning the real id of root
+
+        For "root", all own files are listed at once, which is much faster than walking
+        the tree folder by folder.
+        """
+        if root == "root":
+            # resolve the alias, so children can be matched against the real id
+            root = (await self.api.get_file(root))["id"]
+            await self.cache.fetch("'me' in owners", shared=False, fields=self.FIELDS)
+            await self.cache.fetch_files(root, fields=self.FIELDS)
+        else:
+            await self.cache.fetch_folder_and_descendants(root, fields=self.FIELDS, follow_shortcuts=follow_shortcuts)
+
+        logger.info(f"Number of files fetched: {len(self.cache.file_info)}")
+        return root
+
     async def run(self, *args, **kwargs):
         raise NotImplementedError("run method not implemented")
@@ -1,14 +1,22 @@
 import asyncio
-from typing import Optional
+import math
+from typing import List, Optional, Sequence
 
+from api.events import EVENTS
+from api.profiler import PROFILER
+from api.worker_pool import run_bounded
 from client.client import GoogleDriveClient
-from consts import FOLDER_TYPE, logger
+from client.quota import free_space
+from consts import BATCH_SIZE, FOLDER_TYPE, logger
 from tqdm.asyncio import tqdm
 
 
 class GoogleDriveCloner(GoogleDriveClient):
-    def __init__(self, args) -> None:
-        super().__init__(args)
+    # times are copied over, so diff works
+    FIELDS = {"createdTime", "modifiedTime", "size"}
+
+    def __init__(self, args, sessions=None) -> None:
+        super().__init__(args, sessions)
         self.num_folders_to_copy = 0
         self.files_to_copy = []
 
@@ -30,7 +38,7 @@ class GoogleDriveCloner(GoogleDriveClient):
         item_info = self.cache.file_info[folder_id]
 
         if self.cache.is_ignored(item_info["name"]):
-            logger.trace(f"skipping {item_info['name']}")  # type: ignore
+            EVENTS.emit("skipped", folder_id, self.cache, reason="ignored")
             return None
 
         if folder_id in self.folders_copied:
@@ -54,7 +62,14 @@ class GoogleDriveCloner(GoogleDriveClient):
 
             if pbar:
                 pbar.update(1)
-            await self.log_item_copied(folder_id, len(self.folders_copied), self.num_folders_to_copy)
+            EVENTS.emit(
+                "planned_copy" if dry_run else "copied",
+                folder_id,
+                self.cache,
+                new_id=created_folder_id,
+                done=len(self.folders_copied),
+                total=self.num_folders_to_copy,
+            )
 
             results = []
             for file_id, file_info in self.cache.get_folder_children(folder_id):
@@ -72,7 +87,7 @@ class GoogleDriveCloner(GoogleDriveClient):
         item_info = self.cache.file_info[file_id]
 
         if self.cache.is_ignored(item_info["name"]):
-            logger.trace(f"skipping {item_info['name']}")  # type: ignore
+            EVENTS.emit("skipped", file_id, self.cache, reason="ignored")
             return None
 
         if file_id in self.files_copied:
@@ -87,37 +102,110 @@ class GoogleDriveCloner(GoogleDriveClient):
                     destination_parent_id=destination_parent_id,
                 )
             self.files_copied.add(file_id)
-            await self.log_item_copied(file_id, len(self.files_copied), len(self.files_to_copy))
+            EVENTS.emit(
+                "planned_copy" if dry_run else "copied" if new_file_id is not None else "failed",
+                file_id,
+                self.cache,
+                new_id=new_file_id["id"] if new_file_id else None,
+                done=len(self.files_copied),
+                total=len(self.files_to_copy),
+            )
             return new_file_id
 
-    async def log_item_copied(self, item_id, current, total):
-        logger.trace(f"Copied {self.cache.build_path(item_id).ljust(120)}" f" {item_id.ljust(40)} {current}/{total}")  # type: ignore
+    def folder_levels(self, *base_folder_ids: str):
+        """Number of folders to create per depth below base_folder_ids, bases included
+
+        A folder can only be created once its parent exists, so each level takes its own batches.
+        """
+        levels = []
+        level = list(base_folder_ids)
+        while level:
+            levels.append(len(level))
+            level = [
+                fid
+                for parent in level
+                for fid, info in self.cache.get_folder_children(parent, filter_ignored=True)
+                if info.get("mimeType") == FOLDER_TYPE
+            ]
+        return levels
+
+    def num_files_to_copy(self, *base_folder_ids: str) -> int:
+        """Number of files copy_folder_structure queues below base_folder_ids
+
+        Shortcuts are copied as shortcuts, so what they point to isn't, and nothing below an
+        ignored name is.
+        """
+        return sum(
+            1
+            for base in base_folder_ids
+            for fid in self.cache.iter_post_order(base, filter_ignored=True)
+            if fid != base and self.cache.file_info[fid].get("mimeType") != FOLDER_TYPE
+        )
+
+    def plan_clone(self, base_folder_ids: List[str], size_to_copy: int, free: int):
+        levels = self.folder_levels(*base_folder_ids)
+        if len(base_folder_ids) > 1:
+            # the folder holding them all
+            levels.insert(0, 1)
+        num_files = self.num_files_to_copy(*base_folder_ids)
+        self.cost_plan.add_requests(
+            self.email, "create", sum(levels), batches=sum(math.ceil(x / BATCH_SIZE) for x in levels)
+        )
+        self.cost_plan.add_requests(self.email, "copy", num_files)
+        self.cost_plan.add_quota(self.email, size_to_copy, free)
+
+    def distinct_sources(self, base_folder_ids: Sequence[str]) -> List[str]:
+        """base_folder_ids without repeats, and without those inside another one, which are copied along with it"""
+        sources = list(dict.fromkeys(base_folder_ids))
+        chosen = set(sources)
+        distinct = []
+        for folder_id in sources:
+            ancestor = self.cache.ancestor_in(folder_id, chosen)
+            if ancestor is not None:
+                logger.info(f"Source {folder_id} is inside source {ancestor}, copying it only as part of that")
+            else:
+                distinct.append(folder_id)
+        return distinct
 
     async def clone(
         self,
-        base_folder_id: str,
+        base_folder_ids: Sequence[str],
         destination_parent_folder_id: str,
         new_name: Optional[str] = None,
         dry_run: bool = False,
+        fetch: bool = True,
     ):
-        # fetch time to copy over, so diff works
-        fields = {"createdTime", "modifiedTime"}
-        await self.cache.fetch_folder_and_descendants(base_folder_id, fields=fields)
+        """Copy the base folders into destination_parent_folder_id in one go
+
+        One base folder is copied as new_name. Several are copied into a new folder named
+        new_name, side by side, and share the fetch, the batches and the pool of copies.
+        """
+        if fetch:
+            with PROFILER.phase("fetch"):
+                # shortcuts are copied as shortcuts, what they point to isn't needed
+                await self.cache.fetch_folder_and_descendants(
+                    *base_folder_ids, fields=self.FIELDS, follow_shortcuts=False
+                )
         num_files = len(self.cache.file_info)
         logger.info(f"Number of files fetched: {num_files}")
 
-        items_to_copy = list(self.cache.get_files_in_hierarchy(base_folder_id))
-        logger.info(f"Number of items to copy: {len(items_to_copy)}")
+        with PROFILER.phase("plan"):
+            base_folder_ids = self.distinct_sources(base_folder_ids)
+            items_to_copy = [x for fid in base_folder_ids for x in self.cache.get_files_in_hierarchy(fid)]
+            logger.info(f"Number of items to copy: {len(items_to_copy)}")
 
-        self.num_folders_to_copy = self.cache.get_num_folders(base_folder_id)
-        logger.info(f"Number of folders to copy: {self.num_folders_to_copy}")
+            self.num_folders_to_copy = sum(self.cache.get_num_folders(x) for x in base_folder_ids)
+            logger.info(f"Number of folders to copy: {self.num_folders_to_copy}")
 
-        size_to_copy = self.cache.get_folder_size(base_folder_id)
-        logger.info(f"Size to copy: {size_to_copy / 2 ** 30:.3f} GiB")
+            size_to_copy = sum(self.cache.get_folder_size(x) for x in base_folder_ids)
+            logger.info(f"Size to copy: {size_to_copy / 2 ** 30:.3f} GiB")
 
-        about = await self.api.get_about()
-        quota = about["storageQuota"]
-        free = int(quota["limit"]) - int(quota["usage"])
+        quota = (await self.get_quotas([self.email])).get(self.email)
+        if quota is None:
+            return
+        free = free_space(quota)
+        if dry_run:
+            self.plan_clone(base_folder_ids, size_to_copy, free)
         if size_to_copy > free:
             logger.error(
                 f"Insufficient space. Free: {free / 2 ** 30:.3f} GiB,"
@@ -133,26 +221,47 @@ class GoogleDriveCloner(GoogleDriveClient):
             maxinterval=1,
             unit="folders",
             colour="green",
-        ) as pbar:
-            await self.copy_folder_structure(base_folder_id, destination_parent_folder_id, new_name, pbar, dry_run)
+        ) as pbar, PROFILER.phase("create folders"):
+            if len(base_folder_ids) == 1:
+                await self.copy_folder_structure(
+                    base_folder_ids[0], destination_parent_folder_id, new_name, pbar, dry_run
+                )
+            else:
+                # new, unlike the copies inside, so rotation goes by when the backup was made
+                container_id = ""
+                if not dry_run:
+                    container = await self.api.create_folder(destination_parent_folder_id, new_name)
+                    if container is None:
+                        logger.error(f"Creating folder {new_name} failed. Exiting...")
+                        return
+                    container_id = container["id"]
+                await asyncio.gather(
+                    *(self.copy_folder_structure(x, container_id, pbar=pbar, dry_run=dry_run) for x in base_folder_ids)
+                )
 
-        tasks = [self.copy_file(x, y, dry_run=dry_run) for x, y in self.files_to_copy]
-        logger.info(f"Number of files to copy: {len(tasks)}")
+        logger.info(f"Number of files to copy: {len(self.files_to_copy)}")
         logger.info("Copying files...")
-        await tqdm.gather(
-            *tasks,
+        with tqdm(
+            total=len(self.files_to_copy),
             miniters=1,
             maxinterval=1,
             unit="files",
             colour="green",
-        )
+        ) as pbar, PROFILER.phase("copy files"):
+            await run_bounded(
+                lambda x, y: self.copy_file(x, y, dry_run=dry_run),
+                self.files_to_copy,
+                pbar=pbar,
+            )
         logger.info("Done")
 
     async def run(  # type: ignore
         self,
-        base_folder_id: str,
+        base_folder_ids: Sequence[str],
         destination_parent_folder_id: str,
         new_name: Optional[str] = None,
         dry_run: bool = False,
     ):
-        await self.clone(base_folder_id, destination_parent_folder_id, new_name, dry_run)
+        await self.clone(base_folder_ids, destination_parent_folder_id, new_name, dry_run)
+        if dry_run:
+            print(self.cost_plan.report())
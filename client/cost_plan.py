@@ -0,0 +1,77 @@
+import math
+from collections import Counter, defaultdict
+from typing import Dict, Optional
+
+from api.metrics import METRICS
+from consts import BATCH_SIZE
+
+# used when the run measured no batches of its own yet
+DEFAULT_BATCH_LATENCY = 1.0
+# mean of the jittered pause between batches, as a multiple of the request interval
+INTERVAL_JITTER = 1.5
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+class CostPlan:
+    """API calls, quota and time a run would take, collected instead of making writes on --dry-run
+
+    Batches of one account go out one at a time, each followed by the pause between requests,
+    so the predicted duration is batches * (pause + batch latency), with the latency measured
+    by this run's own reads so far.
+    """
+
+    def __init__(self, request_interval: float) -> None:
+        self.request_interval = request_interval
+        self.requests: Dict[str, Counter] = defaultdict(Counter)
+        self.batches: Counter = Counter()
+        self.quota: Counter = Counter()
+        self.free: Dict[str, int] = {}
+        self.extra_seconds = 0.0
+
+    def add_requests(self, account: Optional[str], kind: str, count: int, batches: Optional[int] = None):
+        account = account or "default"
+        self.requests[account][kind] += count
+        self.batches[account] += math.ceil(count / BATCH_SIZE) if batches is None else batches
+
+    def add_quota(self, account: Optional[str], size: int, free: Optional[int] = None):
+        account = account or "default"
+        self.quota[account] += size
+        if free is not None:
+            self.free[account] = free
+
+    def batch_latency(self) -> float:
+        batches = sum(METRICS.counters.get("gdrive_batches_total", {}).values())
+        if not batches:
+            return DEFAULT_BATCH_LATENCY
+        return METRICS.get("gdrive_in_flight_seconds_total") / batches
+
+    def estimate_seconds(self) -> float:
+        per_batch = self.request_interval * INTERVAL_JITTER + self.batch_latency()
+        return sum(self.batches.values()) * per_batch + self.extra_seconds
+
+    def report(self) -> str:
+        lines = ["Cost plan:"]
+        for account in sorted(set(self.requests) | set(self.quota)):
+            requests = self.requests[account]
+            lines.append(f"    {account}")
+            lines.append(
+                f"        requests: {sum(requests.values())} ("
+                + ", ".join(f"{v} {k}" for k, v in sorted(requests.items()))
+                + f") in {self.batches[account]} batches"
+            )
+            quota = f"        quota: {self.quota[account] / 2 ** 30:+.3f} GiB"
+            if account in self.free:
+                quota += f", free before: {self.free[account] / 2 ** 30:.3f} GiB"
+                if self.quota[account] > self.free[account]:
+                    quota += " (INSUFFICIENT)"
+            lines.append(quota)
+        lines.append(
+            f"    predicted duration: {format_duration(self.estimate_seconds())}"
+            f" ({self.request_interval:g}s interval, {self.batch_latency():.2f}s measured batch latency)"
+        )
+        return "\n".join(lines)
@@ -0,0 +1,176 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shlex
+import signal
+import socket
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from client.client import GoogleDriveClient
+from consts import logger
+
+# settings of the daemon itself, which commands sent to it can't change
+DAEMON_OPTIONS = [
+    "secrets",
+    "oauth",
+    "endpoint",
+    "cache_ttl",
+    "request_interval",
+    "fast_batch_decoder",
+    "json_decoder",
+    "deadline",
+    "hedge_percentile",
+]
+
+
+def parse_job(spec: str) -> Tuple[float, List[str]]:
+    """Split a job like "86400 rotate SOURCE DEST" into its interval in seconds and command"""
+    interval, command = spec.split(None, 1)
+    return float(interval), shlex.split(command)
+
+
+class GoogleDriveDaemon(GoogleDriveClient):
+    """Long-running process keeping one api and cache per account warm
+
+    A changes feed per account keeps every cache current, so folders listed once are
+    served from memory afterwards. Commands come from a Unix socket, one JSON line
+    {"argv": [...]} answered by {"status": int, "output": str}, or from scheduled jobs,
+    and run one at a time as regular clients sharing the daemon's sessions.
+    """
+
+    def __init__(self, args, parse: Callable) -> None:
+        super().__init__(args)
+        self.args = args
+        self.parse = parse
+        self.page_tokens: Dict[str, str] = {}
+        self.lock: asyncio.Lock
+
+    ################################################################################
+    # Cache sync                                                                   #
+    ################################################################################
+    async def sync(self, email):
+        api, cache = self.sessions[email]
+        if email not in self.page_tokens:
+            # changes from here on are applied, so listings made from now on stay current
+            self.page_tokens[email] = await api.get_start_page_token()
+            cache.synced = True
+            return
+
+        # ask for every field some listing was made with, so they don't go stale
+        fields = set().union(*cache.listed.values())
+        changes, self.page_tokens[email] = await api.fetch_changes(self.page_tokens[email], fields=fields)
+        if changes:
+            cache.apply_changes(changes, fields)
+            logger.debug(f"Applied {len(changes)} changes to the cache of {email}")
+
+    async def sync_all(self):
+        for email in list(self.sessions):
+            try:
+                await self.sync(email)
+            except Exception as e:
+                logger.error(f"Syncing the cache of {email} failed: {e}")
+
+    async def sync_forever(self, refresh: float):
+        while True:
+            await asyncio.sleep(refresh)
+            async with self.lock:
+                await self.sync_all()
+
+    ################################################################################
+    # Commands                                                                     #
+    ################################################################################
+    async def run_command(self, argv: List[str]) -> Tuple[int, str]:
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                args = self.parse(argv)
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 2, output.getvalue()
+
+        if not hasattr(args, "func") or getattr(args, "local_only", False):
+            return 2, f"Not a command the daemon can run: {shlex.join(argv)}\n"
+        for option in DAEMON_OPTIONS:
+            setattr(args, option, getattr(self.args, option))
+        # sessions already use the daemon's transport, and a new cassette would truncate its file
+        args.record = args.replay = None
+
+        async with self.lock:
+            # catch up on changes made since the last poll, e.g. by other programs
+            await self.sync_all()
+            with contextlib.redirect_stdout(output):
+                try:
+                    await args.func(args, self.sessions)
+                    status = 0
+                except Exception as e:
+                    logger.exception(f"Command failed: {shlex.join(argv)}")
+                    print(f"Error: {e}")
+                    status = 1
+        return status, output.getvalue()
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = json.loads(await reader.readline())
+            status, output = await self.run_command(request["argv"])
+            writer.write(json.dumps({"status": status, "output": output}).encode() + b"\n")
+            await writer.drain()
+        except (ValueError, KeyError, ConnectionError) as e:
+            logger.error(f"Bad request on daemon socket: {e}")
+        finally:
+            writer.close()
+
+    async def run_job(self, interval: float, argv: List[str]):
+        while True:
+            await asyncio.sleep(interval)
+            status, output = await self.run_command(argv)
+            # stdout is redirected while a command runs, this would end up in its output
+            async with self.lock:
+                print(output, end="", flush=True)
+            logger.info(f"Job '{shlex.join(argv)}' exited with status {status}, next run in {interval:g}s")
+
+    ################################################################################
+    # Main loop                                                                    #
+    ################################################################################
+    def _claim_socket(self, path: str):
+        if not os.path.exists(path):
+            return
+        with socket.socket(socket.AF_UNIX) as sock:
+            try:
+                sock.connect(path)
+            except ConnectionRefusedError:
+                # left behind by a daemon that didn't exit cleanly
+                os.unlink(path)
+                return
+        raise RuntimeError(f"Another daemon is listening on {path}")
+
+    async def run(self, socket_path: str, jobs: Sequence[str] = (), refresh: float = 60):  # type: ignore
+        self.lock = asyncio.Lock()
+        for email in sorted(self.accounts):
+            self._set_secret_by_email(email)
+        # then every account's first sync doesn't wait for a token
+        await self.refresh_tokens()
+        await self.sync_all()
+
+        tasks = [asyncio.ensure_future(self.sync_forever(refresh))]
+        for spec in jobs:
+            interval, argv = parse_job(spec)
+            tasks.append(asyncio.ensure_future(self.run_job(interval, argv)))
+
+        self._claim_socket(socket_path)
+        server = await asyncio.start_unix_server(self.serve, path=socket_path)
+        serving = asyncio.ensure_future(server.serve_forever())
+        # stop cleanly, removing the socket, on Ctrl-C and from service managers
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(sig, serving.cancel)
+
+        logger.info(f"Daemon listening on {socket_path} with {len(self.sessions)} accounts and {len(jobs)} jobs")
+        try:
+            with contextlib.suppress(asyncio.CancelledError):
+                await serving
+        finally:
+            for task in tasks:
+                task.cancel()
+            server.close()
+            os.unlink(socket_path)
+        logger.info("Daemon stopped")
@@ -1,4 +1,6 @@
+from collections import defaultdict
 from datetime import datetime
+from api.profiler import PROFILER
 from client.client import GoogleDriveClient
 from consts import FOLDER_TYPE, logger
 
@@ -12,9 +14,26 @@ def parse_time(time_str):
 
 
 class GoogleDriveDiff(GoogleDriveClient):
+    FIELDS = {"createdTime", "modifiedTime"}
+
     async def run(self, first, second):  # type: ignore
-        fields = {"createdTime", "modifiedTime"}
-        files = await self.cache.fetch_files(first, second, fields=fields)
+        with PROFILER.phase("fetch"):
+            await self.fetch_both(first, second)
+
+        info1 = self.cache.file_info[first]
+        info2 = self.cache.file_info[second]
+
+        # diff stuff
+        with PROFILER.phase("compare"):
+            res = await self.compare((first, info1), (second, info2))
+
+        with PROFILER.phase("print"):
+            self.print_diff(first, second, res)
+
+    async def fetch_both(self, first, second):
+        fields = self.FIELDS
+        # owners only matter for the two roots, to pick the accounts to list with
+        files = await self.cache.fetch_files(first, second, fields=fields | {"owners/emailAddress"})
 
         owners = {
             fid: owner.get("emailAddress")
@@ -41,14 +60,6 @@ class GoogleDriveDiff(GoogleDriveClient):
 
         print("total files fetched:", len(self.cache.file_info))
 
-        info1 = self.cache.file_info[first]
-        info2 = self.cache.file_info[second]
-
-        # diff stuff
-        res = await self.compare((first, info1), (second, info2))
-
-        self.print_diff(first, second, res)
-
     def print_diff(self, first, second, res):
         (new1, new2), (np1, np2) = res
         new1 = sorted((self.cache.build_path(fid, first), fid) for fid in new1)
@@ -86,12 +97,16 @@ class GoogleDriveDiff(GoogleDriveClient):
             paired2 = set()
             pairs = []
 
+            # group by the pairing key instead of comparing every child with every other one
+            by_key = defaultdict(list)
+            for fid2, info2 in children2:
+                by_key[self.pair_key(info2)].append((fid2, info2))
+
             for fid1, info1 in children1:
-                for fid2, info2 in children2:
-                    if self.are_paired(info1, info2):
-                        pairs.append((fid1, info1, fid2, info2))
-                        paired1.add(fid1)
-                        paired2.add(fid2)
+                for fid2, info2 in by_key.get(self.pair_key(info1), []):
+                    pairs.append((fid1, info1, fid2, info2))
+                    paired1.add(fid1)
+                    paired2.add(fid2)
 
             not_paired1 = set(x[0] for x in children1) - paired1
             not_paired2 = set(x[0] for x in children2) - paired2
@@ -102,8 +117,8 @@ class GoogleDriveDiff(GoogleDriveClient):
                 acc1.extend(new1)
                 acc2.extend(new2)
 
-                not_paired1 = not_paired1.union(np1)
-                not_paired2 = not_paired2.union(np2)
+                not_paired1.update(np1)
+                not_paired2.update(np2)
 
             return (acc1, acc2), (not_paired1, not_paired2)
 
@@ -117,8 +132,11 @@ class GoogleDriveDiff(GoogleDriveClient):
             else:
                 return ([], []), ([], [])
 
+    def pair_key(self, info):
+        return tuple(info.get(k) for k in PAIR_FIELDS)
+
     def are_paired(self, info1, info2):
-        return all(info1.get(k) == info2.get(k) for k in PAIR_FIELDS)
+        return self.pair_key(info1) == self.pair_key(info2)
 
     def compare_files(self, first, info1, second, info2) -> int:
         """
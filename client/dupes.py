@@ -0,0 +1,60 @@
+from api.events import EVENTS
+from api.worker_pool import run_bounded
+from client.client import GoogleDriveClient
+from consts import logger
+
+from tqdm.asyncio import tqdm
+
+
+class GoogleDriveDupes(GoogleDriveClient):
+    """Find files with identical content below a folder
+
+    Optionally replaces redundant copies owned by the current account with shortcuts to the
+    copy that is kept, which is the one with the lexicographically smallest path.
+    """
+
+    FIELDS = {"size", "md5Checksum", "owners/me"}
+
+    async def replace_with_shortcut(self, file_id: str, keep_id: str):
+        info = self.cache.file_info[file_id]
+        shortcut = await self.api.create_shortcut(keep_id, info.get("parent"), name=info["name"])
+        # only delete the copy once the shortcut replacing it exists
+        if shortcut is None:
+            EVENTS.emit("failed", file_id, self.cache)
+            return
+        # None if the request failed for good, which leaves the copy next to its shortcut
+        deleted = await self.api.delete_file(file_id) is not None
+        if deleted:
+            EVENTS.emit("replaced", file_id, self.cache, shortcut_to=keep_id)
+        else:
+            EVENTS.emit("failed", file_id, self.cache)
+
+    async def run(self, root: str = "root", link: bool = False, min_size: int = 1, dry_run: bool = False):  # type: ignore
+        root = await self.fetch_tree(root)
+
+        groups = self.cache.get_duplicates(root, min_size=min_size)
+        groups.sort(key=lambda x: x[0] * (len(x[2]) - 1), reverse=True)
+
+        wasted = 0
+        to_replace = []
+        for size, md5, file_ids in groups:
+            paths = sorted((self.cache.build_path(fid, root), fid) for fid in file_ids)
+            group_wasted = size * (len(file_ids) - 1)
+            wasted += group_wasted
+
+            print(f"{len(file_ids)} copies of {size / 2 ** 20:.3f} MiB, {group_wasted / 2 ** 20:.3f} MiB wasted (md5 {md5})")
+            for path, fid in paths:
+                print("   ", path.ljust(120), f"({fid})")
+
+            keep_id = paths[0][1]
+            for _, fid in paths[1:]:
+                if link and self.cache.is_owned_by_me(fid):
+                    to_replace.append((fid, keep_id))
+
+        print(f"\n{len(groups)} duplicate groups, {wasted / 2 ** 30:.3f} GiB wasted")
+
+        if link:
+            logger.info(f"Replacing {len(to_replace)} own copies with shortcuts")
+            if not dry_run:
+                with tqdm(total=len(to_replace), miniters=1, unit="files", colour="green") as pbar:
+                    await run_bounded(self.replace_with_shortcut, to_replace, pbar=pbar)
@@ -0,0 +1,47 @@
+import time
+
+from api.snapshot import Snapshot
+from client.client import GoogleDriveClient
+from consts import logger
+
+
+def print_matches(index, query: str, mode: str = "substring", limit: int = 0):
+    """Print matches from a SearchIndex or a Snapshot"""
+    start = time.perf_counter()
+    if mode == "prefix":
+        results = index.find_prefix(query)
+    elif mode == "glob":
+        results = index.find_glob(query)
+    else:
+        results = index.find_substring(query)
+    logger.info(f"Found {len(results)} matches in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    for path, fid in results[:limit] if limit else results:
+        print(path.ljust(120), f"({fid})")
+
+
+async def print_snapshot_matches(path: str, query: str, mode: str = "substring", limit: int = 0):
+    with Snapshot(path) as snapshot:
+        logger.info(f"Number of files in snapshot: {len(snapshot)}")
+        print_matches(snapshot, query, mode, limit)
+
+
+class GoogleDriveFinder(GoogleDriveClient):
+    """Find files by name or path
+
+    Queries run against the in-memory search index of the cache, so only the initial fetch
+    talks to the API.
+    """
+
+    async def run(self, query: str, root: str = "root", mode: str = "substring", limit: int = 0):  # type: ignore
+        if root == "root":
+            await self.cache.fetch("'me' in owners", shared=False)
+        else:
+            await self.cache.fetch_folder_and_descendants(root)
+
+        logger.info(f"Number of files in GDrive: {len(self.cache.file_info)}")
+
+        start = time.perf_counter()
+        index = self.cache.search_index
+        logger.debug(f"Built search index in {(time.perf_counter() - start) * 1000:.1f} ms")
+        print_matches(index, query, mode, limit)
@@ -0,0 +1,301 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from api.events import EVENTS
+from api.metrics import METRICS
+from api.profiler import PROFILER
+from api.worker_pool import run_bounded
+from client.client import GoogleDriveClient
+from consts import FOLDER_TYPE, SHORTCUT_TYPE, logger
+from tqdm.asyncio import tqdm
+
+# Google Docs files have no content of their own, so they are exported as these
+EXPORT_FORMATS = {
+    "application/vnd.google-apps.document": (
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        ".docx",
+    ),
+    "application/vnd.google-apps.spreadsheet": (
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        ".xlsx",
+    ),
+    "application/vnd.google-apps.presentation": (
+        "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+        ".pptx",
+    ),
+    "application/vnd.google-apps.drawing": ("image/svg+xml", ".svg"),
+    "application/vnd.google-apps.script": ("application/vnd.google-apps.script+json", ".json"),
+    "application/vnd.google-apps.jam": ("application/pdf", ".pdf"),
+}
+CHUNK_SIZE = 16 * 2**20
+WORKERS = 8
+# downloads in progress are kept next to their destination under this suffix, and
+# downloads of more than one chunk the chunks they have under this one plus .json
+PARTIAL_SUFFIX = ".partial"
+
+
+def local_name(name: str) -> str:
+    name = name.replace("/", "_").replace("\0", "_")
+    return name if name.strip(".") else name.replace(".", "_") or "_"
+
+
+def mtime_of(timestamp: str) -> float:
+    return datetime.fromisoformat(timestamp).timestamp()
+
+
+def md5_of(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def is_current(path: str, file: Dict, exported: bool, checksum: bool) -> bool:
+    """Whether path already holds file, judging by size, modification time and md5
+
+    Files whose size and time match aren't read, unless checksum is set. Exports have
+    neither size nor md5, so only their time counts.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+
+    mtime = mtime_of(file["modifiedTime"]) if "modifiedTime" in file else None
+    same_time = mtime is not None and abs(stat.st_mtime - mtime) < 1
+    if exported:
+        return same_time
+    if stat.st_size != int(file.get("size", 0)):
+        return False
+    if same_time and not checksum:
+        return True
+    if "md5Checksum" not in file:
+        return same_time
+    if md5_of(path) != file["md5Checksum"]:
+        return False
+    if mtime is not None and not same_time:
+        # the content is right, only the time is off
+        os.utime(path, (mtime, mtime))
+    return True
+
+
+def load_chunks(partial: str, state: Dict) -> Set[int]:
+    """Chunks of an earlier attempt at the same download, or none if it was of something else"""
+    try:
+        with open(partial + ".json") as f:
+            saved = json.load(f)
+        if os.path.exists(partial) and {k: v for k, v in saved.items() if k != "done"} == state:
+            return set(saved["done"])
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+    with open(partial, "wb"):
+        pass
+    return set()
+
+
+def save_chunks(partial: str, state: Dict, done: Set[int]):
+    with open(partial + ".json.tmp", "w") as f:
+        json.dump(dict(state, done=sorted(done)), f)
+    os.replace(partial + ".json.tmp", partial + ".json")
+
+
+class GoogleDriveMirror(GoogleDriveClient):
+    """Download a folder tree to a local directory, transferring only files that changed
+
+    Files are fetched in byte ranges of chunk_size, with at most workers ranges in flight,
+    so large files download in parallel too. Interrupted downloads resume from the chunks
+    they have.
+    """
+
+    FIELDS = {"size", "modifiedTime", "md5Checksum"}
+
+    def __init__(self, args, sessions=None) -> None:
+        super().__init__(args, sessions)
+        self.transfers: Optional[asyncio.Semaphore] = None
+        self.pbar = None
+        self.counts: Dict[str, int] = {"downloaded": 0, "up to date": 0, "failed": 0}
+        self.bytes_downloaded = 0
+
+    def plan(self, root: str, destination: str) -> Tuple[List[str], List[Tuple[str, str, Optional[Tuple[str, str]]]]]:
+        """Local folders to create, and file id, local path and export format of every file
+
+        Names that can't be file names are changed, and files with the same name in a folder
+        after the first get their id added.
+        """
+        folders = [destination]
+        files = []
+        stack = [(root, destination)]
+        while stack:
+            folder_id, local_folder = stack.pop()
+            taken: Set[str] = set()
+            for file_id, file in self.cache.get_folder_children(folder_id):
+                mime_type = file.get("mimeType", "")
+                export = EXPORT_FORMATS.get(mime_type)
+                if self.cache.is_ignored(file.get("name")):
+                    EVENTS.emit("skipped", file_id, self.cache, reason="ignored")
+                    continue
+                if mime_type == SHORTCUT_TYPE:
+                    EVENTS.emit("skipped", file_id, self.cache, reason="shortcut")
+                    continue
+                if mime_type.startswith("application/vnd.google-apps") and mime_type != FOLDER_TYPE and not export:
+                    EVENTS.emit("skipped", file_id, self.cache, reason="not exportable")
+                    continue
+
+                name = local_name(file.get("name", ""))
+                if export and not name.endswith(export[1]):
+                    name += export[1]
+                if name in taken:
+                    stem, extension = os.path.splitext(name)
+                    name = f"{stem} ({file_id}){extension}"
+                taken.add(name)
+
+                path = os.path.join(local_folder, name)
+                if mime_type == FOLDER_TYPE:
+                    folders.append(path)
+                    stack.append((file_id, path))
+                else:
+                    files.append((file_id, path, export))
+        return folders, files
+
+    async def download(self, file_id: str, path: str, file: Dict, chunk_size: int) -> bool:
+        loop = asyncio.get_running_loop()
+        size = int(file.get("size", 0))
+        partial = path + PARTIAL_SUFFIX
+        chunks = [(x, min(x + chunk_size, size)) for x in range(0, size, chunk_size)]
+        state = {"id": file_id, "size": size, "md5Checksum": file.get("md5Checksum"), "chunkSize": chunk_size}
+        resumable = len(chunks) > 1
+        done = await loop.run_in_executor(None, load_chunks, partial, state) if resumable else set()
+        if done:
+            logger.debug(f"Resuming {path} with {len(done)} of {len(chunks)} chunks")
+            self.pbar.update(sum(chunks[x][1] - chunks[x][0] for x in done))
+
+        async def fetch(index: int) -> bool:
+            start, stop = chunks[index]
+            async with self.transfers:
+                data = await (self.api.download(file_id, start, stop - 1) if resumable else self.api.download(file_id))
+            if data is None or len(data) != stop - start:
+                return False
+            await loop.run_in_executor(None, os.pwrite, fd, data, start)
+            METRICS.inc("gdrive_download_bytes_total", len(data))
+            self.bytes_downloaded += len(data)
+            self.pbar.update(len(data))
+            if resumable:
+                done.add(index)
+                save_chunks(partial, state, done)
+            return True
+
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT | (0 if resumable else os.O_TRUNC))
+        try:
+            results = await asyncio.gather(*(fetch(x) for x in range(len(chunks)) if x not in done))
+        finally:
+            os.close(fd)
+        if not all(results):
+            # what did arrive is kept for the next attempt
+            return False
+
+        ok = "md5Checksum" not in file or await loop.run_in_executor(None, md5_of, partial) == file["md5Checksum"]
+        if ok:
+            self.finish(partial, path, file)
+        else:
+            logger.error(f"Checksum of {path} doesn't match, discarding it")
+            os.remove(partial)
+        # also left behind by attempts with another chunk size
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(partial + ".json")
+        return ok
+
+    async def export(self, file_id: str, path: str, file: Dict, mime_type: str) -> bool:
+        async with self.transfers:
+            data = await self.api.export(file_id, mime_type)
+        if data is None:
+            return False
+        partial = path + PARTIAL_SUFFIX
+        with open(partial, "wb") as f:
+            f.write(data)
+        METRICS.inc("gdrive_download_bytes_total", len(data))
+        self.bytes_downloaded += len(data)
+        self.finish(partial, path, file)
+        return True
+
+    def finish(self, partial: str, path: str, file: Dict):
+        if "modifiedTime" in file:
+            mtime = mtime_of(file["modifiedTime"])
+            os.utime(partial, (mtime, mtime))
+        os.replace(partial, path)
+
+    async def mirror_file(
+        self,
+        file_id: str,
+        path: str,
+        export: Optional[Tuple[str, str]],
+        chunk_size: int = CHUNK_SIZE,
+        checksum: bool = False,
+        dry_run: bool = False,
+    ):
+        file = self.cache.file_info[file_id]
+        size = 0 if export else int(file.get("size", 0))
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, is_current, path, file, export is not None, checksum):
+            self.counts["up to date"] += 1
+            self.pbar.update(size)
+            EVENTS.emit("skipped", file_id, self.cache, reason="up to date", path=path)
+            return
+
+        if dry_run:
+            self.counts["downloaded"] += 1
+            self.bytes_downloaded += size
+            self.pbar.update(size)
+            EVENTS.emit("planned_download", file_id, self.cache, local=path, size=size)
+            return
+
+        if export:
+            ok = await self.export(file_id, path, file, export[0])
+        else:
+            ok = await self.download(file_id, path, file, chunk_size)
+        self.counts["downloaded" if ok else "failed"] += 1
+        EVENTS.emit("downloaded" if ok else "failed", file_id, self.cache, local=path, size=size)
+
+    async def run(  # type: ignore
+        self,
+        root: str,
+        destination: str,
+        workers: int = WORKERS,
+        chunk_size: int = CHUNK_SIZE,
+        checksum: bool = False,
+        dry_run: bool = False,
+    ):
+        with PROFILER.phase("fetch"):
+            root = await self.fetch_tree(root)
+
+        with PROFILER.phase("plan"):
+            folders, files = self.plan(root, os.path.abspath(destination))
+            total = sum(int(self.cache.file_info[x].get("size", 0)) for x, _, export in files if not export)
+            logger.info(f"Mirroring {len(files)} files in {len(folders)} folders, {total / 2 ** 30:.3f} GiB")
+
+        if not dry_run:
+            for folder in folders:
+                os.makedirs(folder, exist_ok=True)
+
+        loop = asyncio.get_running_loop()
+        # every transfer, and every checksum, holds an executor thread while it runs
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=max(workers + 4, min(32, (os.cpu_count() or 1) + 4))))
+        self.transfers = asyncio.Semaphore(workers)
+        with tqdm(total=total, unit="B", unit_scale=True, colour="green") as self.pbar, PROFILER.phase("download"):
+            await run_bounded(
+                lambda x, y, z: self.mirror_file(x, y, z, chunk_size=chunk_size, checksum=checksum, dry_run=dry_run),
+                files,
+                limit=workers,
+            )
+
+        verb = "Would download" if dry_run else "Downloaded"
+        logger.info(
+            f"{verb} {self.counts['downloaded']} files, {self.bytes_downloaded / 2 ** 30:.3f} GiB."
+            f" {self.counts['up to date']} up to date, {self.counts['failed']} failed"
+        )
@@ -1,13 +1,36 @@
+import math
+
 from client.client import GoogleDriveClient
 
+QUOTA_COLUMNS = ["limit", "usage", "usageInDrive", "usageInDriveTrash", "free"]
+
+
+def free_space(storage_quota) -> float:
+    # accounts with unlimited storage report no limit
+    if "limit" not in storage_quota:
+        return math.inf
+    return int(storage_quota["limit"]) - int(storage_quota["usage"])
+
 
-def format_storage_quota(storage_quota) -> str:
-    return "\n".join(
-        f"{str(k.ljust(30))}: {int(v) / 2 ** 30:.3f} GiB"
-        for k, v in storage_quota["storageQuota"].items()
-    )
+def format_quota_line(label: str, values) -> str:
+    return f"    {label.ljust(60)}" + "".join(str(x).rjust(20) for x in values)
+
+
+def format_fleet_quota(quotas) -> str:
+    """One row per account with its storageQuota in GiB, and their total"""
+    lines = [format_quota_line("account", QUOTA_COLUMNS)]
+    totals = [0.0] * len(QUOTA_COLUMNS)
+    for email, storage_quota in sorted(quotas.items(), key=lambda x: str(x[0])):
+        values = [int(storage_quota.get(k, 0)) for k in QUOTA_COLUMNS[:-1]] + [free_space(storage_quota)]
+        totals = [x + y for x, y in zip(totals, values)]
+        lines.append(format_quota_line(str(email), (f"{x / 2 ** 30:.3f} GiB" for x in values)))
+    if len(quotas) > 1:
+        lines.append(format_quota_line(f"total ({len(quotas)} accounts)", (f"{x / 2 ** 30:.3f} GiB" for x in totals)))
+    return "\n".join(lines)
 
 
 class GoogleDriveQuota(GoogleDriveClient):
+    """Storage quota of every account, asked for concurrently"""
+
     async def run(self):
-        print(format_storage_quota(await self.api.get_about()))
+        print(format_fleet_quota(await self.get_quotas()))
@@ -1,22 +1,73 @@
 import asyncio
-from typing import Optional
+from collections import Counter
+from typing import Optional, Sequence
 
+from api.profiler import PROFILER
 from client.cleaner import GoogleDriveCleaner
 from client.cloner import GoogleDriveCloner
+from client.quota import free_space
 from consts import logger
 
 
 class GoogleDriveRotator(GoogleDriveCloner, GoogleDriveCleaner):
+    async def place(self, base_folder_ids: Sequence[str], held: Counter) -> bool:
+        """Switch to the account the new backup goes to, False if none has room for it
+
+        Accounts are ranked by the requests they have pending, then by the backups they hold,
+        then by free space. The sources are fetched with the first to learn their size, and the
+        first one with enough space for them wins.
+        """
+        quotas = await self.get_quotas()
+        ranked = sorted(
+            quotas, key=lambda x: (self._open_session(x)[0].load, held[x], -free_space(quotas[x]), str(x))
+        )
+        if not ranked:
+            logger.error("No account to place the backup on")
+            return False
+
+        self._set_secret_by_email(ranked[0])
+        with PROFILER.phase("fetch"):
+            await self.cache.fetch_folder_and_descendants(
+                *base_folder_ids, fields=self.FIELDS, follow_shortcuts=False
+            )
+        size = sum(self.cache.get_folder_size(x) for x in self.distinct_sources(base_folder_ids))
+
+        fitting = [x for x in ranked if free_space(quotas[x]) >= size]
+        if not fitting:
+            most = max(free_space(x) for x in quotas.values())
+            logger.error(
+                f"No account has room for the backup. Most free: {most / 2 ** 30:.3f} GiB,"
+                f" Needed: {size / 2 ** 30:.3f} GiB. Exiting..."
+            )
+            return False
+
+        picked = fitting[0]
+        logger.info(
+            f"Placing backup on {picked}: {free_space(quotas[picked]) / 2 ** 30:.3f} GiB free,"
+            f" {held[picked]} backups held"
+        )
+        if picked != self.email:
+            self._set_secret_by_email(picked)
+            with PROFILER.phase("fetch"):
+                await self.cache.fetch_folder_and_descendants(
+                    *base_folder_ids, fields=self.FIELDS, follow_shortcuts=False
+                )
+        return True
+
     async def run(  # type: ignore
         self,
-        base_folder_id: str,
+        base_folder_ids: Sequence[str],
         destination_parent_folder_id: str,
         new_name: Optional[str] = None,
         dry_run: bool = False,
     ):
-        fields = {"createdTime"}
-        await self.cache.fetch(f"'{destination_parent_folder_id}' in parents", fields=fields)
-        backups = list(self.cache.file_info.items())
+        fields = {"createdTime", "owners/emailAddress"}
+        # every account's quota is needed for placing the backup, so ask meanwhile
+        listed, _ = await asyncio.gather(
+            self.cache.fetch(f"'{destination_parent_folder_id}' in parents", fields=fields), self.get_quotas()
+        )
+        backups = list(listed.items())
+        held = Counter(x["owners"][0]["emailAddress"] for _, x in backups)
 
         if len(backups) >= len(self.accounts):
             logger.info("Cleaning up oldest backup")
@@ -28,26 +79,32 @@ class GoogleDriveRotator(GoogleDriveCloner, GoogleDriveCleaner):
             logger.info(f"Deleting oldest backup {oldest[1]['name']} ({oldest[0]}) owner: {picked}")
 
             self._set_secret_by_email(picked)
+            # the backup folder itself has no size, what it frees is that of its contents
+            with PROFILER.phase("fetch"):
+                await self.cache.fetch_descendants(oldest[0], fields={"size"}, follow_shortcuts=False)
 
-            await self.cache.fetch_files(oldest[0])
-            await self.clean(oldest[0], dry_run=dry_run)
-
-            # remove cache from cleaning, just in case it breaks things
-            self.cache.clear()
+            freed = await self.clean(oldest[0], dry_run=dry_run)
+            held[picked] -= 1
+            if picked in self.quotas:
+                # the quota was asked for before, and drive is slow to update it anyway
+                quota = self.quotas[picked]
+                quota["usage"] = str(int(quota["usage"]) - freed)
 
             logger.info("Cleanup done. Waiting 10 seconds for drive to catch up...")
-            await asyncio.sleep(10)
-        else:
-            logger.info("Less backups than accounts, picking unused account")
-            emails = [y[1]["owners"][0]["emailAddress"] for y in backups]
-            unused = [x for x in self.accounts if x not in emails]
+            if dry_run:
+                self.cost_plan.extra_seconds += 10
+            else:
+                await asyncio.sleep(10)
 
-            picked = unused[0]
-            self._set_secret_by_email(picked)
+        if not await self.place(base_folder_ids, held):
+            return
 
         await self.clone(
-            base_folder_id=base_folder_id,
+            base_folder_ids=base_folder_ids,
             destination_parent_folder_id=destination_parent_folder_id,
             new_name=new_name,
             dry_run=dry_run,
+            fetch=False,
         )
+        if dry_run:
+            print(self.cost_plan.report())
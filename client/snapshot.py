@@ -0,0 +1,20 @@
+import time
+
+from api.snapshot import write_snapshot
+from client.client import GoogleDriveClient
+from consts import logger
+
+
+class GoogleDriveSnapshot(GoogleDriveClient):
+    """Save a tree to a snapshot file, for `du` and `find` to read offline with --snapshot"""
+
+    FIELDS = {"size", "createdTime", "modifiedTime", "owners/emailAddress"}
+
+    async def run(self, path: str, root: str = "root"):  # type: ignore
+        root = await self.fetch_tree(root)
+
+        start = time.perf_counter()
+        write_snapshot(self.cache, path, root)
+        logger.info(
+            f"Wrote {len(self.cache.file_info)} files to {path} in {(time.perf_counter() - start) * 1000:.1f} ms"
+        )
@@ -0,0 +1,362 @@
+import asyncio
+import json
+import math
+import os
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from api.events import EVENTS
+from api.metrics import METRICS
+from api.profiler import PROFILER
+from api.worker_pool import run_bounded
+from client.client import GoogleDriveClient
+from client.mirror import md5_of
+from client.quota import free_space
+from consts import BATCH_SIZE, FOLDER_TYPE, logger
+from tqdm.asyncio import tqdm
+
+# Drive takes upload chunks in multiples of 256 KiB
+CHUNK_SIZE = 16 * 2**20
+WORKERS = 8
+# kept in the source directory unless given elsewhere, and never uploaded itself
+INDEX_NAME = ".gdrive-index.json"
+
+
+def rfc3339(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class LocalIndex:
+    """Size, modification time and md5 of local files by relative path, kept between runs
+
+    Files whose size and time match their entry aren't read again. Sessions of uploads that
+    didn't finish are kept too, so the next run goes on with them.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.files: Dict[str, Dict] = {}
+        self.sessions: Dict[str, Dict] = {}
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            self.files = saved["files"]
+            self.sessions = saved["sessions"]
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError):
+            logger.warning(f"Ignoring unreadable index {path}")
+
+    def md5(self, rel: str, stat: os.stat_result) -> Optional[str]:
+        entry = self.files.get(rel)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            return entry["md5"]
+        return None
+
+    def set(self, rel: str, stat: os.stat_result, md5: str):
+        self.files[rel] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "md5": md5}
+
+    def session(self, rel: str, stat: os.stat_result, target: str) -> Optional[str]:
+        """Upload uri of an earlier session sending the same content to the same place"""
+        session = self.sessions.get(rel)
+        if session and (session["size"], session["mtime"], session["target"]) == (
+            stat.st_size,
+            stat.st_mtime_ns,
+            target,
+        ):
+            return session["uri"]
+        return None
+
+    def set_session(self, rel: str, stat: os.stat_result, target: str, uri: str):
+        self.sessions[rel] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "target": target, "uri": uri}
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"files": self.files, "sessions": self.sessions}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class GoogleDriveUploader(GoogleDriveClient):
+    """Upload a local directory into a Drive folder, transferring only files that changed
+
+    Local files are compared with their namesakes in Drive by size, then md5; the md5 of
+    local files comes from the index unless their size or time changed. Missing folders are
+    created a level at a time in shared batches, and files are sent in resumable uploads of
+    chunk_size, workers files at a time.
+    """
+
+    FIELDS = {"size", "modifiedTime", "md5Checksum"}
+
+    def __init__(self, args, sessions=None) -> None:
+        super().__init__(args, sessions)
+        self.source = ""
+        self.index: LocalIndex = None  # type: ignore
+        self.pbar = None
+        self.counts: Dict[str, int] = {"uploaded": 0, "up to date": 0, "failed": 0}
+        self.bytes_uploaded = 0
+
+    def scan(self, source: str) -> Tuple[List[str], List[Tuple[str, os.stat_result]]]:
+        """Folders and files below source, as relative paths with slashes, parents before children"""
+        folders = []
+        files = []
+        for dirpath, dirnames, filenames in os.walk(source):
+            rel = os.path.relpath(dirpath, source).replace(os.sep, "/")
+            prefix = "" if rel == "." else rel + "/"
+            dirnames[:] = sorted(
+                x for x in dirnames if not self.cache.is_ignored(x) and not os.path.islink(os.path.join(dirpath, x))
+            )
+            folders.extend(prefix + x for x in dirnames)
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                if self.cache.is_ignored(name) or path == self.index.path or path == self.index.path + ".tmp":
+                    continue
+                stat = os.stat(path)
+                if os.path.isfile(path):
+                    files.append((prefix + name, stat))
+        return folders, files
+
+    def remote_tree(self, root: str) -> Dict[str, str]:
+        """Ids of everything below root by relative path; of items with the same name, the first"""
+        ids: Dict[str, str] = {}
+        stack = [(root, "")]
+        while stack:
+            folder_id, prefix = stack.pop()
+            for file_id, file in self.cache.get_folder_children(folder_id):
+                rel = prefix + file.get("name", "")
+                if rel in ids:
+                    continue
+                ids[rel] = file_id
+                if file.get("mimeType") == FOLDER_TYPE:
+                    stack.append((file_id, rel + "/"))
+        return ids
+
+    async def plan(
+        self, files: List[Tuple[str, os.stat_result]], remote: Dict[str, str], checksum: bool, workers: int
+    ) -> List[Tuple[str, os.stat_result, Optional[str]]]:
+        """Files to upload, with the id of the file in Drive they replace, if any
+
+        Only files whose size matches their namesake in Drive need their md5 compared.
+        """
+        loop = asyncio.get_running_loop()
+        uploads = []
+        same_size = []
+        for rel, stat in files:
+            remote_id = remote.get(rel)
+            if remote_id is None:
+                uploads.append((rel, stat, None))
+                continue
+            file = self.cache.file_info[remote_id]
+            if file.get("mimeType") == FOLDER_TYPE or "md5Checksum" not in file:
+                logger.warning(f"{rel} is a folder or has no binary content in Drive, skipping it")
+                EVENTS.emit("skipped", remote_id, self.cache, reason="not binary", local=rel)
+            elif int(file.get("size", 0)) != stat.st_size:
+                uploads.append((rel, stat, remote_id))
+            else:
+                same_size.append((rel, stat, remote_id))
+
+        async def compare(rel: str, stat: os.stat_result, remote_id: str):
+            md5 = None if checksum else self.index.md5(rel, stat)
+            if md5 is None:
+                md5 = await loop.run_in_executor(None, md5_of, os.path.join(self.source, rel))
+                self.index.set(rel, stat, md5)
+            if md5 == self.cache.file_info[remote_id]["md5Checksum"]:
+                self.counts["up to date"] += 1
+                EVENTS.emit("skipped", remote_id, self.cache, reason="up to date", local=rel)
+            else:
+                uploads.append((rel, stat, remote_id))
+
+        await run_bounded(compare, same_size, limit=workers)
+        return uploads
+
+    async def create_folders(self, root: str, folders: List[str], remote: Dict[str, str], dry_run: bool) -> Dict[str, str]:
+        """Ids of the Drive folders of folders, creating the missing ones
+
+        A folder can only be created once its parent exists, so every level is requested at
+        once and goes out in shared batches. Folders that are files in Drive are left out,
+        along with what's below them.
+        """
+        ids = {"": root}
+        levels = defaultdict(list)
+        for rel in folders:
+            levels[rel.count("/")].append(rel)
+
+        for depth in sorted(levels):
+            missing = []
+            for rel in levels[depth]:
+                parent = rel.rpartition("/")[0]
+                remote_id = remote.get(rel)
+                if parent not in ids:
+                    continue
+                if remote_id is None:
+                    missing.append((rel, parent))
+                elif self.cache.file_info[remote_id].get("mimeType") == FOLDER_TYPE:
+                    ids[rel] = remote_id
+                else:
+                    logger.warning(f"{rel} is a file in Drive, skipping the folder")
+                    EVENTS.emit("skipped", remote_id, self.cache, reason="not a folder", local=rel)
+
+            if dry_run:
+                self.cost_plan.add_requests(
+                    self.email, "create", len(missing), batches=math.ceil(len(missing) / BATCH_SIZE)
+                )
+                for rel, _ in missing:
+                    # there's no id yet, but what goes inside still gets planned
+                    ids[rel] = ""
+                    EVENTS.emit("planned_create", "", local=rel)
+                continue
+
+            created = await asyncio.gather(
+                *(self.api.create_folder(ids[parent], rel.rpartition("/")[2]) for rel, parent in missing)
+            )
+            for (rel, parent), folder in zip(missing, created):
+                if folder is None:
+                    logger.error(f"Creating folder {rel} failed, skipping what's inside")
+                    continue
+                ids[rel] = folder["id"]
+                self.cache.apply_changes([{"fileId": folder["id"], "file": dict(folder, parents=[ids[parent]])}])
+                EVENTS.emit("created", folder["id"], self.cache, local=rel)
+        return ids
+
+    async def send(
+        self, rel: str, stat: os.stat_result, parent_id: str, remote_id: Optional[str], chunk_size: int
+    ) -> Optional[Dict]:
+        """Upload rel in chunks, going on with the session of an earlier run if it's still open"""
+        path = os.path.join(self.source, rel)
+        metadata = {"modifiedTime": rfc3339(stat.st_mtime)}
+        if remote_id is None:
+            metadata.update(name=os.path.basename(rel), parents=[parent_id])
+        target = remote_id or parent_id
+        uri = self.index.session(rel, stat, target)
+        if uri:
+            logger.debug(f"Resuming upload of {rel}")
+
+        req = self.api.new_upload(path, chunk_size, remote_id, uri, self.FIELDS, **metadata)
+        sent = 0
+        while True:
+            result = await self.api.upload_chunk(req)
+            if result is None and uri:
+                # the session expired or is gone; start over
+                logger.debug(f"Upload session of {rel} is gone, restarting it")
+                self.index.sessions.pop(rel, None)
+                uri = None
+                self.pbar.update(-sent)
+                sent = 0
+                req = self.api.new_upload(path, chunk_size, remote_id, None, self.FIELDS, **metadata)
+                continue
+            if result is None:
+                return None
+
+            progress, file = result
+            if req.resumable_uri != uri and stat.st_size > chunk_size:
+                # only worth resuming if there's more than one chunk
+                uri = req.resumable_uri
+                self.index.set_session(rel, stat, target, uri)
+            done = stat.st_size if file is not None else progress.resumable_progress
+            METRICS.inc("gdrive_upload_bytes_total", done - sent)
+            self.pbar.update(done - sent)
+            sent = done
+            if file is not None:
+                self.index.sessions.pop(rel, None)
+                return file
+
+    async def upload_file(
+        self, rel: str, stat: os.stat_result, parent_id: str, remote_id: Optional[str], chunk_size: int, dry_run: bool
+    ):
+        if dry_run:
+            self.counts["uploaded"] += 1
+            self.bytes_uploaded += stat.st_size
+            self.pbar.update(stat.st_size)
+            EVENTS.emit("planned_upload", remote_id or "", local=rel, size=stat.st_size)
+            return
+
+        file = await self.send(rel, stat, parent_id, remote_id, chunk_size)
+        if file is None:
+            self.counts["failed"] += 1
+            EVENTS.emit("failed", remote_id or "", local=rel, size=stat.st_size)
+            return
+
+        self.counts["uploaded"] += 1
+        self.bytes_uploaded += stat.st_size
+        self.cache.apply_changes([{"fileId": file["id"], "file": dict(file)}], fields=self.FIELDS)
+        # Drive's checksum is only that of the file as it is now if it didn't change while uploading
+        if os.stat(os.path.join(self.source, rel)).st_mtime_ns == stat.st_mtime_ns and "md5Checksum" in file:
+            self.index.set(rel, stat, file["md5Checksum"])
+        EVENTS.emit("uploaded", file["id"], self.cache, local=rel, size=stat.st_size)
+
+    async def run(  # type: ignore
+        self,
+        source: str,
+        root: str,
+        workers: int = WORKERS,
+        chunk_size: int = CHUNK_SIZE,
+        checksum: bool = False,
+        dry_run: bool = False,
+        index: Optional[str] = None,
+    ):
+        self.source = os.path.abspath(source)
+        self.index = LocalIndex(os.path.abspath(index or os.path.join(self.source, INDEX_NAME)))
+        loop = asyncio.get_running_loop()
+
+        with PROFILER.phase("fetch"):
+            # remote_tree only descends into folders, what shortcuts point to is never written to
+            root = await self.fetch_tree(root, follow_shortcuts=False)
+
+        try:
+            with PROFILER.phase("plan"):
+                folders, files = await loop.run_in_executor(None, self.scan, self.source)
+                # entries of files that are gone would only grow the index
+                present = {rel for rel, _ in files}
+                self.index.files = {k: v for k, v in self.index.files.items() if k in present}
+                self.index.sessions = {k: v for k, v in self.index.sessions.items() if k in present}
+
+                remote = self.remote_tree(root)
+                uploads = await self.plan(files, remote, checksum, workers)
+                total = sum(stat.st_size for _, stat, _ in uploads)
+                needed = total - sum(
+                    int(self.cache.file_info[x].get("size", 0)) for _, _, x in uploads if x is not None
+                )
+                logger.info(
+                    f"Uploading {len(uploads)} of {len(files)} files, {total / 2 ** 30:.3f} GiB."
+                    f" {self.counts['up to date']} up to date"
+                )
+
+            quota = (await self.get_quotas([self.email])).get(self.email)
+            if quota is None:
+                return
+            free = free_space(quota)
+            if dry_run:
+                chunks = sum(max(1, math.ceil(stat.st_size / chunk_size)) for _, stat, _ in uploads)
+                # uploads aren't batched, and go out without pauses
+                self.cost_plan.add_requests(self.email, "upload", chunks, batches=0)
+                self.cost_plan.add_quota(self.email, needed, free)
+            elif needed > free:
+                logger.error(
+                    f"Insufficient space. Free: {free / 2 ** 30:.3f} GiB,"
+                    f" Needed: {needed / 2 ** 30:.3f} GiB. "
+                    "Exiting..."
+                )
+                return
+
+            with PROFILER.phase("create folders"):
+                ids = await self.create_folders(root, folders, remote, dry_run)
+
+            # files in folders that couldn't be created stay where they are
+            uploads = [(rel, stat, x) for rel, stat, x in uploads if rel.rpartition("/")[0] in ids]
+            with tqdm(total=total, unit="B", unit_scale=True, colour="green") as self.pbar, PROFILER.phase("upload"):
+                await run_bounded(
+                    lambda x, y, z: self.upload_file(x, y, ids[x.rpartition("/")[0]], z, chunk_size, dry_run),
+                    uploads,
+                    limit=workers,
+                )
+        finally:
+            if not dry_run:
+                await loop.run_in_executor(None, self.index.save)
+
+        verb = "Would upload" if dry_run else "Uploaded"
+        logger.info(
+            f"{verb} {self.counts['uploaded']} files, {self.bytes_uploaded / 2 ** 30:.3f} GiB."
+            f" {self.counts['up to date']} up to date, {self.counts['failed']} failed"
+        )
+        if dry_run:
+            print(self.cost_plan.report())
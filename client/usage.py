@@ -0,0 +1,42 @@
+import heapq
+
+from api.snapshot import Snapshot
+from client.client import GoogleDriveClient
+
+
+def format_usage_line(label: str, size: int, items: int) -> str:
+    return f"    {label.ljust(100)} {f'{size / 2 ** 20:.3f} MiB'.rjust(16)} {str(items).rjust(10)} items"
+
+
+def print_report(source, root: str, top: int):
+    """Print the usage below root, from an InfoCache or a Snapshot"""
+    per_folder, per_type, per_owner = source.get_usage(root)
+    total_size, total_items = per_folder.get(root, [0, 0])
+    print(format_usage_line(source.build_path(root), total_size, total_items))
+
+    print(f"\nTop {top} folders by size:")
+    for fid, (size, items) in heapq.nlargest(top, per_folder.items(), key=lambda x: x[1][0]):
+        print(format_usage_line(f"{source.build_path(fid, root)} ({fid})", size, items))
+
+    print("\nBy type:")
+    for mime_type, (size, items) in sorted(per_type.items(), key=lambda x: -x[1][0]):
+        print(format_usage_line(str(mime_type), size, items))
+
+    print("\nBy owner:")
+    for owner, (size, items) in sorted(per_owner.items(), key=lambda x: -x[1][0]):
+        print(format_usage_line(str(owner), size, items))
+
+
+async def print_snapshot_usage(path: str, root: str = "root", top: int = 20):
+    with Snapshot(path) as snapshot:
+        print_report(snapshot, snapshot.root if root == "root" else root, top)
+
+
+class GoogleDriveUsage(GoogleDriveClient):
+    """Report where space goes below a folder, like `du`"""
+
+    FIELDS = {"size", "owners/emailAddress"}
+
+    async def run(self, root: str = "root", top: int = 20):  # type: ignore
+        root = await self.fetch_tree(root)
+        print_report(self.cache, root, top)
@@ -46,6 +46,9 @@ SCOPES = ["https://www.googleapis.com/auth/drive"]
 CLIENT_SECRETS_FILE = "./res/oauth_secret.json"
 
 BATCH_SIZE = 100
+# enough to keep the batcher fed, few enough to keep memory flat on huge jobs
+MAX_OUTSTANDING_REQUESTS = 10 * BATCH_SIZE
+REQUEST_INTERVAL = 1
 MAXIMUM_BACKOFF = 60
 BACKOFF_RESET_SECONDS = 60
 
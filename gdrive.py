@@ -2,70 +2,174 @@
 
 import argparse
 import asyncio
+import json
 import logging
+import socket
+import sys
 from datetime import datetime
 
-from client.cloner import GoogleDriveCloner
-from client.cleaner import GoogleDriveCleaner
-from client.browser import GoogleDriveBrowser
-from client.diff import GoogleDriveDiff
-from client.linker import GoogleDriveLinker
-from client.quota import GoogleDriveQuota
-from client.rotator import GoogleDriveRotator
+from api.events import EVENTS
+from api.metrics import METRICS
+from api.profiler import PROFILER
+from api.tracing import TRACER
+from consts import REQUEST_INTERVAL, logger
 
-from consts import logger
 
+def diff_directories(args, sessions=None):
+    from client.diff import GoogleDriveDiff
 
-def diff_directories(args):
-    diff = GoogleDriveDiff(args)
-    asyncio.run(diff.run(args.first, args.second))
+    diff = GoogleDriveDiff(args, sessions)
+    return diff.run(args.first, args.second)
 
 
-def print_quota(args):
-    quota = GoogleDriveQuota(args)
-    asyncio.run(quota.run())
+def print_quota(args, sessions=None):
+    from client.quota import GoogleDriveQuota
 
+    quota = GoogleDriveQuota(args, sessions)
+    return quota.run()
 
-def browse_files(args):
-    browser = GoogleDriveBrowser(args)
-    asyncio.run(browser.run(args.root, args.orphans))
 
+def print_usage(args, sessions=None):
+    if args.snapshot:
+        from client.usage import print_snapshot_usage
 
-def link_files(args):
-    linker = GoogleDriveLinker(args)
-    asyncio.run(linker.run(args.target, args.destination))
+        return print_snapshot_usage(args.snapshot, args.root, args.top)
 
+    from client.usage import GoogleDriveUsage
 
-def cleanup_files(args):
-    cleaner = GoogleDriveCleaner(args)
-    asyncio.run(cleaner.run(*args.delete, dry_run=args.dry_run))
+    usage = GoogleDriveUsage(args, sessions)
+    return usage.run(args.root, args.top)
 
 
-def clone_files(args):
-    googledrivecloner = GoogleDriveCloner(args)
-    asyncio.run(
-        googledrivecloner.run(
-            base_folder_id=args.source_folder_id,
-            destination_parent_folder_id=args.destination_parent_folder_id,
-            new_name=args.name,
-            dry_run=args.dry_run,
-        )
+def find_duplicates(args, sessions=None):
+    from client.dupes import GoogleDriveDupes
+
+    dupes = GoogleDriveDupes(args, sessions)
+    return dupes.run(args.root, link=args.link, min_size=args.min_size, dry_run=args.dry_run)
+
+
+def browse_files(args, sessions=None):
+    from client.browser import GoogleDriveBrowser
+
+    browser = GoogleDriveBrowser(args, sessions)
+    return browser.run(args.root, args.orphans)
+
+
+def find_files(args, sessions=None):
+    if args.snapshot:
+        from client.finder import print_snapshot_matches
+
+        return print_snapshot_matches(args.snapshot, args.query, args.mode, args.limit)
+
+    from client.finder import GoogleDriveFinder
+
+    finder = GoogleDriveFinder(args, sessions)
+    return finder.run(args.query, args.root, args.mode, args.limit)
+
+
+def save_snapshot(args, sessions=None):
+    from client.snapshot import GoogleDriveSnapshot
+
+    snapshot = GoogleDriveSnapshot(args, sessions)
+    return snapshot.run(args.path, args.root)
+
+
+def mirror_files(args, sessions=None):
+    from client.mirror import GoogleDriveMirror
+
+    mirror = GoogleDriveMirror(args, sessions)
+    return mirror.run(
+        args.root,
+        args.destination,
+        workers=args.workers,
+        chunk_size=int(args.chunk_size * 2**20),
+        checksum=args.checksum,
+        dry_run=args.dry_run,
     )
 
 
-def rotate_backups(args):
-    google_backup_rotator = GoogleDriveRotator(args)
-    asyncio.run(
-        google_backup_rotator.run(
-            base_folder_id=args.source_folder_id,
-            destination_parent_folder_id=args.destination_parent_folder_id,
-            new_name=args.name,
-            dry_run=args.dry_run,
-        )
+def upload_files(args, sessions=None):
+    from client.uploader import GoogleDriveUploader
+
+    uploader = GoogleDriveUploader(args, sessions)
+    return uploader.run(
+        args.source,
+        args.root,
+        workers=args.workers,
+        # Drive takes chunks in multiples of 256 KiB
+        chunk_size=max(1, round(args.chunk_size * 4)) * 2**18,
+        checksum=args.checksum,
+        dry_run=args.dry_run,
+        index=args.index,
     )
 
 
-def parse_arguments():
+def link_files(args, sessions=None):
+    from client.linker import GoogleDriveLinker
+
+    linker = GoogleDriveLinker(args, sessions)
+    return linker.run(args.target, args.destination)
+
+
+def cleanup_files(args, sessions=None):
+    from client.cleaner import GoogleDriveCleaner
+
+    cleaner = GoogleDriveCleaner(args, sessions)
+    return cleaner.run(*args.delete, dry_run=args.dry_run)
+
+
+def read_sources(args):
+    """Folder ids given as arguments, then those in --source-file"""
+    sources = list(args.source_folder_id)
+    if args.source_file:
+        with open(args.source_file) as f:
+            # one per line, with blank lines and # comments allowed
+            sources.extend(x for x in (line.split("#", 1)[0].strip() for line in f) if x)
+    return sources
+
+
+def clone_files(args, sessions=None):
+    from client.cloner import GoogleDriveCloner
+
+    googledrivecloner = GoogleDriveCloner(args, sessions)
+    return googledrivecloner.run(
+        base_folder_ids=read_sources(args),
+        destination_parent_folder_id=args.destination_parent_folder_id,
+        new_name=args.name,
+        dry_run=args.dry_run,
+    )
+
+
+def rotate_backups(args, sessions=None):
+    from client.rotator import GoogleDriveRotator
+
+    google_backup_rotator = GoogleDriveRotator(args, sessions)
+    return google_backup_rotator.run(
+        base_folder_ids=read_sources(args),
+        destination_parent_folder_id=args.destination_parent_folder_id,
+        new_name=args.name,
+        dry_run=args.dry_run,
+    )
+
+
+def run_daemon(args, sessions=None):
+    from client.daemon import GoogleDriveDaemon
+
+    daemon = GoogleDriveDaemon(args, parse=lambda argv: parse_arguments(argv, require_credentials=False))
+    return daemon.run(args.socket, jobs=args.job, refresh=args.refresh)
+
+
+def send_to_daemon(socket_path, argv):
+    """Have the daemon on socket_path run argv, print its output and return its exit status"""
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps({"argv": argv}).encode() + b"\n")
+        response = json.loads(sock.makefile().readline())
+    print(response["output"], end="")
+    return response["status"]
+
+
+def parse_arguments(argv=None, require_credentials=True):
     today = datetime.today().strftime("%Y-%m-%d")
     new_folder_name = f"drive_backup_{today}"
 
@@ -79,7 +183,8 @@ def parse_arguments():
     )
     parser.add_argument("-q", "--quiet", help="Decrease output verbosity", action="store_true")
 
-    creds_group = parser.add_mutually_exclusive_group(required=True)
+    # not required with --socket, checked below
+    creds_group = parser.add_mutually_exclusive_group()
     creds_group.add_argument("-s", "--secrets", help="Path to secrets directory or file")
     creds_group.add_argument("--oauth", help="Use OAuth2 credentials", action="store_true")
 
@@ -91,6 +196,86 @@ def parse_arguments():
         default=1,
     )
 
+    parser.add_argument(
+        "--cache-ttl",
+        help="Seconds to reuse identical metadata responses for. Disabled by default",
+        type=float,
+        default=0,
+    )
+
+    parser.add_argument(
+        "--request-interval",
+        help="Base pause in seconds between batches, before jitter and backoff",
+        type=float,
+        default=REQUEST_INTERVAL,
+    )
+    parser.add_argument("--endpoint", help="Root URL of the Drive API, e.g. a local fake server")
+    parser.add_argument(
+        "--fast-batch-decoder",
+        help="Decode batch responses straight from the response bytes, not through an email parser, to save CPU",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--json-decoder",
+        help="JSON decoder for --fast-batch-decoder. orjson is faster but has to be installed",
+        choices=["json", "orjson"],
+        default="json",
+    )
+    parser.add_argument(
+        "--deadline",
+        help="Seconds before a batch is given up on and re-queued, as OPERATION=SECONDS (e.g. files.list=30) "
+        "or SECONDS for all reads. Can be repeated",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        help="Send a duplicate of a batch of reads slower than this percentile of their latency so far, "
+        "and take the first answer, e.g. 95. Disabled by default",
+        type=float,
+        default=0,
+    )
+
+    cassette_group = parser.add_mutually_exclusive_group()
+    cassette_group.add_argument("--record", help="Record API traffic to this cassette file")
+    cassette_group.add_argument("--replay", help="Serve API traffic from this cassette file instead of the network")
+    parser.add_argument(
+        "--anonymize", help="Anonymize file and user names and e-mail addresses when recording", action="store_true"
+    )
+    parser.add_argument(
+        "--replay-speed",
+        help="Multiplier for recorded latencies when replaying, 0 for no delay",
+        type=float,
+        default=1.0,
+    )
+
+    parser.add_argument(
+        "--metrics",
+        help="Write request metrics to this file at exit, as Prometheus text if it ends in .prom, JSON otherwise",
+    )
+
+    parser.add_argument(
+        "--profile",
+        help="Write a sampling profile, phase timings, executor waits and event loop lag to this file at exit",
+    )
+
+    parser.add_argument("--trace", help="Write spans of sampled requests to this Chrome trace JSON file at exit")
+    parser.add_argument(
+        "--trace-sample",
+        help="Fraction of requests to trace. Batches are always traced",
+        type=float,
+        default=0.01,
+    )
+    parser.add_argument(
+        "--audit-log",
+        help="Append a JSON line for every file copied, deleted or skipped to this file",
+    )
+
+    parser.add_argument(
+        "--socket",
+        help="Unix socket of a daemon to run the command in, or for the daemon command to listen on",
+    )
+
     subparsers = parser.add_subparsers()
 
     diff_parser = subparsers.add_parser("diff", help="Diff own directory with another directory")
@@ -98,21 +283,83 @@ def parse_arguments():
     diff_parser.add_argument("first", help="First directory id")
     diff_parser.add_argument("second", help="Second directory id")
 
-    quota_parser = subparsers.add_parser("quota", help="Get quota info")
+    quota_parser = subparsers.add_parser("quota", help="Get quota info of every account")
     quota_parser.set_defaults(func=print_quota)
 
+    du_parser = subparsers.add_parser("du", help="Report disk usage per folder, type and owner")
+    du_parser.set_defaults(func=print_usage)
+    du_parser.add_argument("root", help="Folder to report on", default="root", nargs="?")
+    du_parser.add_argument("--top", help="Number of heaviest folders to print", type=int, default=20)
+    du_parser.add_argument("--snapshot", help="Report from this snapshot file instead of the API")
+
+    dupes_parser = subparsers.add_parser("dupes", help="Find files with identical content")
+    dupes_parser.set_defaults(func=find_duplicates)
+    dupes_parser.add_argument("root", help="Folder to search for duplicates", default="root", nargs="?")
+    dupes_parser.add_argument("--link", help="Replace own redundant copies with shortcuts", action="store_true")
+    dupes_parser.add_argument("--min-size", help="Ignore files smaller than this many bytes", type=int, default=1)
+    dupes_parser.add_argument("--dry-run", help="Print duplicates without replacing them", action="store_true")
+
     browse_parser = subparsers.add_parser("browse", help="Browse files")
-    browse_parser.set_defaults(func=browse_files)
+    browse_parser.set_defaults(func=browse_files, local_only=True)
     browse_parser.add_argument("root", help="Folder from which to start browsing", default="root", nargs="?")
     browse_parser.add_argument("--orphans", help="Browse orphan files", action="store_true")
 
+    find_parser = subparsers.add_parser("find", help="Find files by name or path")
+    find_parser.set_defaults(func=find_files)
+    find_parser.add_argument("query", help="Name substring, name or path prefix, or glob pattern")
+    find_parser.add_argument("root", help="Folder from which to search", default="root", nargs="?")
+    find_parser.add_argument(
+        "--mode",
+        help="How to match query. Prefixes and globs containing '/' match full paths",
+        choices=["substring", "prefix", "glob"],
+        default="substring",
+    )
+    find_parser.add_argument("--limit", help="Maximum number of results to print", type=int, default=0)
+    find_parser.add_argument("--snapshot", help="Search this snapshot file instead of the API")
+
+    snapshot_parser = subparsers.add_parser("snapshot", help="Save a tree to a snapshot file")
+    snapshot_parser.set_defaults(func=save_snapshot)
+    snapshot_parser.add_argument("path", help="Snapshot file to write")
+    snapshot_parser.add_argument("root", help="Folder to save", default="root", nargs="?")
+
+    mirror_parser = subparsers.add_parser("mirror", help="Download a folder to a local directory")
+    # writes to the disk of whoever runs it, so never in the daemon
+    mirror_parser.set_defaults(func=mirror_files, local_only=True)
+    mirror_parser.add_argument("root", help="Folder to download")
+    mirror_parser.add_argument("destination", help="Local directory to download into")
+    mirror_parser.add_argument("--workers", help="Downloads in flight at once", type=int, default=8)
+    mirror_parser.add_argument(
+        "--chunk-size", help="MiB per download request; larger files are fetched in parallel chunks", type=float, default=16
+    )
+    mirror_parser.add_argument(
+        "--checksum", help="Compare md5 checksums even of local files whose size and time match", action="store_true"
+    )
+    mirror_parser.add_argument("--dry-run", help="Print files to download", action="store_true")
+
+    upload_parser = subparsers.add_parser("upload", help="Upload a local directory into a folder")
+    # reads the disk of whoever runs it, so never in the daemon
+    upload_parser.set_defaults(func=upload_files, local_only=True)
+    upload_parser.add_argument("source", help="Local directory to upload")
+    upload_parser.add_argument("root", help="Folder to upload into")
+    upload_parser.add_argument("--workers", help="Uploads in flight at once", type=int, default=8)
+    upload_parser.add_argument(
+        "--chunk-size", help="MiB per upload request, rounded to a multiple of 256 KiB", type=float, default=16
+    )
+    upload_parser.add_argument(
+        "--checksum", help="Hash local files even if their size and time match the index", action="store_true"
+    )
+    upload_parser.add_argument(
+        "--index", help="File to keep sizes, times and checksums of local files in. Default: SOURCE/.gdrive-index.json"
+    )
+    upload_parser.add_argument("--dry-run", help="Print files to upload", action="store_true")
+
     link_parser = subparsers.add_parser("link", help="Create shortcut files")
     link_parser.set_defaults(func=link_files)
     link_parser.add_argument("target", help="Target item to link")
     link_parser.add_argument("destination", help="Destination folder to link to", nargs="?")
 
     cleanup_parser = subparsers.add_parser("delete", help="Delete files")
-    cleanup_parser.set_defaults(func=cleanup_files)
+    cleanup_parser.set_defaults(func=cleanup_files, local_only=True)
     cleanup_parser.add_argument("delete", help="File IDs to delete", nargs="+")
     cleanup_parser.add_argument("--dry-run", help="Print files to delete", action="store_true")
 
@@ -120,23 +367,60 @@ def parse_arguments():
     backup_parser.set_defaults(func=clone_files)
     backup_parser.add_argument("--dry-run", help="Print files to copy", action="store_true")
     backup_parser.add_argument("--name", help="New folder name", default=new_folder_name)
+    backup_parser.add_argument("--source-file", help="File with more folder IDs to copy, one per line")
 
-    backup_parser.add_argument("source_folder_id", help="Folder ID to copy")
+    backup_parser.add_argument(
+        "source_folder_id", help="Folder IDs to copy, copied side by side into one new folder if several", nargs="*"
+    )
     backup_parser.add_argument("destination_parent_folder_id", help="Destination folder ID")
 
     rotate_parser = subparsers.add_parser("rotate", help="Rotate backups")
     rotate_parser.add_argument("--dry-run", help="Print files to copy", action="store_true")
     rotate_parser.add_argument("--name", help="New folder name", default=new_folder_name)
+    rotate_parser.add_argument("--source-file", help="File with more folder IDs to copy, one per line")
     rotate_parser.set_defaults(func=rotate_backups)
-    rotate_parser.add_argument("source_folder_id", help="Folder ID to copy")
+    rotate_parser.add_argument(
+        "source_folder_id", help="Folder IDs to copy, copied side by side into one new folder if several", nargs="*"
+    )
     rotate_parser.add_argument("destination_parent_folder_id", help="Destination folder ID")
 
-    arguments = parser.parse_args()
+    daemon_parser = subparsers.add_parser(
+        "daemon", help="Keep caches warm and serve commands sent with --socket, and run scheduled jobs"
+    )
+    daemon_parser.set_defaults(func=run_daemon, local_only=True)
+    daemon_parser.add_argument(
+        "--refresh", help="Seconds between polls of the changes feed", type=float, default=60
+    )
+    daemon_parser.add_argument(
+        "--job",
+        help='Command to run every so many seconds, e.g. "86400 rotate SOURCE DEST". Can be repeated',
+        action="append",
+        default=[],
+    )
+
+    arguments = parser.parse_args(argv)
+    if getattr(arguments, "snapshot", None):
+        # offline, so neither the daemon nor credentials are needed
+        arguments.local_only = True
+        require_credentials = False
+    if getattr(arguments, "func", None) in [clone_files, rotate_backups] and not (
+        arguments.source_folder_id or arguments.source_file
+    ):
+        parser.error("at least one source folder id or --source-file is required")
+    if getattr(arguments, "func", None) is run_daemon and not arguments.socket:
+        parser.error("the daemon needs --socket to listen on")
+    # interactive commands, and the daemon itself, run here even with --socket
+    remote = arguments.socket and not getattr(arguments, "local_only", False)
+    if require_credentials and not (arguments.secrets or arguments.oauth or remote):
+        parser.error("one of the arguments -s/--secrets --oauth is required")
     return arguments
 
 
-def main():
-    args = parse_arguments()
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_arguments(argv)
+    if args.socket and not getattr(args, "local_only", False):
+        sys.exit(send_to_daemon(args.socket, argv))
 
     if args.verbose:
         logger.setLevel(logging.DEBUG)
@@ -145,7 +429,22 @@ def main():
     elif args.quiet:
         logger.setLevel(logging.WARNING)
 
-    args.func(args)
+    if args.profile:
+        PROFILER.start()
+    if args.trace:
+        TRACER.start(args.trace_sample)
+    if args.audit_log:
+        EVENTS.start(args.audit_log)
+    try:
+        asyncio.run(args.func(args))
+    finally:
+        if args.metrics:
+            METRICS.dump(args.metrics)
+        if args.profile:
+            PROFILER.dump(args.profile)
+        if args.trace:
+            TRACER.dump(args.trace)
+        EVENTS.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,81 @@
+import asyncio
+
+from api.api_wrapper import GoogleDriveApiWrapper, fields_mask
+from google.auth.credentials import AnonymousCredentials
+
+
+class FakeBatcher:
+    def __init__(self):
+        self.sent = []
+
+    async def queue_request(self, req, execute_now=False):
+        self.sent.append(req.methodId)
+        await asyncio.sleep(0.01)
+        return {"id": "new", "storageQuota": {"usage": str(len(self.sent))}}
+
+
+def make_api(cache_ttl=60.0):
+    api = GoogleDriveApiWrapper(AnonymousCredentials(), cache_ttl=cache_ttl)
+    api._batcher = FakeBatcher()
+    return api
+
+
+def test_cached_gets_until_deleted():
+    async def run():
+        api = make_api()
+        await api.get_file("a")
+        await api.get_file("a")
+        await api.get_file("b")
+        await api.delete_file("a")
+        await api.get_file("a")
+        await api.get_file("b")
+        return api._batcher.sent
+
+    assert asyncio.run(run()) == ["drive.files.get", "drive.files.get", "drive.files.delete", "drive.files.get"]
+
+
+def test_quota_asked_again_after_copy():
+    async def run():
+        api = make_api()
+        before = await api.get_about()
+        assert await api.get_about() == before
+        await api.copy_file("a", {"name": "a", "mimeType": "text/plain", "createdTime": "", "modifiedTime": ""}, "dest")
+        return before, await api.get_about()
+
+    before, after = asyncio.run(run())
+    assert before != after
+
+
+def test_identical_gets_in_flight_share_a_request():
+    async def run():
+        api = make_api(cache_ttl=0)
+        first, second, other = await asyncio.gather(api.get_file("a"), api.get_file("a"), api.get_file("a", {"size"}))
+        # each caller gets a copy of its own
+        first["id"] = "changed"
+        return api._batcher.sent, second
+
+    sent, second = asyncio.run(run())
+    assert sent == ["drive.files.get", "drive.files.get"]
+    assert second["id"] == "new"
+
+
+def test_cached_gets_expire():
+    async def run():
+        api = make_api(cache_ttl=0.05)
+        await api.get_file("a")
+        await api.get_file("a")
+        await asyncio.sleep(0.1)
+        await api.get_file("a")
+        return api._batcher.sent
+
+    assert asyncio.run(run()) == ["drive.files.get"] * 2
+
+
+def test_fields_mask():
+    assert fields_mask() == "id,mimeType,name,parents,shortcutDetails(targetId)"
+    assert fields_mask({"owners/me", "owners/emailAddress", "size"}) == (
+        "id,mimeType,name,owners(emailAddress,me),parents,shortcutDetails(targetId),size"
+    )
+    # the whole object covers its subfields
+    assert fields_mask({"owners", "owners/me"}) == fields_mask({"owners"})
+    assert "owners," in fields_mask({"owners"})
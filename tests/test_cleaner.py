@@ -0,0 +1,40 @@
+import asyncio
+
+from api.info_cache import InfoCache
+from client.cleaner import GoogleDriveCleaner
+from client.cost_plan import CostPlan
+from consts import FOLDER_TYPE, SHORTCUT_TYPE
+
+
+def make_cleaner():
+    cleaner = GoogleDriveCleaner.__new__(GoogleDriveCleaner)
+    cleaner.email = "a@x"
+    cleaner.cost_plan = CostPlan(request_interval=1)
+    cleaner.cache = InfoCache(None)  # type: ignore
+    me = [{"me": True}]
+    cleaner.cache.file_info.update(
+        {
+            "top": {"name": "top", "mimeType": FOLDER_TYPE, "parent": "root", "owners": me},
+            "sub": {"name": "sub", "mimeType": FOLDER_TYPE, "parent": "top", "owners": me},
+            "f1": {"name": "f1", "mimeType": "text/plain", "parent": "top", "size": "10", "owners": me},
+            "f2": {"name": "f2", "mimeType": "text/plain", "parent": "sub", "size": "5", "owners": me},
+            "link": {"name": "link", "mimeType": SHORTCUT_TYPE, "parent": "sub", "shortcutDetails": {"targetId": "other"}, "owners": me},
+            "other": {"name": "other", "mimeType": "text/plain", "parent": "root", "size": "1000", "owners": me},
+            "theirs": {"name": "theirs", "mimeType": "text/plain", "parent": "root", "size": "7", "owners": [{"me": False}]},
+        }
+    )
+    cleaner.cache._track(cleaner.cache.file_info, GoogleDriveCleaner.FIELDS)
+    return cleaner
+
+
+def test_freed_counts_folder_contents_once():
+    cleaner = make_cleaner()
+    # as "all" passes them, folders along with everything below them
+    freed = asyncio.run(cleaner.clean("top", "sub", "f1", "f2", "link", "theirs", dry_run=True))
+    assert freed == 15
+    assert cleaner.cost_plan.requests["a@x"]["delete"] == 5
+    assert cleaner.cost_plan.quota["a@x"] == -15
+
+
+def test_freed_by_a_file():
+    assert asyncio.run(make_cleaner().clean("other", dry_run=True)) == 1000
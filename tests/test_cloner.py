@@ -0,0 +1,48 @@
+import argparse
+
+from api.info_cache import InfoCache
+from client.cloner import GoogleDriveCloner
+from consts import FOLDER_TYPE
+from gdrive import read_sources
+
+
+def make_cloner():
+    cloner = GoogleDriveCloner.__new__(GoogleDriveCloner)
+    cloner.cache = InfoCache(None)  # type: ignore
+    cloner.cache.file_info.update(
+        {
+            "a": {"name": "a", "mimeType": FOLDER_TYPE, "parent": "root"},
+            "a1": {"name": "a1", "mimeType": FOLDER_TYPE, "parent": "a"},
+            "a2": {"name": "a2", "mimeType": FOLDER_TYPE, "parent": "a"},
+            "a11": {"name": "a11", "mimeType": FOLDER_TYPE, "parent": "a1"},
+            "f": {"name": "f", "mimeType": "text/plain", "parent": "a1"},
+            "ignored": {"name": "node_modules", "mimeType": FOLDER_TYPE, "parent": "a2"},
+            "b": {"name": "b", "mimeType": FOLDER_TYPE, "parent": "root"},
+        }
+    )
+    return cloner
+
+
+def test_distinct_sources_drops_repeats_and_nested_sources():
+    cloner = make_cloner()
+    assert cloner.distinct_sources(["a11", "b", "a", "b", "a1"]) == ["b", "a"]
+    assert cloner.distinct_sources(["a1", "b"]) == ["a1", "b"]
+
+
+def test_folder_levels():
+    cloner = make_cloner()
+    assert cloner.folder_levels("a") == [1, 2, 1]
+    assert cloner.folder_levels("a", "b") == [2, 2, 1]
+    assert cloner.folder_levels("f") == [1]
+
+
+def test_num_files_to_copy_over_several_sources():
+    assert make_cloner().num_files_to_copy("a", "b") == 1
+
+
+def test_read_sources(tmp_path):
+    source_file = tmp_path / "sources.txt"
+    source_file.write_text("c  # nested in a\n\n# only a comment\nd\n")
+    args = argparse.Namespace(source_folder_id=["a", "b"], source_file=str(source_file))
+    assert read_sources(args) == ["a", "b", "c", "d"]
+    assert read_sources(argparse.Namespace(source_folder_id=["a"], source_file=None)) == ["a"]
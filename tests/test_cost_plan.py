@@ -0,0 +1,73 @@
+from api.info_cache import InfoCache
+from api.metrics import METRICS
+from client.cloner import GoogleDriveCloner
+from client.cost_plan import DEFAULT_BATCH_LATENCY, CostPlan, format_duration
+from consts import FOLDER_TYPE, SHORTCUT_TYPE
+
+
+def test_format_duration():
+    assert format_duration(5) == "0m05s"
+    assert format_duration(3605) == "1h00m05s"
+
+
+def test_batches_per_account():
+    plan = CostPlan(request_interval=1)
+    plan.add_requests(None, "copy", 250)
+    plan.add_requests("a@x", "create", 3, batches=3)
+    assert plan.batches == {"default": 3, "a@x": 3}
+    assert plan.requests["default"]["copy"] == 250
+
+
+def test_estimate_without_measured_batches():
+    METRICS.reset()
+    plan = CostPlan(request_interval=2)
+    plan.add_requests(None, "copy", 150)
+    plan.extra_seconds = 10
+    assert plan.estimate_seconds() == 2 * (2 * 1.5 + DEFAULT_BATCH_LATENCY) + 10
+
+
+def test_report_flags_insufficient_quota():
+    plan = CostPlan(request_interval=1)
+    plan.add_requests("a@x", "copy", 1)
+    plan.add_quota("a@x", 2 * 2**30, free=2**30)
+    plan.add_quota("b@x", 2**30, free=2 * 2**30)
+    report = plan.report()
+    assert "quota: +2.000 GiB, free before: 1.000 GiB (INSUFFICIENT)" in report
+    assert "quota: +1.000 GiB, free before: 2.000 GiB\n" in report
+    assert "requests: 1 (1 copy) in 1 batches" in report
+
+
+def make_cloner():
+    cloner = GoogleDriveCloner.__new__(GoogleDriveCloner)
+    cloner.email = "a@x"
+    cloner.cost_plan = CostPlan(request_interval=1)
+    cloner.cache = InfoCache(None)  # type: ignore
+    cloner.cache.file_info.update(
+        {
+            "top": {"name": "top", "mimeType": FOLDER_TYPE, "parent": "root"},
+            "f1": {"name": "f1", "mimeType": "text/plain", "parent": "top"},
+            "sub": {"name": "sub", "mimeType": FOLDER_TYPE, "parent": "top"},
+            "f2": {"name": "f2", "mimeType": "text/plain", "parent": "sub"},
+            "link": {"name": "link", "mimeType": SHORTCUT_TYPE, "parent": "sub", "shortcutDetails": {"targetId": "shared"}},
+            "shared": {"name": "shared", "mimeType": FOLDER_TYPE, "parent": "elsewhere"},
+            "g": {"name": "g", "mimeType": "text/plain", "parent": "shared"},
+            "ignored": {"name": "node_modules", "mimeType": FOLDER_TYPE, "parent": "top"},
+            "h": {"name": "h", "mimeType": "text/plain", "parent": "ignored"},
+        }
+    )
+    return cloner
+
+
+def test_num_files_to_copy_skips_shortcut_targets_and_ignored_folders():
+    # f1, f2 and the shortcut itself
+    assert make_cloner().num_files_to_copy("top") == 3
+
+
+def test_plan_clone():
+    cloner = make_cloner()
+    cloner.plan_clone(["top"], size_to_copy=100, free=50)
+    plan = cloner.cost_plan
+    assert plan.requests["a@x"] == {"create": 2, "copy": 3}
+    # one batch per folder level, and one for the copies
+    assert plan.batches["a@x"] == 3
+    assert plan.quota["a@x"] == 100 and plan.free["a@x"] == 50
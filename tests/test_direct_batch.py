@@ -0,0 +1,44 @@
+import httplib2
+from api.multipart import build_batch_response, parse_batch_request
+from api.direct_batch import DirectBatchHttpRequest
+from googleapiclient.http import HttpRequest
+
+
+class FakeHttp:
+    def __init__(self, answer, mangle=lambda content: content):
+        self.answer = answer
+        self.mangle = mangle
+
+    def request(self, uri, method="GET", body=None, headers=None):
+        parts = parse_batch_request(headers["content-type"], body.encode())
+        content_type, content = build_batch_response([(x[0], 200, self.answer(x[2])) for x in parts])
+        return httplib2.Response({"status": 200, "content-type": content_type}), self.mangle(content)
+
+
+def run_batch(answer, paths, mangle=lambda content: content):
+    http = FakeHttp(answer, mangle)
+    batch = DirectBatchHttpRequest("http://drive/batch")
+    answers = []
+    for path in paths:
+        request = HttpRequest(http, lambda resp, content: content, f"http://drive{path}")
+        batch.add(request, callback=lambda *args: answers.append(args))
+    batch.execute(http=http)
+    return answers
+
+
+def test_undecodable_part_fails_alone():
+    answers = run_batch(lambda path: b'{"id": "a"}' if path == "/a" else b'{"id": ', ["/a", "/b", "/a"])
+    assert [x[1] for x in answers] == [{"id": "a"}, None, {"id": "a"}]
+    assert answers[1][2].status_code == 500
+
+
+def test_malformed_part_fails_the_rest():
+    def mangle(content):
+        # the status line of the second part can't be parsed
+        first = content.index(b"HTTP/1.1 200 OK")
+        second = content.index(b"HTTP/1.1 200 OK", first + 1)
+        return content[:second] + b"HTTP/1.1" + content[second + len(b"HTTP/1.1 200 OK") :]
+
+    answers = run_batch(lambda path: b'{"id": "a"}', ["/a", "/b", "/c"], mangle)
+    assert [x[1] for x in answers] == [{"id": "a"}, None, None]
+    assert [x[2].status_code for x in answers[1:]] == [500, 500]
@@ -0,0 +1,56 @@
+import asyncio
+
+from api.events import EVENTS
+from api.info_cache import InfoCache
+from client.dupes import GoogleDriveDupes
+
+
+class FakeApi:
+    def __init__(self, shortcut_ok=True, delete_ok=True):
+        self.shortcut_ok = shortcut_ok
+        self.delete_ok = delete_ok
+        self.deleted = []
+
+    async def create_shortcut(self, target_id, destination_id, name=None):
+        return {"id": "shortcut"} if self.shortcut_ok else None
+
+    async def delete_file(self, file_id):
+        self.deleted.append(file_id)
+        return "" if self.delete_ok else None
+
+
+class Recorder:
+    def __init__(self):
+        self.events = []
+
+    def put(self, event):
+        self.events.append(event["event"])
+
+
+def replace(api):
+    dupes = GoogleDriveDupes.__new__(GoogleDriveDupes)
+    dupes.api = api
+    dupes.cache = InfoCache(None)  # type: ignore
+    dupes.cache.file_info["copy"] = {"name": "copy", "mimeType": "text/plain", "parent": "folder"}
+    EVENTS.audit = Recorder()
+    try:
+        asyncio.run(dupes.replace_with_shortcut("copy", "kept"))
+        return EVENTS.audit.events
+    finally:
+        EVENTS.audit = None
+
+
+def test_replaced():
+    api = FakeApi()
+    assert replace(api) == ["replaced"]
+    assert api.deleted == ["copy"]
+
+
+def test_copy_kept_without_shortcut():
+    api = FakeApi(shortcut_ok=False)
+    assert replace(api) == ["failed"]
+    assert api.deleted == []
+
+
+def test_failed_delete():
+    assert replace(FakeApi(delete_ok=False)) == ["failed"]
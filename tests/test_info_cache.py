@@ -0,0 +1,185 @@
+import asyncio
+
+from api.info_cache import InfoCache
+from consts import FOLDER_TYPE, SHORTCUT_TYPE
+
+
+def make_cache():
+    cache = InfoCache(None)  # type: ignore
+    cache.file_info.update(
+        {
+            "folder": {"name": "folder", "mimeType": FOLDER_TYPE, "parent": "root"},
+            "child": {"name": "child", "mimeType": "text/plain", "parent": "folder"},
+            "other": {"name": "other", "mimeType": "text/plain", "parent": "root"},
+        }
+    )
+    return cache
+
+
+def test_remove_folder_with_its_child():
+    cache = make_cache()
+    cache.remove("child", "folder")
+    assert set(cache.file_info) == {"other"}
+
+
+def test_remove_child_with_its_folder():
+    cache = make_cache()
+    cache.remove("folder", "child", "missing")
+    assert set(cache.file_info) == {"other"}
+    assert cache.children_index.get("folder") is None
+
+
+def test_folder_size_stops_at_shortcuts():
+    cache = make_cache()
+    cache.file_info["child"]["size"] = "10"
+    cache.file_info.update(
+        {
+            "link": {"name": "link", "mimeType": SHORTCUT_TYPE, "parent": "folder", "shortcutDetails": {"targetId": "shared"}},
+            "shared": {"name": "shared", "mimeType": FOLDER_TYPE, "parent": "elsewhere"},
+            "big": {"name": "big", "mimeType": "video/mp4", "parent": "shared", "size": "1000"},
+        }
+    )
+    assert cache.get_folder_size("folder") == 10
+
+
+class FakeApi:
+    def __init__(self, files):
+        self.files = files
+        self.listed = []
+        self.got = []
+        self.asked = []
+
+    async def get_files(self, *file_ids, fields=None):
+        self.asked.append((sorted(file_ids), set(fields or ())))
+        for file_id in file_ids:
+            self.got.append(file_id)
+            # None is what the batcher answers for files that can't be fetched
+            yield dict(self.files[file_id]) if file_id in self.files else None
+
+    async def fetch_all_file_info(self, query=None, shared=True, fields=None, batch=False):
+        folder_id = query.split("'")[1]
+        self.listed.append(folder_id)
+        return [dict(x) for x in self.files.values() if x.get("parents") == [folder_id]]
+
+
+def drive_files():
+    def item(file_id, parent, mime_type="text/plain", **kwargs):
+        return {"id": file_id, "name": file_id, "mimeType": mime_type, "parents": [parent], **kwargs}
+
+    files = [
+        item("top", "root", FOLDER_TYPE),
+        item("sub", "top", FOLDER_TYPE),
+        item("f", "sub"),
+        # back up the tree, and out of it
+        item("loop", "sub", SHORTCUT_TYPE, shortcutDetails={"targetId": "top"}),
+        item("out", "top", SHORTCUT_TYPE, shortcutDetails={"targetId": "shared"}),
+        item("gone", "top", SHORTCUT_TYPE, shortcutDetails={"targetId": "deleted"}),
+        item("shared", "elsewhere", FOLDER_TYPE),
+        item("g", "shared"),
+    ]
+    return {x["id"]: x for x in files}
+
+
+def test_fetch_files_leaves_out_missing_files():
+    cache = InfoCache(FakeApi({"a": {"id": "a", "name": "a", "mimeType": "text/plain"}}))  # type: ignore
+    fetched = asyncio.run(cache.fetch_files("a", "gone"))
+    assert set(fetched) == {"a"}
+    assert "gone" not in cache.file_info
+
+
+def test_ancestor_in():
+    cache = make_cache()
+    assert cache.ancestor_in("child", {"folder", "other"}) == "folder"
+    assert cache.ancestor_in("folder", {"folder", "child"}) is None
+    assert cache.ancestor_in("missing", {"folder"}) is None
+
+
+def test_get_usage():
+    a, b = [{"emailAddress": "a@x"}], [{"emailAddress": "b@x"}]
+    cache = InfoCache(None)  # type: ignore
+    cache.file_info.update(
+        {
+            "top": {"name": "top", "mimeType": FOLDER_TYPE, "parent": "root", "owners": a},
+            "sub": {"name": "sub", "mimeType": FOLDER_TYPE, "parent": "top", "owners": a},
+            "f1": {"name": "f1", "mimeType": "text/plain", "parent": "top", "size": "10", "owners": a},
+            "f2": {"name": "f2", "mimeType": "text/plain", "parent": "sub", "size": "5", "owners": b},
+            "link": {"name": "link", "mimeType": SHORTCUT_TYPE, "parent": "sub", "shortcutDetails": {"targetId": "f1"}, "owners": a},
+            "elsewhere": {"name": "elsewhere", "mimeType": "text/plain", "parent": "root", "size": "99", "owners": a},
+        }
+    )
+    per_folder, per_type, per_owner = cache.get_usage("top")
+    assert per_folder == {"top": [15, 4], "sub": [5, 2]}
+    assert per_type == {FOLDER_TYPE: [0, 2], "text/plain": [15, 2], SHORTCUT_TYPE: [0, 1]}
+    assert per_owner == {"a@x": [10, 4], "b@x": [5, 1]}
+
+
+def test_get_duplicates():
+    cache = InfoCache(None)  # type: ignore
+    cache.file_info.update(
+        {
+            "top": {"name": "top", "mimeType": FOLDER_TYPE, "parent": "root"},
+            "a": {"name": "a", "mimeType": "text/plain", "parent": "top", "size": "10", "md5Checksum": "x"},
+            "b": {"name": "b", "mimeType": "text/plain", "parent": "top", "size": "10", "md5Checksum": "x"},
+            # same size, other content
+            "c": {"name": "c", "mimeType": "text/plain", "parent": "top", "size": "10", "md5Checksum": "y"},
+            "small1": {"name": "s1", "mimeType": "text/plain", "parent": "top", "size": "1", "md5Checksum": "z"},
+            "small2": {"name": "s2", "mimeType": "text/plain", "parent": "top", "size": "1", "md5Checksum": "z"},
+            # a Google Docs file has no checksum
+            "doc1": {"name": "d1", "mimeType": "application/vnd.google-apps.document", "parent": "top"},
+            "doc2": {"name": "d2", "mimeType": "application/vnd.google-apps.document", "parent": "top"},
+            "outside": {"name": "o", "mimeType": "text/plain", "parent": "root", "size": "10", "md5Checksum": "x"},
+        }
+    )
+    groups = cache.get_duplicates("top", min_size=2)
+    assert [(size, md5, sorted(ids)) for size, md5, ids in groups] == [(10, "x", ["a", "b"])]
+    assert len(cache.get_duplicates("top")) == 2
+
+
+def test_fetch_descendants_follows_shortcuts_once():
+    api = FakeApi(drive_files())
+    cache = InfoCache(api)  # type: ignore
+    asyncio.run(cache.fetch_folder_and_descendants("top"))
+    assert sorted(api.listed) == ["shared", "sub", "top"]
+    assert {"f", "g", "shared"} <= set(cache.file_info)
+    # couldn't be fetched, so it's asked for again next time
+    assert "deleted" not in cache.file_info
+    asyncio.run(cache.fetch_folder_and_descendants("top"))
+    assert api.got.count("deleted") == 2
+    assert api.got.count("shared") == 1
+
+
+def test_fetch_descendants_without_following_shortcuts():
+    api = FakeApi(drive_files())
+    cache = InfoCache(api)  # type: ignore
+    asyncio.run(cache.fetch_folder_and_descendants("top", follow_shortcuts=False))
+    assert sorted(api.listed) == ["sub", "top"]
+    assert api.got == ["top"]
+
+
+def test_track_and_has_fields():
+    cache = InfoCache(None)  # type: ignore
+    cache._track(["a", "b"], {"owners"})
+    assert cache.fields["a"] is cache.fields["b"]
+    # the whole object covers its subfields
+    assert cache.has_fields("a", {"owners/me"})
+    assert not cache.has_fields("a", {"size"})
+    assert not cache.has_fields("missing", ())
+    # a part of an object replaces the whole one
+    cache._track(["a"], {"owners/me", "size"})
+    assert cache.fields["a"] == {"owners/me", "size"}
+    assert not cache.has_fields("a", {"owners"})
+
+
+def test_ensure_fields_fetches_only_what_is_missing():
+    api = FakeApi(drive_files())
+    cache = InfoCache(api)  # type: ignore
+    asyncio.run(cache.fetch_files("f", fields={"owners/me"}))
+    asyncio.run(cache.fetch_files("g", fields={"size"}))
+    api.asked.clear()
+    asyncio.run(cache.ensure_fields(["f", "g"], {"size"}))
+    # along with what it had, so the owners stay
+    assert api.asked == [(["f"], {"owners/me", "size"})]
+    assert cache.has_fields("f", {"owners/me", "size"})
+    api.asked.clear()
+    asyncio.run(cache.ensure_fields(["f", "g"], {"size"}))
+    assert api.asked == []
@@ -0,0 +1,26 @@
+import math
+
+from client.quota import format_fleet_quota, free_space
+
+GIB = 2**30
+
+
+def test_free_space():
+    assert free_space({"limit": str(10 * GIB), "usage": str(3 * GIB)}) == 7 * GIB
+    # unlimited accounts report no limit
+    assert free_space({"usage": "5"}) == math.inf
+
+
+def test_fleet_quota_totals():
+    lines = format_fleet_quota(
+        {
+            "b@x": {"limit": str(2 * GIB), "usage": str(GIB)},
+            "a@x": {"limit": str(4 * GIB), "usage": str(GIB)},
+        }
+    ).splitlines()
+    assert [x.split()[0] for x in lines] == ["account", "a@x", "b@x", "total"]
+    assert lines[-1].split()[-2:] == ["4.000", "GiB"]
+
+
+def test_single_account_has_no_total():
+    assert "total" not in format_fleet_quota({None: {"limit": "1", "usage": "0"}})
@@ -0,0 +1,32 @@
+from api.request_batcher import Attempt
+
+
+class Error(Exception):
+    status_code = 429
+
+
+def make_attempt():
+    answers = []
+    return Attempt(lambda *args: answers.append(args)), answers
+
+
+def test_one_error_per_attempt():
+    attempt, answers = make_attempt()
+    attempt("1", None, Error())
+    attempt("1", None, Error())
+    assert len(answers) == 1
+
+
+def test_no_error_after_response():
+    attempt, answers = make_attempt()
+    attempt("1", {"id": "a"}, None)
+    attempt("1", None, Error())
+    assert answers == [("1", {"id": "a"}, None)]
+
+
+def test_responses_after_giving_up():
+    attempt, answers = make_attempt()
+    attempt.give_up()
+    attempt("1", None, Error())
+    attempt("1", {"id": "a"}, None)
+    assert answers == [("1", {"id": "a"}, None)]
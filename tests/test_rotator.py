@@ -0,0 +1,55 @@
+import asyncio
+from collections import Counter
+
+from api.info_cache import InfoCache
+from client.rotator import GoogleDriveRotator
+from consts import FOLDER_TYPE
+
+
+class FakeApi:
+    def __init__(self, load=0):
+        self.load = load
+        self.fetched = 0
+
+    async def get_files(self, *file_ids, fields=None):
+        self.fetched += 1
+        for file_id in file_ids:
+            yield {"id": file_id, "name": file_id, "mimeType": FOLDER_TYPE, "parents": ["root"]}
+
+    async def fetch_all_file_info(self, query=None, shared=True, fields=None, batch=False):
+        folder_id = query.split("'")[1]
+        if folder_id != "src":
+            return []
+        return [{"id": "big", "name": "big", "mimeType": "text/plain", "parents": ["src"], "size": "100"}]
+
+
+def make_rotator(free, loads=None):
+    rotator = GoogleDriveRotator.__new__(GoogleDriveRotator)
+    rotator.accounts = sorted(free)
+    rotator.quotas = {x: {"limit": str(y), "usage": "0"} for x, y in free.items()}
+    rotator.sessions = {}
+    for email in free:
+        api = FakeApi((loads or {}).get(email, 0))
+        rotator.sessions[email] = (api, InfoCache(api))  # type: ignore
+    return rotator
+
+
+def test_place_on_the_account_with_most_room():
+    rotator = make_rotator({"a": 50, "b": 1000, "c": 200})
+    assert asyncio.run(rotator.place(["src"], Counter()))
+    assert rotator.email == "b"
+    # sized with the pick itself, so fetched once
+    assert [rotator.sessions[x][0].fetched for x in "abc"] == [0, 1, 0]
+
+
+def test_place_prefers_idle_accounts_holding_fewer_backups():
+    rotator = make_rotator({"a": 50, "b": 1000, "c": 200}, loads={"c": 5})
+    # a is ranked first but too small, b holds more backups than c, c is busy
+    assert asyncio.run(rotator.place(["src"], Counter({"b": 1})))
+    assert rotator.email == "b"
+    assert [rotator.sessions[x][0].fetched for x in "abc"] == [1, 1, 0]
+
+
+def test_place_fails_when_nothing_fits():
+    rotator = make_rotator({"a": 50, "b": 99})
+    assert not asyncio.run(rotator.place(["src"], Counter()))
@@ -0,0 +1,51 @@
+from api.info_cache import InfoCache
+from consts import FOLDER_TYPE
+
+
+def make_cache():
+    cache = InfoCache(None)  # type: ignore
+    cache.file_info.update(
+        {
+            "photos": {"name": "Photos", "mimeType": FOLDER_TYPE, "parent": "root"},
+            "beach": {"name": "Beach.JPG", "mimeType": "image/jpeg", "parent": "photos"},
+            "notes": {"name": "notes.txt", "mimeType": "text/plain", "parent": "root"},
+            "ab": {"name": "ab", "mimeType": "text/plain", "parent": "root"},
+        }
+    )
+    return cache
+
+
+def test_find_substring_ignores_case():
+    cache = make_cache()
+    assert cache.search_index.find_substring("jpg") == [("/Photos/Beach.JPG", "beach")]
+    assert [x for _, x in cache.search_index.find_substring("ab")] == ["ab"]
+
+
+def test_find_glob_by_name_and_by_path():
+    index = make_cache().search_index
+    assert [x for _, x in index.find_glob("*.txt")] == ["notes"]
+    assert [x for _, x in index.find_glob("/Photos/*")] == ["beach"]
+    assert index.find_glob("/Other/*") == []
+
+
+def test_renamed_folder_moves_paths_below_it():
+    cache = make_cache()
+    index = cache.search_index
+    cache.apply_changes([{"fileId": "photos", "file": {"id": "photos", "name": "Pictures", "parents": ["root"]}}])
+    assert [x for _, x in index.find_prefix("/Pictures/")] == ["beach"]
+    assert index.find_prefix("/Photos/") == []
+    assert [x for _, x in index.find_substring("pict")] == ["photos"]
+
+
+def test_find_prefix_beyond_the_basic_plane():
+    cache = InfoCache(None)  # type: ignore
+    cache.file_info.update(
+        {
+            "folder": {"name": "photos", "mimeType": FOLDER_TYPE, "parent": "root"},
+            "bmp": {"name": "￮.jpg", "mimeType": "image/jpeg", "parent": "folder"},
+            "emoji": {"name": "\U0001f600.jpg", "mimeType": "image/jpeg", "parent": "folder"},
+            "other": {"name": "notes", "mimeType": "text/plain", "parent": "root"},
+        }
+    )
+    found = [x for _, x in cache.search_index.find_prefix("/photos/")]
+    assert sorted(found) == ["bmp", "emoji"]
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from api.worker_pool import run_bounded
+
+
+class Pbar:
+    def __init__(self):
+        self.n = 0
+
+    def update(self, n):
+        self.n += n
+
+
+def test_runs_every_item_with_at_most_limit_in_flight():
+    done = []
+    in_flight = 0
+    most = 0
+
+    async def work(x, y):
+        nonlocal in_flight, most
+        in_flight += 1
+        most = max(most, in_flight)
+        await asyncio.sleep(0)
+        in_flight -= 1
+        done.append(x + y)
+
+    pbar = Pbar()
+    asyncio.run(run_bounded(work, ((i, 1) for i in range(20)), limit=3, pbar=pbar))
+    assert sorted(done) == list(range(1, 21))
+    assert most == 3
+    assert pbar.n == 20
+
+
+def test_pulls_items_lazily():
+    pulled = 0
+
+    def items():
+        nonlocal pulled
+        for i in range(10):
+            pulled += 1
+            yield (i,)
+
+    async def work(i):
+        # by the first item's end, only one item per worker has been taken
+        if i == 0:
+            assert pulled <= 2
+        await asyncio.sleep(0)
+
+    asyncio.run(run_bounded(work, items(), limit=2))
+    assert pulled == 10
+
+
+def test_error_cancels_the_other_workers():
+    started = []
+
+    async def work(i):
+        started.append(i)
+        if i == 0:
+            raise ValueError(i)
+        await asyncio.sleep(10)
+
+    with pytest.raises(ValueError):
+        asyncio.run(run_bounded(work, ((i,) for i in range(100)), limit=4))
+    assert len(started) == 4